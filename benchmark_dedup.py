@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Dedup Key Benchmark
+Compares the string dedup/connection keys with the single-pass binary keys
+
+Usage:
+    python benchmark_dedup.py [--count N] [--dup-ratio R] [--seed S]
+
+A synthetic corpus of N proxy URIs (vless, vmess, trojan, ss and others, a share of
+them re-published under different remarks) is keyed both ways; the number of unique
+proxies found must match.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+# Make the src package importable when run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.common import connection_key, get_openray_dedup_key, get_proxy_connection_hash, proxy_keys
+
+
+def _host(rnd):
+    if rnd.random() < 0.6:
+        return '.'.join(str(rnd.randint(1, 254)) for _ in range(4))
+    return f"node{rnd.randint(1, 99999)}.example{rnd.randint(1, 500)}.com"
+
+
+def _make_uri(rnd):
+    host = _host(rnd)
+    port = rnd.choice([443, 80, 8080, 2053, 8443, rnd.randint(1000, 65000)])
+    uid = str(uuid.UUID(int=rnd.getrandbits(128)))
+    sni = f"cdn{rnd.randint(1, 50)}.example.org"
+    kind = rnd.random()
+    if kind < 0.40:
+        return (f"vless://{uid}@{host}:{port}?encryption=none&security=tls&sni={sni}"
+                f"&type=ws&host={sni}&path=%2F{rnd.randint(1, 999)}#remark")
+    if kind < 0.65:
+        obj = {'v': '2', 'ps': 'remark', 'add': host, 'port': str(port), 'id': uid, 'aid': '0',
+               'scy': 'auto', 'net': 'ws', 'type': 'none', 'host': sni, 'path': f"/{rnd.randint(1, 999)}",
+               'tls': 'tls', 'sni': sni}
+        return 'vmess://' + base64.b64encode(json.dumps(obj).encode('utf-8')).decode('ascii')
+    if kind < 0.80:
+        return f"trojan://{uid}@{host}:{port}?security=tls&sni={sni}&type=tcp#remark"
+    if kind < 0.95:
+        userinfo = base64.b64encode(f"aes-256-gcm:{uid[:12]}".encode('ascii')).decode('ascii')
+        return f"ss://{userinfo}@{host}:{port}#remark"
+    return f"hysteria2://{uid[:16]}@{host}:{port}?sni={sni}#remark"
+
+
+def _relabel(uri, n):
+    """Same connection, different remark (how re-published proxies usually differ)."""
+    if uri.startswith('vmess://'):
+        obj = json.loads(base64.b64decode(uri[8:]))
+        obj['ps'] = f"copy {n}"
+        return 'vmess://' + base64.b64encode(json.dumps(obj).encode('utf-8')).decode('ascii')
+    return uri.split('#', 1)[0] + f"#copy{n}"
+
+
+def build_corpus(count, dup_ratio, seed):
+    rnd = random.Random(seed)
+    uris = []
+    for i in range(count):
+        if uris and rnd.random() < dup_ratio:
+            uris.append(_relabel(uris[rnd.randrange(len(uris))], i))
+        else:
+            uris.append(_make_uri(rnd))
+    return uris
+
+
+def run_strings(uris):
+    seen, tested = set(), set()
+    for u in uris:
+        key = get_openray_dedup_key(u)
+        if key in seen:
+            continue
+        seen.add(key)
+        tested.add(get_proxy_connection_hash(u))
+    return seen, tested
+
+
+def run_binary(uris):
+    seen, tested = set(), set()
+    for u in uris:
+        # As ProxyRecord does: the connection key only for survivors, unless it came for free
+        key, conn = proxy_keys(u, with_conn=False)
+        if key in seen:
+            continue
+        seen.add(key)
+        tested.add(conn if conn is not None else connection_key(u))
+    return seen, tested
+
+
+def _set_bytes(s):
+    return sys.getsizeof(s) + sum(sys.getsizeof(k) for k in s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark proxy dedup keys on a synthetic corpus')
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--dup-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print("=== OpenRay Dedup Key Benchmark ===")
+    print()
+    start_time = time.perf_counter()
+    uris = build_corpus(max(1, args.count), args.dup_ratio, args.seed)
+    print(f"🧪 Generated {len(uris):,} URIs in {time.perf_counter() - start_time:.1f}s")
+
+    start_time = time.perf_counter()
+    old_seen, old_tested = run_strings(uris)
+    old_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    new_seen, new_tested = run_binary(uris)
+    new_time = time.perf_counter() - start_time
+
+    print(f"   Unique proxies: {len(new_seen):,}")
+    print()
+    print(f"⏱️  String keys:  {old_time:.2f}s ({len(uris) / old_time:,.0f} URIs/sec), "
+          f"key sets {(_set_bytes(old_seen) + _set_bytes(old_tested)) / 1024 / 1024:.1f} MB")
+    print(f"🚀 Binary keys:  {new_time:.2f}s ({len(uris) / new_time:,.0f} URIs/sec), "
+          f"key sets {(_set_bytes(new_seen) + _set_bytes(new_tested)) / 1024 / 1024:.1f} MB")
+    if new_time > 0:
+        print(f"   Speed improvement: {old_time / new_time:.1f}x faster")
+    if len(old_seen) != len(new_seen) or {bytes.fromhex(h) for h in old_tested} != new_tested:
+        print("⚠️  The two key schemes disagree on the unique proxies")
+    else:
+        print("✅ Both key schemes found the same unique proxies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+URI Extraction Benchmark
+Compares the regex extractor with the str.find scanner on the real subscription bodies
+
+Usage:
+    python benchmark_extract.py [sources.txt] [--cache DIR] [--rounds N]
+
+Bodies are downloaded once (or read from DIR when --cache points at an earlier run)
+and then decoded + scanned by both implementations; the URI lists must match.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Make the src package importable when run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.common import safe_b64decode_to_bytes
+from src.parsing import URI_REGEX, decode_subscription, extract_uris, parse_source_line
+
+
+def regex_decode(content, hinted_base64=False):
+    """The regex-based maybe_decode_subscription this benchmark compares against."""
+    def contains_uri(txt):
+        return URI_REGEX.search(txt) is not None
+
+    if hinted_base64:
+        b = safe_b64decode_to_bytes(content)
+        if b:
+            text = b.decode('utf-8', errors='ignore')
+            if contains_uri(text):
+                return text
+            b2 = safe_b64decode_to_bytes(text)
+            if b2:
+                t2 = b2.decode('utf-8', errors='ignore')
+                if contains_uri(t2):
+                    return t2
+        return content
+
+    if contains_uri(content):
+        return content
+    b = safe_b64decode_to_bytes(content)
+    if b:
+        text = b.decode('utf-8', errors='ignore')
+        if contains_uri(text):
+            return text
+        b2 = safe_b64decode_to_bytes(text)
+        if b2:
+            t2 = b2.decode('utf-8', errors='ignore')
+            if contains_uri(t2):
+                return t2
+    return content
+
+
+def regex_extract(text):
+    found = set()
+    uris = []
+    for m in URI_REGEX.finditer(text):
+        uri = m.group(0).rstrip(')>,;"\'\n\r')
+        if uri not in found:
+            found.add(uri)
+            uris.append(uri)
+    return uris
+
+
+def load_bodies(sources_file, cache_dir):
+    entries = []
+    with open(sources_file, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            url, flags = parse_source_line(line.strip())
+            if url:
+                entries.append((url, flags.get('base64', False)))
+
+    def _get(entry):
+        url, hinted = entry
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.txt'
+        path = os.path.join(cache_dir, name) if cache_dir else None
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8', errors='ignore') as fh:
+                return url, hinted, fh.read()
+        try:
+            if os.path.exists(url):
+                with open(url, 'r', encoding='utf-8', errors='ignore') as fh:
+                    body = fh.read()
+            else:
+                import requests
+                r = requests.get(url, timeout=20)
+                r.raise_for_status()
+                body = r.text
+        except Exception:
+            return url, hinted, None
+        if path:
+            with open(path, 'w', encoding='utf-8') as fh:
+                fh.write(body)
+        return url, hinted, body
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        return [b for b in ex.map(_get, entries) if b[2]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark URI extraction on subscription bodies')
+    parser.add_argument('sources', nargs='?', default='sources.txt')
+    parser.add_argument('--cache', default='', help='directory to keep downloaded bodies in')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    print("=== OpenRay URI Extraction Benchmark ===")
+    print()
+    bodies = load_bodies(args.sources, args.cache)
+    total_bytes = sum(len(b[2]) for b in bodies)
+    print(f"📥 Loaded {len(bodies)} sources ({total_bytes/1024/1024:.1f} MB)")
+    if not bodies:
+        print("   Nothing to benchmark")
+        return
+
+    best_regex = best_scan = None
+    mismatches = 0
+    total_uris = 0
+    for _ in range(max(1, args.rounds)):
+        start_time = time.perf_counter()
+        old = [regex_extract(regex_decode(body, hinted)) for _url, hinted, body in bodies]
+        t = time.perf_counter() - start_time
+        best_regex = t if best_regex is None else min(best_regex, t)
+
+        start_time = time.perf_counter()
+        new = [extract_uris(decode_subscription(body, hinted)) for _url, hinted, body in bodies]
+        t = time.perf_counter() - start_time
+        best_scan = t if best_scan is None else min(best_scan, t)
+
+        mismatches = sum(1 for a, b in zip(old, new) if a != b)
+        total_uris = sum(len(x) for x in new)
+
+    print(f"   URIs extracted: {total_uris:,}")
+    print()
+    print(f"⏱️  Regex extractor:  {best_regex:.3f}s (best of {args.rounds})")
+    print(f"🚀 Scanner:          {best_scan:.3f}s (best of {args.rounds})")
+    if best_scan > 0:
+        print(f"   Speed improvement: {best_regex / best_scan:.1f}x faster")
+    if mismatches:
+        print(f"⚠️  {mismatches} sources produced different URI lists")
+    else:
+        print("✅ Both extractors returned identical URI lists")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+State Store Round-Trip Check
+Drives the incremental .state stores through load -> update -> save -> reload -> compact
+in a temporary directory and checks that every reload sees the same state
+
+Usage:
+    python check_state_stores.py [--seed N]
+
+Covers check_counts (value log replay, stale-log merge, old increment lines) and host
+streaks (binary base plus update log, TTL eviction, legacy streaks.json import) and the
+tested index (cold build with and without numpy, merge, reopen, log tails and rewrites).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Make the src package importable when run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.check_counts import CheckCountStore
+from src.streaks import StreakStore, streaks_to_dict
+from src import tested_index
+from src.tested_index import TestedIndex
+
+
+def _uris(rng, n):
+    out = []
+    for i in range(n):
+        host = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        out.append(f"vless://user{i}@{host}:{rng.randint(1, 65535)}?security=tls#node-{i}")
+    return out
+
+
+def _counts(store):
+    return {uri: dict(counts) for uri, counts in store.items()}
+
+
+def check_counts(rng, tmp):
+    failures = []
+    path = os.path.join(tmp, 'check_counts.json')
+    log_path = os.path.join(tmp, 'check_counts.log')
+
+    def reopen():
+        store = CheckCountStore(path, log_path, compact_bytes=1 << 30)
+        store.load()
+        return store
+
+    uris = _uris(rng, 60)
+    store = reopen()
+    store.sync(uris[:40])
+    for _ in range(5):
+        store.increment(rng.sample(uris[:40], 15), 'main')
+        store.increment(rng.sample(uris[:40], 5), 'iran')
+    store.increment(uris[40:45], 'main')  # new proxies are added by increment
+    expected = _counts(store)
+
+    if _counts(reopen()) != expected:
+        failures.append("check_counts: reload after increments differs")
+    if _counts(reopen()) != expected:
+        failures.append("check_counts: replaying the log twice differs")
+
+    store = reopen()
+    store.sync(uris[10:50])
+    store.increment(uris[10:20], 'main')
+    expected = _counts(store)
+    if _counts(reopen()) != expected:
+        failures.append("check_counts: reload after sync differs")
+
+    store = reopen()
+    store.compact()
+    with open(log_path, 'r', encoding='utf-8') as f:
+        if len(f.read().splitlines()) != 1:
+            failures.append("check_counts: compaction left records in the log")
+    if _counts(reopen()) != expected:
+        failures.append("check_counts: reload after compaction differs")
+
+    # A log that names another snapshot (a compaction on one branch, appends on another,
+    # merged by git) is merged conservatively and compacted instead of being dropped
+    with open(path, 'rb') as f:
+        base_snapshot = f.read()
+    with open(log_path, 'rb') as f:
+        base_log = f.read()
+    store = reopen()
+    store.increment(uris[10:15], 'main')
+    appended = _counts(store)
+    with open(log_path, 'rb') as f:
+        appended_log = f.read()
+    with open(path, 'wb') as f:
+        f.write(base_snapshot)
+    with open(log_path, 'wb') as f:
+        f.write(base_log)
+    store = reopen()
+    store.increment(uris[15:20], 'iran')
+    compacted = _counts(store)
+    store.compact()
+    with open(log_path, 'wb') as f:
+        f.write(appended_log)
+    merged = _counts(reopen())
+    lost = [uri for uri in set(appended) | set(compacted)
+            if any(merged.get(uri, {}).get(c, -1) < max(appended.get(uri, {}).get(c, 0), compacted.get(uri, {}).get(c, 0))
+                   for c in ('main', 'iran'))]
+    if lost:
+        failures.append(f"check_counts: merging a stale log lost counts of {len(lost)} proxies")
+    if _counts(reopen()) != merged:
+        failures.append("check_counts: stale log was not compacted after the merge")
+
+    # Relative increments from before values were logged still replay once
+    store = reopen()
+    before = store.get(uris[20])['main']
+    with open(log_path, 'a', encoding='utf-8') as f:
+        f.write(f"i main {store.key(uris[20]).hex()}\n")
+    if reopen().get(uris[20])['main'] != before + 1:
+        failures.append("check_counts: old increment line not replayed")
+    return failures
+
+
+def _legacy_load_streaks(path):
+    """io_ops.load_streaks as it read streaks.json before the binary store."""
+    try:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            data = json.load(f)
+        cleaned = {}
+        for host, obj in data.items():
+            if not isinstance(obj, dict):
+                continue
+            cleaned[host] = {'streak': int(obj.get('streak', 0)), 'last_test': int(obj.get('last_test', 0)),
+                             'last_success': int(obj.get('last_success', 0))}
+        return cleaned
+    except Exception:
+        return {}
+
+
+def check_streaks(rng, tmp):
+    failures = []
+    path = os.path.join(tmp, 'streaks.bin')
+    legacy_path = os.path.join(tmp, 'streaks.json')
+    now = int(time.time())
+
+    def reopen():
+        store = StreakStore(path, ttl_days=30)
+        store.load()
+        return store
+
+    # streaks.json as main.py and main_existing_only.py used to write it
+    hosts = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}" for _ in range(300)]
+    hosts += [f"node{i}.example.com" for i in range(50)] + ['مثال.example']
+    legacy = {}
+    for host in hosts:
+        last_test = now - rng.randint(0, 20 * 86400)
+        streak = rng.randint(0, 40)
+        legacy[host] = {'streak': streak, 'last_test': last_test,
+                        'last_success': last_test if streak else last_test - rng.randint(1, 86400)}
+    legacy['old-run.example'] = {'consecutive': 3, 'last_success': now - 86400}
+    legacy['stale.example'] = {'streak': 2, 'last_test': now - 90 * 86400, 'last_success': now - 90 * 86400}
+    legacy['junk.example'] = 'not a record'
+    with open(legacy_path, 'w', encoding='utf-8') as f:
+        json.dump(legacy, f, ensure_ascii=False)
+    expected = _legacy_load_streaks(legacy_path)
+
+    if streaks_to_dict(reopen()) != expected:
+        failures.append("streaks: legacy streaks.json import differs from the old loader")
+    store = reopen()
+    store.save()
+    if os.path.exists(legacy_path):
+        failures.append("streaks: legacy streaks.json kept after the import was saved")
+    # The import is compacted, which drops hosts untested for ttl_days like any compaction
+    kept = {h: r for h, r in expected.items() if r['last_test'] >= now - 30 * 86400}
+    if streaks_to_dict(reopen()) != kept:
+        failures.append("streaks: reload after the legacy import differs")
+
+    expected = kept
+    for run in range(1, 6):
+        store = reopen()
+        outcomes = {h: rng.random() < 0.7 for h in rng.sample(hosts, 80)}
+        outcomes['new-host.example'] = True
+        saved = streaks_to_dict(store)
+        store.record(outcomes, now=now + run * 3600)
+        for host, ok in outcomes.items():
+            s, _lt, ls = store.get(host)
+            expected[host] = {'streak': s, 'last_test': now + run * 3600, 'last_success': ls}
+            if s != (saved.get(host, {'streak': 0})['streak'] + 1 if ok else 0):
+                failures.append(f"streaks: run {run} recorded {host} wrongly")
+                break
+        store.save()
+        if streaks_to_dict(reopen()) != expected:
+            failures.append(f"streaks: reload after run {run} differs")
+    if not os.path.exists(path + '.log'):
+        failures.append("streaks: small runs were not appended to the update log")
+
+    store = reopen()
+    store.compact(now=now + 6 * 3600)
+    if os.path.exists(path + '.log'):
+        failures.append("streaks: compaction left the update log behind")
+    if streaks_to_dict(reopen()) != expected:
+        failures.append("streaks: reload after compaction differs")
+
+    store = reopen()
+    store.compact(now=now + 60 * 86400)
+    if len(reopen()):
+        failures.append("streaks: hosts untested for ttl_days survived compaction")
+    return failures
+
+
+def _digests(rng, n):
+    return [hashlib.sha1(rng.getrandbits(64).to_bytes(8, 'big')).digest() for _ in range(n)]
+
+
+def _append_records(path, digests, ts):
+    with open(path, 'ab') as f:
+        for d in digests:
+            f.write(ts.to_bytes(8, 'big') + d)
+
+
+def check_tested_index(rng, tmp):
+    failures = []
+    files = [os.path.join(tmp, 'tested.txt'), os.path.join(tmp, 'tested_iran.txt')]
+    index_path = os.path.join(tmp, 'tested.idx')
+    now = int(time.time())
+
+    def reopen():
+        return TestedIndex(index_path, files, bloom_bits_per_entry=10)
+
+    def missing(idx, digests):
+        return sum(1 for d in digests if not idx.contains_digest(d))
+
+    main_digests = _digests(rng, 5000)
+    iran_digests = _digests(rng, 2000) + main_digests[:500]  # proxies tested by both runs
+    _append_records(files[0] + '.bin', main_digests + main_digests[:100], now)
+    _append_records(files[1] + '.bin', iran_digests, now)
+    logged = set(main_digests) | set(iran_digests)
+    never = _digests(rng, 2000)
+
+    # Cold build: the numpy and pure-Python paths must write the same index
+    builds = {}
+    for name, np in (('numpy', tested_index._np), ('python', None)):
+        if name == 'numpy' and np is None:
+            continue
+        for leftover in (index_path, index_path + '.json', os.path.join(tmp, 'tested.bloom')):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        saved_np, tested_index._np = tested_index._np, np
+        try:
+            idx = reopen()
+            if len(idx) != len(logged) or idx.pending:
+                failures.append(f"tested_index: {name} build indexed {len(idx)} of {len(logged)} digests")
+            if missing(idx, logged) or any(idx.contains_digest(d) for d in never):
+                failures.append(f"tested_index: {name} build answers lookups wrongly")
+            idx.close()
+        finally:
+            tested_index._np = saved_np
+        with open(index_path, 'rb') as f:
+            builds[name] = f.read()
+    if len(set(builds.values())) > 1:
+        failures.append("tested_index: numpy and pure-Python builds differ")
+
+    # A run appends its records and registers them, then merges; reopening must not rebuild
+    idx = reopen()
+    fresh = _digests(rng, 300)
+    _append_records(files[0] + '.bin', fresh, now + 60)
+    idx.add_digests(fresh)
+    if missing(idx, fresh):
+        failures.append("tested_index: registered digests not found before the merge")
+    idx.merge()
+    idx.close()
+    logged.update(fresh)
+    idx = reopen()
+    if idx.rebuilt or idx.pending or len(idx) != len(logged):
+        failures.append("tested_index: reopening after a merge did not reuse the index")
+    if missing(idx, logged):
+        failures.append("tested_index: merged digests missing after reopening")
+    idx.close()
+
+    # Records appended by a run that never merged are read back as the unmerged tail
+    tail = _digests(rng, 200)
+    _append_records(files[1] + '.bin', tail, now + 120)
+    logged.update(tail)
+    idx = reopen()
+    if idx.pending != len(tail) or missing(idx, logged):
+        failures.append("tested_index: unmerged log tail not picked up on reopen")
+    idx.merge()
+    idx.close()
+
+    # A rewritten (cleaned up) log invalidates the index, which is rebuilt from the logs
+    kept = iran_digests[:1000]
+    os.remove(files[1] + '.bin')
+    _append_records(files[1] + '.bin', kept, now + 180)
+    logged = set(main_digests) | set(fresh) | set(kept)
+    idx = reopen()
+    dropped = (set(iran_digests) | set(tail)) - logged
+    if len(idx) != len(logged) or missing(idx, logged) or any(idx.contains_digest(d) for d in dropped):
+        failures.append("tested_index: rewritten log not reflected after reopening")
+    idx.close()
+    return failures
+
+
+CHECKS = [
+    ('check_counts', check_counts),
+    ('streaks', check_streaks),
+    ('tested_index', check_tested_index),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Round-trip the incremental state stores through save and reload')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print("=== OpenRay State Store Check ===")
+    print()
+    rng = random.Random(args.seed)
+    failures = []
+    for name, check in CHECKS:
+        tmp = tempfile.mkdtemp(prefix='openray-state-')
+        try:
+            found = check(rng, tmp)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        print(f"   {name}: {'ok' if not found else f'{len(found)} problem(s)'}")
+        failures.extend(found)
+
+    print()
+    if failures:
+        for msg in failures:
+            print(f"❌ {msg}")
+        sys.exit(1)
+    print("✅ Every store reloaded to the state it saved")
+
+
+if __name__ == "__main__":
+    main()
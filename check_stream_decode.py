@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Streaming Decode Equivalence Check
+Feeds subscription bodies to SubscriptionScanner in chunks and compares the URIs with
+the whole-body extract_uris(decode_subscription(...)) path
+
+Usage:
+    python check_stream_decode.py [--seed N] [--rounds N]
+
+Covers padded, unpadded, URL-safe, per-line and double-encoded base64 bodies, plain
+text and junk, each split at random chunk boundaries (down to single bytes).
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+
+# Make the src package importable when run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.common import safe_b64decode_to_bytes
+from src.parsing import SubscriptionScanner, _Base64Layer, decode_subscription, extract_uris
+
+
+class _Collect:
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, chunk):
+        self.data += chunk
+
+
+def _uris(rng, n):
+    out = []
+    for i in range(n):
+        host = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        scheme = rng.choice(['vless', 'trojan', 'ss', 'hysteria2'])
+        out.append(f"{scheme}://user{i}@{host}:{rng.randint(1, 65535)}?security=tls#node-{i}")
+    return out
+
+
+def bodies(rng):
+    uris = _uris(rng, rng.randint(1, 40))
+    text = '\n'.join(uris).encode('utf-8')
+    b64 = base64.b64encode(text)
+    yield 'plain', text, False
+    yield 'padded', b64, False
+    yield 'unpadded', b64.rstrip(b'='), False
+    yield 'wrapped', b'\n'.join(b64[i:i + 76] for i in range(0, len(b64), 76)), False
+    yield 'urlsafe', base64.urlsafe_b64encode(text).rstrip(b'='), True
+    yield 'per-line', b'\n'.join(base64.b64encode(u.encode('utf-8')) for u in uris), False
+    yield 'per-line-urlsafe', b'\r\n'.join(base64.urlsafe_b64encode(u.encode('utf-8')) for u in uris), True
+    yield 'double', base64.b64encode(b64), False
+    yield 'double-per-line', base64.b64encode(b'\n'.join(base64.b64encode(u.encode('utf-8')) for u in uris)), True
+    yield 'junk', bytes(rng.randrange(32, 127) for _ in range(rng.randint(1, 400))), rng.random() < 0.5
+    yield 'non-ascii', b64 + ' ✓'.encode('utf-8'), False
+    yield 'stray-pad', b64[:rng.randint(0, len(b64))] + b'=' * rng.randint(1, 3) + b64, False
+
+
+def _chunks(rng, data):
+    i = 0
+    while i < len(data):
+        n = rng.choice([1, 2, 3, 5, 7, 64, 1000, len(data)])
+        yield data[i:i + n]
+        i += n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check streaming subscription decoding against the whole-body path')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    print("=== OpenRay Streaming Decode Check ===")
+    print()
+    rng = random.Random(args.seed)
+    checked = 0
+    failures = 0
+    for _ in range(max(1, args.rounds)):
+        for name, body, hinted in bodies(rng):
+            text = body.decode('utf-8', errors='ignore')
+            expected = extract_uris(decode_subscription(text, hinted))
+            scanner = SubscriptionScanner(hinted)
+            sink = _Collect()
+            layer = _Base64Layer(sink, ascii_only=True)
+            for chunk in _chunks(rng, body):
+                scanner.feed(chunk)
+                layer.feed(chunk)
+            got = scanner.close()
+            layer.close()
+            raw = safe_b64decode_to_bytes(text)
+            decoded = sink.data if layer.ok and layer.decoded else None
+            checked += 1
+            if got != expected or decoded != (raw or None):
+                failures += 1
+                if failures <= 5:
+                    print(f"❌ {name}: stream {len(got)} URIs / whole body {len(expected)} URIs;"
+                          f" base64 layer {'matches' if decoded == (raw or None) else 'differs'}")
+
+    print(f"   Bodies checked: {checked:,}")
+    if failures:
+        print(f"⚠️  {failures} bodies decoded differently")
+        sys.exit(1)
+    print("✅ Streaming and whole-body decoding returned identical results")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,17 @@ import struct
 import time
 from typing import Set
 
-# Add src to path
-sys.path.insert(0, 'src')
+# Make the src package importable when run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-import constants as C
-from io_ops import (
+from src.io_ops import (
     load_tested_hashes,
     load_tested_hashes_optimized,
-    migrate_to_optimized_format,
+    load_tested_hashes_full,
+    scan_tested_store,
     get_storage_stats
 )
+from src import io_ops
 
 def main():
     print("=== OpenRay Storage Optimization Test ===")
@@ -33,9 +34,34 @@ def main():
     print(f"   Text entries: {stats['text_entries']:,}")
     print(f"   Unique hashes: {stats['unique_hashes']:,}")
     duplicates = stats['text_entries'] - stats['unique_hashes']
-    print(f"   Duplicates: {duplicates:,} ({duplicates/stats['text_entries']*100:.1f}%)")
+    if stats['text_entries'] > 0:
+        print(f"   Duplicates: {duplicates:,} ({duplicates/stats['text_entries']*100:.1f}%)")
+    print(f"   Binary entries: {stats['binary_entries']:,} ({stats.get('binary_unique', 0):,} unique)")
     print()
 
+    # Bulk scan of the .bin logs: per-record loop vs vectorized/array views
+    if stats['binary_entries'] > 0:
+        print("🧮 Testing bulk .bin scan...")
+        start_time = time.time()
+        full = load_tested_hashes_full()
+        loop_time = time.time() - start_time
+        print(f"   Per-record loader: {len(full):,} hashes in {loop_time:.2f}s")
+        del full
+        start_time = time.time()
+        pure = scan_tested_store(use_numpy=False)
+        pure_time = time.time() - start_time
+        print(f"   Array-view scan:   {pure['unique']:,} hashes in {pure_time:.2f}s")
+        if io_ops._np is not None:
+            start_time = time.time()
+            vec = scan_tested_store(use_numpy=True)
+            vec_time = time.time() - start_time
+            print(f"   numpy scan:        {vec['unique']:,} hashes in {vec_time:.2f}s")
+            if vec_time > 0:
+                print(f"   Speed improvement: {loop_time / vec_time:.1f}x faster than the per-record loader")
+        elif pure_time > 0:
+            print(f"   Speed improvement: {loop_time / pure_time:.1f}x faster (install numpy for the vectorized path)")
+        print()
+
     # Test loading with old method
     print("⏱️  Testing old loading method...")
     start_time = time.time()
@@ -51,7 +77,7 @@ def main():
     new_load_time = time.time() - start_time
     print(f"   Loaded {len(new_hashes):,} hashes in {new_load_time:.2f}s")
 
-    if new_load_time > 0 and old_load_time > 0:
+    if old_hashes and new_load_time > 0 and old_load_time > 0:
         speedup = old_load_time / new_load_time
         print(f"   Speed improvement: {speedup:.1f}x faster")
     print()
@@ -59,6 +59,7 @@ class FastXrayVlessTester:
 
         # Performance settings
         self.xray_start_timeout = 3
+        self.startup_times = []     # Seconds from spawn until Xray accepts connections
         self.test_timeout = 15
 
     def _read_vless_urls_from_files(self):
@@ -199,6 +200,25 @@ class FastXrayVlessTester:
 
         return socks_port, http_port
 
+    def _wait_for_xray_ready(self, process, port):
+        """Poll the local inbound until Xray accepts connections; False if it exits or times out"""
+        import socket
+
+        start = time.time()
+        deadline = start + self.xray_start_timeout
+        delay = 0.01
+        while time.time() < deadline:
+            if process.poll() is not None:
+                return False
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.settimeout(0.2)
+                if s.connect_ex(('127.0.0.1', port)) == 0:
+                    self.startup_times.append(time.time() - start)
+                    return True
+            time.sleep(delay)
+            delay = min(0.1, delay * 2)
+        return False
+
     def _test_single_proxy_worker(self, vless_url, worker_id):
         """Worker function to test a single proxy"""
         try:
@@ -216,9 +236,8 @@ class FastXrayVlessTester:
                     stdout=subprocess.DEVNULL,
                     stderr=subprocess.DEVNULL
                 )
-                time.sleep(self.xray_start_timeout)
-
-                if process.poll() is not None:
+                # Wait until the inbound accepts connections (or Xray exits / deadline passes)
+                if not self._wait_for_xray_ready(process, socks_port):
                     return {'url': vless_url, 'success': False, 'error': 'Xray failed to start'}
 
                 proxies = {
@@ -373,6 +392,13 @@ class FastXrayVlessTester:
                     print(f"   {i}. {proxy['server']} - {proxy['response_time_ms']}ms "
                           f"(Status {proxy['status_code']})")
 
+        if self.startup_times:
+            times_ms = sorted(t * 1000 for t in self.startup_times)
+            p50 = times_ms[len(times_ms) // 2]
+            p95 = times_ms[min(len(times_ms) - 1, int(len(times_ms) * 0.95))]
+            print(f"\n🚀 Xray startup: p50 {p50:.0f}ms, p95 {p95:.0f}ms, max {times_ms[-1]:.0f}ms "
+                  f"over {len(times_ms)} starts")
+
         print("=" * 80)
 
 
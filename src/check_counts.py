@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .common import DEDUP_KEY_SIZE, dedup_key_bytes, log
+from .constants import CHECK_COUNTS_COMPACT_KB, CHECK_COUNTS_FILE, CHECK_COUNTS_LOG_FILE
+
+# First line of the change log; names the snapshot (crc32:size) the changes apply to
+_LOG_HEADER = '#openray-check-counts'
+COUNTERS = ('main', 'iran')
+
+
+def _snapshot_id(data: bytes) -> str:
+    return f"{zlib.crc32(data) & 0xFFFFFFFF:08x}:{len(data)}"
+
+
+def _key(uri: str) -> bytes:
+    try:
+        return dedup_key_bytes(uri)
+    except Exception:
+        return hashlib.blake2b(uri.encode('utf-8', errors='ignore'), digest_size=DEDUP_KEY_SIZE).digest()
+
+
+class CheckCountStore:
+    """Per-proxy success counters ({"main": n, "iran": m}) with incremental persistence.
+
+    Entries are keyed by the binary dedup key, so a proxy keeps its counts when it is
+    re-published under another remark. check_counts.json stays the {uri: counts}
+    snapshot; every change after it is appended to check_counts.log as one short line
+    per batch (`v <counter> <key>=<count>...`, `a <key> <uri>`, `d <key>...`). A run
+    therefore writes a few kilobytes instead of rewriting the whole file, and the log is
+    folded back into the snapshot once it outgrows CHECK_COUNTS_COMPACT_KB.
+
+    Counts are logged as absolute values, so replay does not depend on the snapshot.
+    The log header still names the snapshot it extends. When it names another one (an
+    interrupted compaction, or a compaction and an append from two runs merged by git),
+    the log is replayed conservatively: counts never go down, deletions are skipped (the
+    next sync() repeats them) and the result is compacted right away, so a stale log is
+    neither applied twice nor truncated with increments still pending.
+    """
+
+    def __init__(self, path: str = CHECK_COUNTS_FILE, log_path: str = CHECK_COUNTS_LOG_FILE,
+                 compact_bytes: int = CHECK_COUNTS_COMPACT_KB * 1024) -> None:
+        self.path = path
+        self.log_path = log_path
+        self.compact_bytes = compact_bytes
+        self._uris: Dict[bytes, str] = {}
+        self._counts: Dict[bytes, Dict[str, int]] = {}
+        self._by_uri: Dict[str, bytes] = {}
+        self._snapshot = _snapshot_id(b'')
+        self._log_valid = False
+        self._lock = threading.Lock()
+        self.replayed = 0
+        self.written = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def __contains__(self, uri: str) -> bool:
+        return self.key(uri) in self._counts
+
+    def key(self, uri: str) -> bytes:
+        k = self._by_uri.get(uri)
+        if k is None:
+            k = _key(uri)
+            if len(self._by_uri) < 4 * len(self._counts) + 100000:
+                self._by_uri[uri] = k
+        return k
+
+    # ---- loading ----
+    def load(self) -> int:
+        data = b''
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+        except Exception as e:
+            log(f"Failed to load check counts: {e}")
+        self._snapshot = _snapshot_id(data)
+        self._uris, self._counts, self._by_uri = {}, {}, {}
+        try:
+            parsed = json.loads(data.decode('utf-8', errors='ignore')) if data.strip() else {}
+        except Exception as e:
+            log(f"Failed to load check counts: {e}")
+            parsed = {}
+        if isinstance(parsed, dict):
+            for uri, value in parsed.items():
+                if isinstance(value, dict):
+                    counts = {c: int(value.get(c, 0) or 0) for c in COUNTERS}
+                else:
+                    # Old format: a bare main count
+                    counts = {'main': int(value) if isinstance(value, (int, str)) and str(value).isdigit() else 0, 'iran': 0}
+                self._put(str(uri), counts)
+        self._log_valid = self._replay()
+        return len(self._counts)
+
+    def _put(self, uri: str, counts: Dict[str, int]) -> None:
+        k = self.key(uri)
+        prev = self._counts.get(k)
+        if prev is not None:
+            # Same proxy under two remarks in an old snapshot: keep the better record
+            if sum(prev.values()) >= sum(counts.values()):
+                return
+        self._uris[k] = uri
+        self._counts[k] = counts
+
+    def _replay(self) -> bool:
+        """Apply the change log; False when there is none to append to (it is then started afresh)."""
+        try:
+            with open(self.log_path, 'r', encoding='utf-8', errors='ignore') as f:
+                header = f.readline().split()
+                current = header[:2] == [_LOG_HEADER, self._snapshot]
+                if not current:
+                    log(f"Check counts log belongs to snapshot {header[1] if len(header) > 1 else '?'}, "
+                        f"not {self._snapshot}; merging it conservatively")
+                for line in f:
+                    parts = line.rstrip('\n').split(' ')
+                    try:
+                        self._apply(parts, current)
+                    except (ValueError, IndexError):
+                        continue
+                    self.replayed += 1
+        except (OSError, IndexError):
+            return False
+        if not current:
+            try:
+                self._compact()
+            except Exception as e:
+                log(f"Failed to save check counts: {e}")
+                return False
+        return True
+
+    def _apply(self, parts: List[str], current: bool = True) -> None:
+        op = parts[0]
+        if op == 'v':
+            counter = parts[1]
+            for item in parts[2:]:
+                h, _, n = item.partition('=')
+                counts = self._counts.get(bytes.fromhex(h))
+                if counts is not None:
+                    counts[counter] = int(n) if current else max(int(n), counts.get(counter, 0))
+        elif op == 'i' and current:
+            # Relative increments written before counts were logged as values
+            counter = parts[1]
+            for h in parts[2:]:
+                counts = self._counts.get(bytes.fromhex(h))
+                if counts is not None:
+                    counts[counter] = counts.get(counter, 0) + 1
+        elif op == 'a':
+            k = bytes.fromhex(parts[1])
+            uri = ' '.join(parts[2:])
+            self._uris[k] = uri
+            self._counts.setdefault(k, {c: 0 for c in COUNTERS})
+        elif op == 'd' and current:
+            for h in parts[1:]:
+                k = bytes.fromhex(h)
+                self._uris.pop(k, None)
+                self._counts.pop(k, None)
+
+    # ---- queries ----
+    def get(self, uri: str, default: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        counts = self._counts.get(self.key(uri))
+        if counts is None:
+            return default if default is not None else {c: 0 for c in COUNTERS}
+        return counts
+
+    def items(self) -> Iterable[Tuple[str, Dict[str, int]]]:
+        for k, counts in self._counts.items():
+            yield self._uris[k], counts
+
+    def top_k(self, counter: str, k: int = 100, among: Optional[Sequence[str]] = None,
+              tiebreak: Optional[str] = None) -> List[Tuple[str, Dict[str, int]]]:
+        """The k proxies with the highest counter (then tiebreak), earlier entries first on ties.
+
+        among restricts the ranking to those URIs (in their order); without it every
+        stored proxy is ranked.
+        """
+        if among is None:
+            pool = ((i, uri, counts) for i, (uri, counts) in enumerate(self.items()))
+        else:
+            empty = {c: 0 for c in COUNTERS}
+            pool = ((i, uri, self._counts.get(self.key(uri), empty)) for i, uri in enumerate(among))
+        best = heapq.nsmallest(k, pool, key=lambda t: (-t[2].get(counter, 0), -t[2].get(tiebreak, 0) if tiebreak else 0, t[0]))
+        return [(uri, counts) for _, uri, counts in best]
+
+    # ---- updates ----
+    def increment(self, uris: Iterable[str], counter: str) -> int:
+        """Add one to counter for each distinct proxy in uris (new proxies are added); returns the count."""
+        lines: List[str] = []
+        keys: List[str] = []
+        seen = set()
+        with self._lock:
+            for uri in uris:
+                if not uri:
+                    continue
+                k = self.key(uri)
+                if k in seen:
+                    continue
+                seen.add(k)
+                counts = self._counts.get(k)
+                if counts is None:
+                    counts = self._counts[k] = {c: 0 for c in COUNTERS}
+                    self._uris[k] = uri
+                    lines.append(f"a {k.hex()} {uri}")
+                counts[counter] = counts.get(counter, 0) + 1
+                keys.append(f"{k.hex()}={counts[counter]}")
+            if keys:
+                lines.append(f"v {counter} " + ' '.join(keys))
+            self._write(lines)
+        return len(keys)
+
+    def sync(self, uris: Iterable[str]) -> Tuple[int, int]:
+        """Keep exactly the proxies in uris: drop the others, add missing ones at zero
+        and follow remark changes. Returns (removed, added)."""
+        lines: List[str] = []
+        wanted: Dict[bytes, str] = {}
+        with self._lock:
+            for uri in uris:
+                if uri:
+                    wanted.setdefault(self.key(uri), uri)
+            if not wanted:
+                return 0, 0
+            removed = [k for k in self._counts if k not in wanted]
+            for k in removed:
+                self._uris.pop(k, None)
+                del self._counts[k]
+            if removed:
+                lines.append('d ' + ' '.join(k.hex() for k in removed))
+            added = 0
+            for k, uri in wanted.items():
+                if k not in self._counts:
+                    self._counts[k] = {c: 0 for c in COUNTERS}
+                    added += 1
+                elif self._uris.get(k) == uri:
+                    continue
+                self._uris[k] = uri
+                lines.append(f"a {k.hex()} {uri}")
+            self._write(lines)
+        return len(removed), added
+
+    def retain(self, uris: Iterable[str]) -> int:
+        """Drop every proxy not in uris; returns how many were removed."""
+        keep = {self.key(u) for u in uris if u}
+        with self._lock:
+            removed = [k for k in self._counts if k not in keep]
+            for k in removed:
+                self._uris.pop(k, None)
+                del self._counts[k]
+            if removed:
+                self._write(['d ' + ' '.join(k.hex() for k in removed)])
+        return len(removed)
+
+    # ---- persistence ----
+    def _write(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        text = ''.join(ln.replace('\n', ' ') + '\n' for ln in lines)
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            if not self._log_valid:
+                # No usable log yet (or a stale one): start a fresh one for the current snapshot
+                text = f"{_LOG_HEADER} {self._snapshot}\n" + text
+            with open(self.log_path, 'a' if self._log_valid else 'w', encoding='utf-8') as f:
+                f.write(text)
+            self._log_valid = True
+            self.written += len(text)
+            if os.path.getsize(self.log_path) >= self.compact_bytes:
+                self._compact()
+        except Exception as e:
+            log(f"Failed to save check counts: {e}")
+
+    def _compact(self) -> None:
+        data = json.dumps({self._uris[k]: counts for k, counts in self._counts.items()},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        self._snapshot = _snapshot_id(data)
+        tmp = self.log_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(f"{_LOG_HEADER} {self._snapshot}\n")
+        os.replace(tmp, self.log_path)
+        self.written += len(data)
+
+    def compact(self) -> None:
+        with self._lock:
+            try:
+                self._compact()
+                self._log_valid = True
+            except Exception as e:
+                log(f"Failed to save check counts: {e}")
+
+
+_store: Optional[CheckCountStore] = None
+_store_lock = threading.Lock()
+
+
+def get_check_counts() -> CheckCountStore:
+    """The process-wide store, loaded on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = CheckCountStore()
+                store.load()
+                _store = store
+    return _store
@@ -1,10 +1,11 @@
 from __future__ import annotations
 import os
 import base64
+import functools
 import hashlib
 import threading
 import json
-from urllib.parse import urlparse
+from urllib.parse import ParseResult, urlparse
 
 try:
     from tqdm import tqdm as _tqdm  # type: ignore
@@ -32,10 +33,18 @@ def sha1_hex(s: str) -> str:
     return hashlib.sha1(s.encode('utf-8', errors='ignore')).hexdigest()
 
 
-def safe_b64decode_to_bytes(s: str) -> bytes | None:
+def safe_b64decode_to_bytes(s: str | bytes) -> bytes | None:
     """Try to base64-decode a string with leniency (padding, URL-safe). Returns None on failure."""
     if not s:
         return None
+    if isinstance(s, (bytes, bytearray)):
+        # Already-decoded layers are scanned as bytes; handle them without a text copy
+        compact = b''.join(s.split()).replace(b'-', b'+').replace(b'_', b'/')
+        compact += b'=' * ((-len(compact)) % 4)
+        try:
+            return base64.b64decode(compact, validate=False)
+        except Exception:
+            return None
     # Remove whitespace
     compact = ''.join(s.split())
     # Convert URL-safe variants
@@ -49,6 +58,55 @@ def safe_b64decode_to_bytes(s: str) -> bytes | None:
         return None
 
 
+@functools.lru_cache(maxsize=65536)
+def _decode_vmess_cached(payload_b64: str):
+    try:
+        b = safe_b64decode_to_bytes(payload_b64)
+        if not b:
+            return None
+        obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
+    except Exception:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def decode_vmess_payload(payload_b64: str) -> dict | None:
+    """Decode a vmess base64-JSON payload to a dict, or None when it is not one.
+
+    Decodes are cached, since one URI is looked at by dedup, host/port extraction,
+    remark handling and config export; a fresh shallow copy is returned so callers
+    can edit it.
+    """
+    obj = _decode_vmess_cached(payload_b64 or '')
+    return dict(obj) if obj is not None else None
+
+
+_SCHEME_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-.')
+
+
+def _split_uri(base_uri: str):
+    """urlparse(base_uri) without its overhead for the plain URIs the extractor yields.
+
+    Only printable ASCII without spaces, brackets, ';' or '#' and with a well-formed
+    scheme takes the short path (where urlparse has nothing to strip, validate or split
+    off); anything else goes through urlparse itself.
+    """
+    if not (base_uri.isascii() and base_uri.isprintable()) or ' ' in base_uri or ';' in base_uri \
+            or '#' in base_uri or '[' in base_uri or ']' in base_uri:
+        return urlparse(base_uri)
+    scheme, sep, rest = base_uri.partition('://')
+    if not sep or not scheme or not scheme[0].isalpha() or not _SCHEME_CHARS.issuperset(scheme):
+        return urlparse(base_uri)
+    end = len(rest)
+    for c in '/?':
+        i = rest.find(c)
+        if 0 <= i < end:
+            end = i
+    netloc, tail = rest[:end], rest[end:]
+    path, _q, query = tail.partition('?')
+    return ParseResult(scheme.lower(), netloc, path, '', query, '')
+
+
 def normalize_proxy_uri(uri: str) -> str:
     """
     Extract only connection-defining parameters from a proxy URI.
@@ -78,8 +136,7 @@ def normalize_proxy_uri(uri: str) -> str:
         base_uri = uri.split('#', 1)[0]
 
         # Parse the URI
-        from urllib.parse import urlparse, parse_qs, unquote
-        parsed = urlparse(base_uri)
+        parsed = _split_uri(base_uri)
 
         protocol = parsed.scheme.lower()
         if not protocol:
@@ -112,13 +169,10 @@ def _normalize_vmess(uri: str, parsed) -> str:
         if not payload_b64:
             return uri
 
-        b = safe_b64decode_to_bytes(payload_b64)
-        if not b:
+        obj = decode_vmess_payload(payload_b64)
+        if obj is None:
             return uri
 
-        import json
-        obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
-
         # Normalize empty strings to None for optional fields
         def normalize_value(v):
             if v == '' or v is None:
@@ -460,6 +514,11 @@ def get_openray_dedup_key(uri: str) -> str:
     - For vmess: use normalized connection hash (removes ps/remarks, normalizes parameters).
     - For vless: consider only characters before '?', and ignore '/' characters.
     """
+    return _openray_dedup_key(uri)
+
+
+def _openray_dedup_key(uri: str, normalized: str | None = None) -> str:
+    """get_openray_dedup_key, reusing normalize_proxy_uri(uri) when the caller already has it."""
     if not uri:
         return ''
 
@@ -469,24 +528,24 @@ def get_openray_dedup_key(uri: str) -> str:
         if '://' not in base_uri:
             return f"raw|{base_uri}"
 
-        parsed = urlparse(base_uri)
-        scheme = (parsed.scheme or '').lower()
+        scheme = (_split_uri(base_uri).scheme or '').lower()
 
         if scheme == 'vmess':
             # Use normalized connection hash for vmess to properly detect duplicates
             # This removes ps field and normalizes all connection parameters
-            normalized = normalize_proxy_uri(uri)
+            if normalized is None:
+                normalized = normalize_proxy_uri(uri)
             return f"vmess|{normalized}"
 
         if scheme == 'vless':
             # Take substring after scheme up to '?', then remove all '/'
             after_scheme = base_uri.split('://', 1)[1]
             before_query = after_scheme.split('?', 1)[0]
-            normalized = before_query.replace('/', '')
-            return f"vless|{normalized}"
+            return f"vless|{before_query.replace('/', '')}"
 
         if scheme == 'trojan':
-            normalized = normalize_proxy_uri(uri)
+            if normalized is None:
+                normalized = normalize_proxy_uri(uri)
             return f"trojan|{normalized}"
 
         # Default: equality-based on the base URI (without remarks)
@@ -496,6 +555,49 @@ def get_openray_dedup_key(uri: str) -> str:
         # Fallback to raw string if anything goes wrong
         return f"raw|{uri.strip()}"
 
+
+# Binary dedup keys: 16-byte BLAKE2b of the OpenRay dedup string
+DEDUP_KEY_SIZE = 16
+
+
+# Schemes whose dedup key is built from normalize_proxy_uri (see get_openray_dedup_key)
+_NORMALIZED_DEDUP = frozenset(('vmess', 'trojan'))
+
+
+def proxy_keys(uri: str, with_conn: bool = True) -> tuple[bytes, bytes | None]:
+    """Binary (dedup key, connection key) of a URI from a single normalization.
+
+    The dedup key is a DEDUP_KEY_SIZE-byte BLAKE2b digest of get_openray_dedup_key(uri);
+    the connection key is the raw 20-byte SHA-1 behind get_proxy_connection_hash(uri)
+    (its .hex() is that hash), i.e. the digest the tested store keeps. vmess and trojan
+    share the one normalize_proxy_uri call both keys need. With with_conn=False the
+    connection key is only returned when it came for free (vmess, trojan), else None:
+    duplicates are usually dropped on the dedup key alone.
+    """
+    normalized = None
+    if with_conn:
+        normalized = normalize_proxy_uri(uri)
+    else:
+        scheme = uri.split('://', 1)[0].strip().lower() if uri and '://' in uri else ''
+        if scheme in _NORMALIZED_DEDUP:
+            normalized = normalize_proxy_uri(uri)
+    dedup = hashlib.blake2b(_openray_dedup_key(uri, normalized).encode('utf-8', errors='ignore'),
+                            digest_size=DEDUP_KEY_SIZE).digest()
+    if normalized is None:
+        return dedup, None
+    return dedup, hashlib.sha1(normalized.encode('utf-8', errors='ignore')).digest()
+
+
+def dedup_key_bytes(uri: str) -> bytes:
+    """Binary form of get_openray_dedup_key (comparable with ProxyRecord.dedup_key)."""
+    return proxy_keys(uri, with_conn=False)[0]
+
+
+def connection_key(uri: str) -> bytes:
+    """Raw 20-byte digest of get_proxy_connection_hash (the tested-store key)."""
+    return hashlib.sha1(normalize_proxy_uri(uri).encode('utf-8', errors='ignore')).digest()
+
+
 def _get_vmess_v2rayn_key(parsed) -> str:
     """Get V2RayN-style connection key for VMess."""
     try:
@@ -505,11 +607,9 @@ def _get_vmess_v2rayn_key(parsed) -> str:
         if not payload_b64:
             return "invalid_vmess"
             
-        b = safe_b64decode_to_bytes(payload_b64)
-        if not b:
+        obj = decode_vmess_payload(payload_b64)
+        if obj is None:
             return "invalid_vmess"
-            
-        obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
         
         # CORRECTED: V2RayN considers these parameters as unique (gives 122 unique proxies, close to V2RayN's 107)
         key_parts = [
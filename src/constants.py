@@ -14,9 +14,20 @@ STATE_DIR = os.path.join(REPO_ROOT, '.state')
 OUTPUT_DIR = os.path.join(REPO_ROOT, 'output')
 TESTED_FILE = os.path.join(STATE_DIR, 'tested.txt')  # stores SHA1 per tested proxy URI
 AVAILABLE_FILE = os.path.join(OUTPUT_DIR, 'all_valid_proxies.txt')
-STREAKS_FILE = os.path.join(STATE_DIR, 'streaks.json')
+STREAKS_FILE = os.path.join(STATE_DIR, 'streaks.bin')  # packed per-host streaks (+ streaks.bin.log of recent updates)
 KIND_DIR = os.path.join(OUTPUT_DIR, 'kind')
+SOURCE_STATE_FILE = os.path.join(STATE_DIR, 'sources.json')  # per-source validators and digests
+CHECK_COUNTS_FILE = os.path.join(STATE_DIR, 'check_counts.json')  # compacted {uri: {"main": n, "iran": m}} snapshot
+CHECK_COUNTS_LOG_FILE = os.path.join(STATE_DIR, 'check_counts.log')  # append-only changes since the snapshot
+SCORES_FILE = os.path.join(STATE_DIR, 'scores.json')  # compacted decayed success rates and latency samples per proxy
+SCORES_LOG_FILE = os.path.join(STATE_DIR, 'scores.log')  # append-only check outcomes since the snapshot
+FASTEST_FILE = os.path.join(OUTPUT_DIR, 'fastest.txt')  # available proxies by measured median latency
+FASTEST_DIR = os.path.join(OUTPUT_DIR, 'fastest')  # fastest/<CC>.txt, the same per country
 COUNTRY_DIR = os.path.join(OUTPUT_DIR, 'country')
+GEO_RANGES_FILE = os.path.join(STATE_DIR, 'geo_ranges.bin')  # offline IP-range -> country table
+GEOIP_MMDB_FILE = os.path.join(REPO_ROOT, 'GeoLite2-Country.mmdb')
+# Optional CSV of IP ranges (network,cc or first_ip,last_ip,cc) for the offline table
+GEO_CSV_FILE = os.environ.get('OPENRAY_GEO_CSV', '')
 
 
 def _env_int(name: str, default: int, min_v: Optional[int] = None, max_v: Optional[int] = None) -> int:
@@ -311,11 +322,65 @@ PING_TIMEOUT_MS = _env_int('OPENRAY_PING_TIMEOUT_MS',
 
 # Workers (maximum performance with safety limits)
 FETCH_WORKERS = _env_int('OPENRAY_FETCH_WORKERS', max(_opt_fetch, 16), 1, 512)
+# Concurrent source downloads per origin (most sources share raw.githubusercontent.com) and
+# how long an idle keep-alive connection is kept for the next source from that origin (seconds)
+FETCH_PER_HOST = _env_int('OPENRAY_FETCH_PER_HOST', 6, 1, 256)
+FETCH_KEEPALIVE_S = _env_int('OPENRAY_FETCH_KEEPALIVE', 30, 1, 600)
 PING_WORKERS = _env_int('OPENRAY_PING_WORKERS', max(_opt_ping, 32), 1, 2048)
+# In-flight proxies for the asyncio Stage 2 engine (coroutines are cheap; bounded by fd limits at runtime)
+STAGE2_CONCURRENCY = _env_int('OPENRAY_STAGE2_CONCURRENCY', max(PING_WORKERS * 4, 256), 1, 65536)
+# Hard wall-clock limit per proxy in Stage 2 (seconds)
+STAGE2_ITEM_TIMEOUT = _env_int('OPENRAY_STAGE2_ITEM_TIMEOUT', 10, 1, 120)
+# Worker processes keying (normalize + hash) large sources in parallel (0: in-process only);
+# sources with fewer URIs than PARSE_POOL_MIN_URIS are keyed in-process, where IPC costs more
+PARSE_PROCESSES = _env_int('OPENRAY_PARSE_PROCESSES', max(0, min(8, _get_system_specs()[0] - 1)), 0, 64)
+PARSE_POOL_MIN_URIS = _env_int('OPENRAY_PARSE_POOL_MIN_URIS', 5000, 1, 100000000)
+# Ask ip-api.com about IPs the offline data cannot place: 1 always, 0 never,
+# -1 (default) only when neither the range table nor a GeoLite2 database could be loaded
+GEO_HTTP_FALLBACK = _env_int('OPENRAY_GEO_HTTP', -1, -1, 1)
+# GeoLite2 reader: load the whole database into RAM instead of mmap (1), IP -> country LRU size
+GEOIP_IN_MEMORY = _env_int('OPENRAY_GEOIP_MEMORY', 0, 0, 1)
+GEOIP_CACHE_SIZE = _env_int('OPENRAY_GEOIP_CACHE', 100000, 0, 10000000)
+# Bounded hand-off queues between pipeline stages (fetch -> Stage 2 -> Stage 3); caps memory under backpressure
+PIPELINE_QUEUE_SIZE = _env_int('OPENRAY_PIPELINE_QUEUE_SIZE', 4096, 16, 1000000)
 
 # TCP connect timeout for checking specific proxy ports (ms) - maximum performance
 CONNECT_TIMEOUT_MS = _env_int('OPENRAY_CONNECT_TIMEOUT_MS',
                              min(_opt_connect_timeout, 500), 50, 10000)
+# Shared DNS resolver cache: positive TTL (seconds), negative TTL, max entries
+DNS_CACHE_TTL = _env_int('OPENRAY_DNS_TTL', 3 * 3600, 0, 7 * 86400)
+DNS_NEGATIVE_TTL = _env_int('OPENRAY_DNS_NEGATIVE_TTL', 300, 0, 86400)
+DNS_CACHE_MAX = _env_int('OPENRAY_DNS_CACHE_MAX', 200000, 100, 5000000)
+DNS_TIMEOUT_MS = _env_int('OPENRAY_DNS_TIMEOUT_MS', 3000, 100, 30000)
+DNS_WORKERS = _env_int('OPENRAY_DNS_WORKERS', 64, 1, 1024)
+# Conditional fetching of sources whose last pass was fully tested (0 disables)
+SOURCE_CACHE_ENABLED = _env_int('OPENRAY_SOURCE_CACHE', 1, 0, 1)
+# Source health: consecutive failed fetches before quarantine, max backoff before that,
+# and how often a quarantined source is probed again (hours)
+SOURCE_QUARANTINE_FAILS = _env_int('OPENRAY_SOURCE_QUARANTINE_FAILS', 6, 1, 1000)
+SOURCE_BACKOFF_MAX_H = _env_int('OPENRAY_SOURCE_BACKOFF_MAX_H', 12, 1, 24 * 30)
+SOURCE_QUARANTINE_RETRY_H = _env_int('OPENRAY_SOURCE_QUARANTINE_RETRY_H', 24, 1, 24 * 90)
+# Unmerged tested-hash records tolerated before the sorted index is rewritten
+TESTED_INDEX_MERGE_MIN = _env_int('OPENRAY_TESTED_INDEX_MERGE_MIN', 50000, 1, 100000000)
+# Hosts not tested for this many days are dropped from the streaks store when it is compacted
+STREAKS_TTL_DAYS = _env_int('OPENRAY_STREAKS_TTL_DAYS', 30, 1, 3650)
+# Reliability score: half-life (hours) of past check outcomes, latency samples kept per stage,
+# and the Stage 2 (TCP connect) / Stage 3 latencies (ms) at which the latency factor drops to one half
+SCORE_HALF_LIFE_H = _env_int('OPENRAY_SCORE_HALF_LIFE_H', 72, 1, 24 * 365)
+SCORE_LATENCY_SAMPLES = _env_int('OPENRAY_SCORE_LATENCY_SAMPLES', 16, 1, 1000)
+SCORE_STAGE2_REF_MS = _env_int('OPENRAY_SCORE_STAGE2_REF_MS', 250, 1, 60000)
+SCORE_STAGE3_REF_MS = _env_int('OPENRAY_SCORE_STAGE3_REF_MS', 1500, 1, 60000)
+# Proxies not checked for this many days are dropped from the scores, and the outcome log size (KB)
+# at which it is folded into scores.json
+SCORE_TTL_DAYS = _env_int('OPENRAY_SCORE_TTL_DAYS', 14, 1, 3650)
+SCORES_COMPACT_KB = _env_int('OPENRAY_SCORES_COMPACT_KB', 2048, 1, 1024 * 1024)
+# Entries in output/fastest.txt and in each output/fastest/<CC>.txt
+FASTEST_TOP = _env_int('OPENRAY_FASTEST_TOP', 100, 1, 100000)
+FASTEST_PER_COUNTRY = _env_int('OPENRAY_FASTEST_PER_COUNTRY', 20, 1, 100000)
+# Check-count change log size (KB) at which it is folded into check_counts.json
+CHECK_COUNTS_COMPACT_KB = _env_int('OPENRAY_CHECK_COUNTS_COMPACT_KB', 1024, 1, 1024 * 1024)
+# Bloom filter bits per tested hash in front of the index (10 ~ 1% false positives)
+TESTED_BLOOM_BITS = _env_int('OPENRAY_TESTED_BLOOM_BITS', 10, 4, 32)
 # Ports to try for TCP connectivity fallback (when ICMP ping is blocked, e.g., in CI)
 TCP_FALLBACK_PORTS: List[int] = [80, 443, 8080, 8443, 2052, 2082, 2086, 2095]
 USER_AGENT = (
@@ -360,6 +425,13 @@ def _adaptive_stage3_workers() -> int:
 # Stage 3 adaptive workers (maximum performance)
 STAGE3_WORKERS = _env_int('OPENRAY_STAGE3_WORKERS',
                          max(_adaptive_stage3_workers(), 24), 4, 512)
+# Stage 3 Xray pool: concurrent core instances, and outbounds loaded into each instance per start
+XRAY_INSTANCES = _env_int('OPENRAY_XRAY_INSTANCES', 4, 1, 64)
+XRAY_BATCH_SIZE = _env_int('OPENRAY_XRAY_BATCH_SIZE', 128, 1, 2000)
+# Deadline for a started core to accept connections on all its inbounds (ms)
+XRAY_START_TIMEOUT_MS = _env_int('OPENRAY_XRAY_START_TIMEOUT_MS', 5000, 200, 60000)
+# Parsed ProxyRecord objects kept per process (parse-once cache of URIs)
+PROXY_RECORD_CACHE = _env_int('OPENRAY_PROXY_RECORD_CACHE', 200000, 0, 10000000)
 
 # Limit for number of new URIs processed per run (overridable)
 NEW_URIS_LIMIT_ENABLED = _env_int('OPENRAY_NEW_URIS_LIMIT_ENABLED', 1, 0, 1)
@@ -418,6 +490,7 @@ if os.environ.get('OPENRAY_DEBUG', '').strip() in ('1', 'true', 'yes'):
     print("⚙️  WORKERS:")
     print(f"   FETCH_WORKERS: {FETCH_WORKERS} (was: {_opt_fetch})")
     print(f"   PING_WORKERS: {PING_WORKERS} (was: {_opt_ping})")
+    print(f"   STAGE2_CONCURRENCY: {STAGE2_CONCURRENCY}")
     print(f"   STAGE3_WORKERS: {STAGE3_WORKERS}")
     print("⏱️  TIMEOUTS:")
     print(f"   PING_TIMEOUT_MS: {PING_TIMEOUT_MS}ms (auto: {_opt_ping_timeout}ms)")
@@ -80,6 +80,23 @@ def read_local_subscription(file_path):
         sys.exit(1)
 
 
+def order_by_ranking(lines, ranking_file):
+    """Move the lines listed in ranking_file (best first, e.g. main_top100_checked.txt) to the front.
+
+    Ranked lines keep the ranking's order, the others keep their own order after them.
+    """
+    try:
+        with open(ranking_file, 'r', encoding='utf-8') as f:
+            ranked = [line.strip() for line in f if line.strip()]
+    except Exception as e:
+        print(f'[!] WARNING: Ranking file not used ({ranking_file}): {e}')
+        return lines
+    pos = {}
+    for i, line in enumerate(ranked):
+        pos.setdefault(line, i)
+    return sorted(lines, key=lambda line: pos.get(line, len(ranked)))
+
+
 # --- PROTOCOL PARSERS ---
 def parse_vmess(uri):
     # vmess://<base64json>
@@ -698,8 +715,8 @@ def update_singbox_outbounds(sj, proxies):
     # Replace all outbounds but keep system ones and add new ones
     sj['outbounds'] = system_outbounds + new_outbounds
 
-    # Update selector and urltest outbounds with new proxy tags
-    proxy_tags = list(tagset)
+    # Update selector and urltest outbounds with new proxy tags (input order: best ranked first)
+    proxy_tags = [o['tag'] for o in new_outbounds]
     for o in sj['outbounds']:
         if o['type'] == 'selector' and o.get('tag') == 'proxy':
             # Replace any placeholder with auto + all proxies
@@ -883,12 +900,14 @@ def proxy_to_singbox(proxy):
 
 # ------ MAIN ENTRYPOINT ------
 if __name__ == '__main__':
-    if len(sys.argv) != 6:
+    if len(sys.argv) not in (6, 7):
         print(
-            "Usage: python sub2clash_singbox.py <sub_url_or_file> <clash_template.yaml> <singbox_template.json> <output_clash.yaml> <output_singbox.json>")
+            "Usage: python sub2clash_singbox.py <sub_url_or_file> <clash_template.yaml> <singbox_template.json> <output_clash.yaml> <output_singbox.json> [ranking.txt]")
         print("       <sub_url_or_file> can be a URL (https://...) or local file path")
+        print("       [ranking.txt] lists proxies best first (e.g. output/main_top100_checked.txt); they are placed first")
         sys.exit(1)
-    (input_source, clash_tmpl, singbox_tmpl, out_clash, out_sb) = sys.argv[1:]
+    (input_source, clash_tmpl, singbox_tmpl, out_clash, out_sb) = sys.argv[1:6]
+    ranking_file = sys.argv[6] if len(sys.argv) == 7 else None
 
     # Determine if input is URL or local file
     if input_source.startswith(('http://', 'https://', 'ftp://')):
@@ -898,6 +917,9 @@ if __name__ == '__main__':
         print(f"[+] Read local file: {input_source}")
         lines = read_local_subscription(input_source)
     print(f"[+] {len(lines)} lines found in sub...")
+    if ranking_file:
+        lines = order_by_ranking(lines, ranking_file)
+        print(f"[+] Ordered by ranking: {ranking_file}")
 
     proxies = []
     for line in lines:
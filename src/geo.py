@@ -1,13 +1,161 @@
 from __future__ import annotations
 
 
-from typing import Dict, Iterable, Optional, Tuple
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
 import os
-import geoip2.database
+import threading
+import time
+try:
+    import geoip2.database  # type: ignore
+except Exception:  # the offline range table works without it
+    geoip2 = None
+from .constants import GEOIP_CACHE_SIZE, GEOIP_IN_MEMORY, GEOIP_MMDB_FILE
+from .ip_ranges import IpRangeTable, load_or_build as load_ip_ranges
 from .parsing import is_ip_address
 
 
 from .parsing import _extract_our_cc_and_num_from_uri
+
+_DEFAULT_MMDB = GEOIP_MMDB_FILE
+
+
+class GeoIPReader:
+    """Process-wide GeoLite2-Country reader with an IP -> country LRU.
+
+    On first use it loads the offline IpRangeTable (see ip_ranges; bisect lookups, no
+    I/O) for the default database. Other paths, or when no table can be built, get a
+    geoip2 Reader that is kept open (MODE_MMAP, or MODE_MEMORY when in_memory is set)
+    instead of being opened and closed around every lookup. Results, misses included,
+    are cached for cache_size IPs. A database that cannot be opened is not retried for
+    the rest of the process.
+    """
+
+    def __init__(self, mmdb_path: str = _DEFAULT_MMDB, in_memory: bool = bool(GEOIP_IN_MEMORY),
+                 cache_size: int = GEOIP_CACHE_SIZE) -> None:
+        self.mmdb_path = mmdb_path
+        self.in_memory = bool(in_memory)
+        self.cache_size = max(0, int(cache_size))
+        self._reader = None
+        self._table: Optional[IpRangeTable] = None
+        self._failed = False
+        self._cache: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.db_lookups = 0
+        self.db_seconds = 0.0
+
+    def _open(self):
+        if self._table is not None:
+            return self._table
+        if self._reader is not None or self._failed:
+            return self._reader
+        with self._lock:
+            if self._table is None and self._reader is None and not self._failed:
+                if os.path.abspath(self.mmdb_path) == os.path.abspath(_DEFAULT_MMDB):
+                    self._table = load_ip_ranges(self.mmdb_path)
+                if self._table is None:
+                    try:
+                        mode = geoip2.database.MODE_MEMORY if self.in_memory else geoip2.database.MODE_MMAP
+                        self._reader = geoip2.database.Reader(self.mmdb_path, mode=mode)
+                    except Exception:
+                        self._failed = True
+        return self._table if self._table is not None else self._reader
+
+    def _query(self, reader, ip: str) -> Optional[str]:
+        if reader is self._table:
+            return reader.lookup(ip)
+        try:
+            cc = reader.country(ip).country.iso_code
+        except Exception:
+            return None
+        if isinstance(cc, str) and len(cc) == 2:
+            return cc.upper()
+        return None
+
+    def _remember(self, ip: str, cc: Optional[str]) -> None:
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[ip] = cc
+            self._cache.move_to_end(ip)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def lookup(self, ip: str) -> Optional[str]:
+        return self.lookup_many([ip]).get(ip)
+
+    def lookup_many(self, ips: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Country code (or None) for every IP; hostnames and unknown IPs map to None."""
+        result: Dict[str, Optional[str]] = {}
+        misses: List[str] = []
+        with self._lock:
+            for ip in ips:
+                if ip in result:
+                    continue
+                self.lookups += 1
+                if ip in self._cache:
+                    self._cache.move_to_end(ip)
+                    result[ip] = self._cache[ip]
+                    self.hits += 1
+                else:
+                    result[ip] = None
+                    if is_ip_address(ip):
+                        misses.append(ip)
+        if not misses:
+            return result
+        reader = self._open()
+        if reader is None:
+            return result
+        t0 = time.perf_counter()
+        for ip in misses:
+            cc = self._query(reader, ip)
+            result[ip] = cc
+            self._remember(ip, cc)
+        with self._lock:
+            self.db_lookups += len(misses)
+            self.db_seconds += time.perf_counter() - t0
+        return result
+
+    def available(self) -> bool:
+        """True when the range table or a GeoLite2 database could be loaded."""
+        return self._open() is not None
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {'available': self._table is not None or self._reader is not None,
+                    'engine': 'ranges' if self._table is not None else ('mmdb' if self._reader is not None else 'none'),
+                    'lookups': self.lookups, 'hits': self.hits,
+                    'db_lookups': self.db_lookups, 'db_ms': round(self.db_seconds * 1000.0, 1),
+                    'entries': len(self._cache)}
+
+    def close(self) -> None:
+        with self._lock:
+            reader, self._reader = self._reader, None
+        if reader is not None:
+            try:
+                reader.close()
+            except Exception:
+                pass
+
+
+_readers: Dict[str, GeoIPReader] = {}
+_readers_lock = threading.Lock()
+
+
+def get_geoip_reader(mmdb_path: Optional[str] = None) -> GeoIPReader:
+    """The shared reader for mmdb_path (default: GeoLite2-Country.mmdb in the repository root)."""
+    path = os.path.abspath(mmdb_path or _DEFAULT_MMDB)
+    reader = _readers.get(path)
+    if reader is None:
+        with _readers_lock:
+            reader = _readers.get(path)
+            if reader is None:
+                reader = _readers[path] = GeoIPReader(path)
+    return reader
+
+
 def get_country_code_geoip2(ip: str, mmdb_path: str = None) -> Optional[str]:
     """
     Returns 2-letter country code for a static IP using local GeoLite2-Country.mmdb.
@@ -15,18 +163,20 @@ def get_country_code_geoip2(ip: str, mmdb_path: str = None) -> Optional[str]:
     """
     if not is_ip_address(ip):
         return None
-    if mmdb_path is None:
-        mmdb_path = os.path.join(os.path.dirname(__file__), "../GeoLite2-Country.mmdb")
-    try:
-        reader = geoip2.database.Reader(mmdb_path)
-        response = reader.country(ip)
-        cc = response.country.iso_code
-        reader.close()
-        if isinstance(cc, str) and len(cc) == 2:
-            return cc.upper()
-    except Exception:
-        return None
-    return None
+    return get_geoip_reader(mmdb_path).lookup(ip)
+
+
+def lookup_many(ips: Iterable[str], mmdb_path: Optional[str] = None) -> Dict[str, Optional[str]]:
+    """Batch form of get_country_code_geoip2: ip -> country code or None."""
+    return get_geoip_reader(mmdb_path).lookup_many(ips)
+
+
+def offline_geo_available() -> bool:
+    return get_geoip_reader().available()
+
+
+def geoip_stats() -> Dict[str, float]:
+    return get_geoip_reader().stats()
 
 
 def _country_flag(cc: Optional[str]) -> str:
@@ -0,0 +1,270 @@
+"""Batch ICMP echo without forking /bin/ping.
+
+Uses unprivileged ICMP datagram sockets (Linux, net.ipv4.ping_group_range) and falls
+back to raw sockets when the process is allowed to open them. One socket per address
+family carries the echo requests for every host; replies are matched by sequence
+number (and identifier on raw sockets) plus the source address.
+"""
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import os
+import random
+import socket
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+_PAYLOAD = b'OpenRay-icmp-probe'
+_MAX_OUTSTANDING = 60000
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return (~total) & 0xFFFF
+
+
+def _build_echo(family: int, ident: int, seq: int) -> bytes:
+    if family == socket.AF_INET6:
+        # The kernel fills in the ICMPv6 checksum (it covers the IPv6 pseudo-header)
+        return struct.pack('!BBHHH', ICMPV6_ECHO_REQUEST, 0, 0, ident, seq) + _PAYLOAD
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = _checksum(header + _PAYLOAD)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, csum, ident, seq) + _PAYLOAD
+
+
+def _parse_reply(family: int, raw: bool, data: bytes) -> Optional[Tuple[int, int]]:
+    """Return (ident, seq) for an echo reply, or None for anything else."""
+    if family == socket.AF_INET and raw:
+        if len(data) < 20:
+            return None
+        data = data[(data[0] & 0x0F) * 4:]
+    if len(data) < 8:
+        return None
+    typ, _code, _csum, ident, seq = struct.unpack('!BBHHH', data[:8])
+    if typ != (ICMPV6_ECHO_REPLY if family == socket.AF_INET6 else ICMP_ECHO_REPLY):
+        return None
+    return ident, seq
+
+
+def _open_socket(family: int) -> Optional[Tuple[socket.socket, bool]]:
+    """Open a non-blocking ICMP socket: datagram (unprivileged) first, then raw."""
+    if os.name == 'nt':
+        return None
+    proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+    for kind, raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+        try:
+            s = socket.socket(family, kind, proto)
+        except (OSError, AttributeError):
+            continue
+        s.setblocking(False)
+        return s, raw
+    return None
+
+
+def _family_of(ip: str) -> Optional[int]:
+    try:
+        return socket.AF_INET6 if ipaddress.ip_address(ip).version == 6 else socket.AF_INET
+    except ValueError:
+        return None
+
+
+def _norm(ip: str) -> str:
+    try:
+        return str(ipaddress.ip_address(ip.split('%', 1)[0]))
+    except ValueError:
+        return ip
+
+
+class AsyncIcmpPinger:
+    """Shared-socket ICMP echo for many hosts on the running event loop.
+
+    ping() returns the round-trip time in milliseconds, or None when no reply arrived in
+    time. supports() tells whether ICMP sockets could be opened for an address family at
+    all, so callers can fall back to another reachability method instead of reporting
+    every host as down.
+    """
+
+    def __init__(self) -> None:
+        self._socks: Dict[int, Optional[Tuple[socket.socket, bool, int]]] = {}
+        self._pending: Dict[Tuple[int, int], Tuple[str, float, asyncio.Future]] = {}
+        self._by_ip: Dict[str, asyncio.Future] = {}
+        self._seq = random.randint(0, 0xFFFF)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.sent = 0
+        self.received = 0
+
+    def _ensure(self, family: int) -> Optional[Tuple[socket.socket, bool, int]]:
+        if family in self._socks:
+            return self._socks[family]
+        ent = None
+        opened = _open_socket(family)
+        if opened is not None:
+            sock, raw = opened
+            try:
+                loop = asyncio.get_running_loop()
+                loop.add_reader(sock.fileno(), self._on_readable, family)
+                self._loop = loop
+                # Datagram sockets get their identifier rewritten by the kernel; raw ones keep ours
+                ident = (os.getpid() ^ random.randint(0, 0xFFFF)) & 0xFFFF
+                ent = (sock, raw, ident)
+            except (NotImplementedError, RuntimeError, OSError):
+                sock.close()
+                ent = None
+        self._socks[family] = ent
+        return ent
+
+    def supports(self, ip: str) -> bool:
+        family = _family_of(ip)
+        return family is not None and self._ensure(family) is not None
+
+    def _next_seq(self, family: int) -> Optional[int]:
+        for _ in range(0x10000):
+            self._seq = (self._seq + 1) & 0xFFFF
+            if (family, self._seq) not in self._pending:
+                return self._seq
+        return None
+
+    def _on_readable(self, family: int) -> None:
+        ent = self._socks.get(family)
+        if not ent:
+            return
+        sock, raw, ident = ent
+        while True:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            now = time.perf_counter()
+            parsed = _parse_reply(family, raw, data)
+            if parsed is None:
+                continue
+            r_ident, seq = parsed
+            if raw and r_ident != ident:
+                continue
+            pend = self._pending.get((family, seq))
+            if pend is None:
+                continue
+            ip, t0, fut = pend
+            if _norm(addr[0]) != ip:
+                continue
+            del self._pending[(family, seq)]
+            self.received += 1
+            if not fut.done():
+                fut.set_result((now - t0) * 1000.0)
+
+    async def _send_one(self, ip: str, timeout_ms: int) -> Optional[float]:
+        family = _family_of(ip)
+        ent = self._ensure(family) if family is not None else None
+        if ent is None:
+            return None
+        sock, _raw, ident = ent
+        deadline = time.perf_counter() + timeout_ms / 1000.0
+        while len(self._pending) >= _MAX_OUTSTANDING:
+            if time.perf_counter() >= deadline:
+                return None
+            await asyncio.sleep(0.005)
+        seq = self._next_seq(family)
+        if seq is None:
+            return None
+        fut = asyncio.get_running_loop().create_future()
+        dest = (ip, 0, 0, 0) if family == socket.AF_INET6 else (ip, 0)
+        packet = _build_echo(family, ident, seq)
+        while True:
+            try:
+                self._pending[(family, seq)] = (ip, time.perf_counter(), fut)
+                sock.sendto(packet, dest)
+                self.sent += 1
+                break
+            except (BlockingIOError, InterruptedError):
+                # Socket buffer full: let replies drain, then retry until the deadline
+                self._pending.pop((family, seq), None)
+                if time.perf_counter() >= deadline:
+                    return None
+                await asyncio.sleep(0.002)
+            except OSError:
+                self._pending.pop((family, seq), None)
+                return None
+        try:
+            remaining = max(0.0, deadline - time.perf_counter())
+            return await asyncio.wait_for(fut, timeout=remaining)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._pending.pop((family, seq), None)
+
+    async def ping(self, ip: str, timeout_ms: int) -> Optional[float]:
+        """Echo one address; concurrent pings of the same address share one request."""
+        ip = _norm(ip)
+        fut = self._by_ip.get(ip)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        task = asyncio.ensure_future(self._send_one(ip, int(timeout_ms)))
+        self._by_ip[ip] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done():
+                self._by_ip.pop(ip, None)
+
+    async def ping_many(self, ips: Iterable[str], timeout_ms: int) -> Dict[str, float]:
+        """Echo many addresses at once. Returns {ip: rtt_ms} for hosts that replied."""
+        uniq = list(dict.fromkeys(_norm(ip) for ip in ips if ip))
+        rtts = await asyncio.gather(*(self.ping(ip, timeout_ms) for ip in uniq))
+        return {ip: rtt for ip, rtt in zip(uniq, rtts) if rtt is not None}
+
+    def close(self) -> None:
+        for ent in self._socks.values():
+            if not ent:
+                continue
+            sock = ent[0]
+            try:
+                if self._loop is not None and not self._loop.is_closed():
+                    self._loop.remove_reader(sock.fileno())
+            except Exception:
+                pass
+            try:
+                sock.close()
+            except Exception:
+                pass
+        self._socks.clear()
+        for _ip, _t0, fut in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
+
+
+def icmp_supported(family: int = socket.AF_INET) -> bool:
+    """Whether this process can open ICMP sockets (datagram or raw) for the family."""
+    opened = _open_socket(family)
+    if opened is None:
+        return False
+    opened[0].close()
+    return True
+
+
+def ping_many(ips: List[str], timeout_ms: int) -> Dict[str, float]:
+    """Blocking batch ping. Returns {ip: rtt_ms} for addresses that replied."""
+    if not ips:
+        return {}
+
+    async def _run() -> Dict[str, float]:
+        pinger = AsyncIcmpPinger()
+        try:
+            return await pinger.ping_many(ips, timeout_ms)
+        finally:
+            pinger.close()
+
+    return asyncio.run(_run())
@@ -1,16 +1,20 @@
 from __future__ import annotations
 
-import json
 import os
 import hashlib
 import struct
 import time
-from typing import Iterable, List, Set, Dict
+from typing import Iterable, List, Optional, Set, Dict, Union
 
 # Dynamic constants handling for runtime overrides
 import os
 import sys
 
+try:
+    import numpy as _np  # optional: vectorized bulk path for the .bin tested stores
+except Exception:
+    _np = None
+
 # Get repository root
 REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -19,7 +23,7 @@ DEFAULT_STATE_DIR = os.path.join(REPO_ROOT, '.state')
 DEFAULT_OUTPUT_DIR = os.path.join(REPO_ROOT, 'output')
 DEFAULT_TESTED_FILE = os.path.join(DEFAULT_STATE_DIR, 'tested.txt')
 DEFAULT_AVAILABLE_FILE = os.path.join(DEFAULT_OUTPUT_DIR, 'all_valid_proxies.txt')
-DEFAULT_STREAKS_FILE = os.path.join(DEFAULT_STATE_DIR, 'streaks.json')
+DEFAULT_STREAKS_FILE = os.path.join(DEFAULT_STATE_DIR, 'streaks.bin')
 
 def get_state_dir():
     """Get current STATE_DIR, checking for runtime overrides"""
@@ -75,6 +79,30 @@ def get_tested_file():
     except (ImportError, AttributeError):
         return DEFAULT_TESTED_FILE
 
+def get_tested_index_file():
+    """Sorted digest index over the tested .bin logs, kept in the current STATE_DIR"""
+    return os.path.join(get_state_dir(), 'tested.idx')
+
+def get_tested_index_merge_min() -> int:
+    """Get current TESTED_INDEX_MERGE_MIN, checking for runtime overrides"""
+    try:
+        if 'constants' in sys.modules:
+            return int(sys.modules['constants'].TESTED_INDEX_MERGE_MIN)
+        from . import constants as C
+        return int(C.TESTED_INDEX_MERGE_MIN)
+    except (ImportError, AttributeError, ValueError):
+        return 50000
+
+def get_tested_bloom_bits() -> int:
+    """Get current TESTED_BLOOM_BITS, checking for runtime overrides"""
+    try:
+        if 'constants' in sys.modules:
+            return int(sys.modules['constants'].TESTED_BLOOM_BITS)
+        from . import constants as C
+        return int(C.TESTED_BLOOM_BITS)
+    except (ImportError, AttributeError, ValueError):
+        return 10
+
 # For backward compatibility, set some globals
 try:
     STATE_DIR = get_state_dir()
@@ -144,41 +172,34 @@ def load_existing_available() -> Set[str]:
 
 
 def load_streaks() -> Dict[str, Dict[str, int]]:
+    """All streaks as {host: {streak, last_test, last_success}} (prefer StreakStore, which loads lazily)."""
     try:
-        if not os.path.exists(get_streaks_file()):
-            return {}
-        with open(get_streaks_file(), 'r', encoding='utf-8', errors='ignore') as f:
-            data = json.load(f)
-            if isinstance(data, dict):
-                # Ensure numeric fields are ints
-                cleaned: Dict[str, Dict[str, int]] = {}
-                for host, obj in data.items():
-                    if not isinstance(obj, dict):
-                        continue
-                    streak = int(obj.get('streak', 0))
-                    last_test = int(obj.get('last_test', 0))
-                    last_success = int(obj.get('last_success', 0))
-                    cleaned[host] = {'streak': streak, 'last_test': last_test, 'last_success': last_success}
-                return cleaned
+        from .streaks import StreakStore, streaks_to_dict
+        store = StreakStore()
+        store.load()
+        return streaks_to_dict(store)
     except Exception:
-        pass
-    return {}
+        return {}
 
 
 def save_streaks(streaks: Dict[str, Dict[str, int]]) -> None:
+    """Persist the entries of streaks that changed."""
     try:
-        os.makedirs(get_state_dir(), exist_ok=True)
-        streaks_file = get_streaks_file()
-        tmp = streaks_file + '.tmp'
-        with open(tmp, 'w', encoding='utf-8', errors='ignore') as f:
-            json.dump(streaks, f, ensure_ascii=False)
-        os.replace(tmp, streaks_file)
+        from .streaks import StreakStore, update_from_dict
+        store = StreakStore()
+        store.load()
+        update_from_dict(store, streaks)
+        store.save()
     except Exception:
         # best-effort; ignore
         pass
 
 
 # Optimized tested hashes storage using binary format
+TESTED_RECORD = struct.Struct('>Q20s')  # timestamp (8 bytes) + SHA1 digest (20 bytes)
+_TESTED_DTYPE = _np.dtype([('ts', '>u8'), ('h', 'V20')]) if _np is not None else None
+
+
 def get_tested_bin_file():
     return get_tested_file() + '.bin'
 
@@ -190,13 +211,88 @@ def bytes_to_hash(hash_bytes: bytes) -> str:
     """Convert 20 bytes back to hex hash string."""
     return hash_bytes.hex()
 
-def load_tested_hashes_optimized() -> Set[str]:
-    """Load tested hashes from all tested files (multi-file support)."""
+_tested_index = None
+
+
+def open_tested_index(refresh: bool = False):
+    """Shared TestedIndex over all tested files; reopened when the file set changes."""
+    global _tested_index
+    from .tested_index import TestedIndex  # local import keeps io_ops importable standalone
+
+    path = get_tested_index_file()
+    files = get_all_tested_files()
+    idx = _tested_index
+    if idx is not None and not refresh and idx.path == path and idx.tested_files == files:
+        return idx
+    if idx is not None:
+        idx.close()
+    _tested_index = TestedIndex(path, files, bloom_bits_per_entry=get_tested_bloom_bits())
+    return _tested_index
+
+
+def _drop_tested_index() -> None:
+    global _tested_index
+    if _tested_index is not None:
+        _tested_index.close()
+        _tested_index = None
+
+
+def load_tested_hashes_optimized():
+    """Open the tested-hash store (multi-file support) for membership checks.
+
+    Returns a TestedIndex: supports `h in tested` and len(), backed by a Bloom filter,
+    a sorted memory-mapped digest index and the unmerged tails of the .bin logs, so the
+    full history is never materialized as a Python set.
+    """
     # Check for rotation before loading
     if should_rotate_tested_file():
         print(f"File rotation needed before loading. Current file size: {os.path.getsize(get_current_tested_file()) / (1024 * 1024):.1f}MB")
         rotate_tested_file()
 
+    _migrate_single_text_file()
+    index = open_tested_index(refresh=True)
+    index.maybe_merge(get_tested_index_merge_min())
+    return index
+
+
+def tested_store_mark() -> Dict[str, List]:
+    """Fingerprint of the append-only tested store: size and first record of every file.
+
+    Hashes recorded before the mark stay in the store for as long as tested_store_covers()
+    holds, i.e. until a file is rewritten (cleanup, reset) or removed.
+    """
+    mark: Dict[str, List] = {}
+    for base in get_all_tested_files():
+        for path in (base + '.bin', base):
+            try:
+                with open(path, 'rb') as f:
+                    head = f.read(TESTED_RECORD.size)
+                mark[os.path.relpath(path, REPO_ROOT)] = [os.path.getsize(path), head.hex()]
+            except OSError:
+                continue
+    return mark
+
+
+def tested_store_covers(mark: Optional[Dict[str, List]]) -> bool:
+    """True while every file of an earlier tested_store_mark() still starts with the same bytes and has not shrunk."""
+    if not mark:
+        return False
+    try:
+        for rel, (size, head) in mark.items():
+            path = os.path.join(REPO_ROOT, rel)
+            expected = bytes.fromhex(head)
+            if os.path.getsize(path) < int(size):
+                return False
+            with open(path, 'rb') as f:
+                if f.read(len(expected)) != expected:
+                    return False
+    except (OSError, ValueError, TypeError):
+        return False
+    return True
+
+
+def load_tested_hashes_full() -> Set[str]:
+    """Load every tested hash into a set of hex strings (maintenance scripts only)."""
     tested: Set[str] = set()
 
     # Get all tested files
@@ -237,23 +333,21 @@ def load_tested_hashes_optimized() -> Set[str]:
             except Exception:
                 pass  # Skip corrupted files
 
-    # Only migrate to optimized format if we're loading from a single file
-    # and the binary file doesn't already exist or is smaller than expected
+    return tested
+
+
+def _migrate_single_text_file() -> None:
+    """Convert a lone legacy tested.txt into the binary format on first load."""
+    tested_files = get_all_tested_files()
     tested_bin_file = get_tested_bin_file()
-    should_migrate = (
-        tested and
-        len(get_all_tested_files()) == 1 and  # Only migrate if loading from single file
-        (not os.path.exists(tested_bin_file) or
-         os.path.getsize(tested_bin_file) < len(tested) * 28 * 0.9)  # Allow 10% size variance
-    )
-
-    if should_migrate:
-        try:
+    if len(tested_files) != 1 or os.path.exists(tested_bin_file) or not os.path.exists(get_tested_file()):
+        return
+    try:
+        tested = {line.strip() for line in read_lines(get_tested_file()) if line.strip()}
+        if tested:
             migrate_to_optimized_format(tested)
-        except Exception:
-            pass  # Migration failure shouldn't break loading
-
-    return tested
+    except Exception:
+        pass  # Migration failure shouldn't break loading
 
 def migrate_to_optimized_format(hashes: Set[str]) -> None:
     """Migrate existing text format to optimized binary format."""
@@ -287,8 +381,11 @@ def migrate_to_optimized_format(hashes: Set[str]) -> None:
             print(f"Migration failed: {e}")
             pass  # Migration failure is non-critical
 
-def append_tested_hashes_optimized(new_hashes: Iterable[str]) -> None:
-    """Append new hashes to current active tested file with rotation support."""
+def append_tested_hashes_optimized(new_hashes: Iterable[Union[str, bytes]]) -> None:
+    """Append new hashes to current active tested file with rotation support.
+
+    Accepts hex strings or raw 20-byte digests (ProxyRecord.conn_key).
+    """
     if not new_hashes:
         return
 
@@ -302,22 +399,31 @@ def append_tested_hashes_optimized(new_hashes: Iterable[str]) -> None:
     current_file = get_current_tested_file()
     bin_file = current_file + '.bin'
 
-    # Load existing hashes to check for duplicates (from all files)
-    existing_hashes = load_tested_hashes_optimized()
+    # Check duplicates against the shared index (from all files) instead of reloading the store
+    index = open_tested_index()
     current_time = int(time.time())
     new_entries = []
+    new_digests: List[bytes] = []
+    batch_seen: Set[bytes] = set()
 
     for hash_str in new_hashes:
-        hash_str = hash_str.strip()
-        if not hash_str or hash_str in existing_hashes:
+        if isinstance(hash_str, bytes):
+            if len(hash_str) != 20:
+                continue
+            hash_bytes = hash_str
+        else:
+            hash_str = hash_str.strip()
+            if not hash_str:
+                continue
+            try:
+                hash_bytes = hash_to_bytes(hash_str)
+            except Exception:
+                continue  # Skip invalid hashes
+        if hash_bytes in batch_seen or index.contains_digest(hash_bytes):
             continue
-
-        try:
-            hash_bytes = hash_to_bytes(hash_str)
-            new_entries.append(struct.pack('>Q20s', current_time, hash_bytes))
-            existing_hashes.add(hash_str)
-        except Exception:
-            continue  # Skip invalid hashes
+        batch_seen.add(hash_bytes)
+        new_entries.append(struct.pack('>Q20s', current_time, hash_bytes))
+        new_digests.append(hash_bytes)
 
     if new_entries:
         try:
@@ -334,8 +440,7 @@ def append_tested_hashes_optimized(new_hashes: Iterable[str]) -> None:
                     bin_file = new_file + '.bin'
 
             with open(bin_file, 'ab') as f:
-                for entry in new_entries:
-                    f.write(entry)
+                f.write(b''.join(new_entries))
         except Exception:
             # Fallback to text format
             try:
@@ -350,46 +455,141 @@ def append_tested_hashes_optimized(new_hashes: Iterable[str]) -> None:
                         new_file = rotate_tested_file()
                         current_file = new_file
 
-                append_lines(current_file, (h for h in new_hashes if h.strip()))
+                append_lines(current_file, (bytes_to_hash(d) for d in new_digests))
             except Exception as e:
                 print(f"Failed to append hashes: {e}")
 
+        # The index picks up files created by rotation on its next open; fold the tail in when it grows
+        try:
+            index.add_digests(new_digests)
+            index.maybe_merge(get_tested_index_merge_min())
+        except Exception as e:
+            print(f"Tested index merge failed: {e}")
+
+def read_tested_records(bin_file: str):
+    """Read a whole .bin store at once, cut to complete 28-byte records.
+
+    Returns a numpy structured array with fields ts (>u8) and h (20-byte digest) when
+    numpy is installed, otherwise a memoryview to walk with TESTED_RECORD.iter_unpack.
+    """
+    n = os.path.getsize(bin_file) // TESTED_RECORD.size
+    if _np is not None:
+        return _np.fromfile(bin_file, dtype=_TESTED_DTYPE, count=n)
+    with open(bin_file, 'rb') as f:
+        return memoryview(f.read(n * TESTED_RECORD.size))
+
+
+def _write_records_atomic(bin_file: str, data: bytes) -> None:
+    with open(bin_file + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(bin_file + '.tmp', bin_file)
+    # The rewritten log no longer matches the index offsets; next open rebuilds it
+    _drop_tested_index()
+
+
 def cleanup_old_hashes(days_to_keep: int = 30) -> int:
     """Remove hashes older than specified days. Returns number of removed entries."""
-    if not os.path.exists(get_tested_bin_file()):
+    tested_bin_file = get_tested_bin_file()
+    if not os.path.exists(tested_bin_file):
         return 0
 
     cutoff_time = int(time.time()) - (days_to_keep * 24 * 60 * 60)
-    kept_entries = []
     removed_count = 0
 
     try:
-        tested_bin_file = get_tested_bin_file()
-        with open(tested_bin_file, 'rb') as f:
-            while True:
-                entry = f.read(28)
-                if not entry:
-                    break
-                if len(entry) != 28:
-                    continue
-                timestamp, hash_bytes = struct.unpack('>Q20s', entry)
+        recs = read_tested_records(tested_bin_file)
+        if _np is not None:
+            keep = recs['ts'] >= cutoff_time
+            removed_count = int(len(recs) - int(keep.sum()))
+            if removed_count > 0:
+                _write_records_atomic(tested_bin_file, recs[keep].tobytes())
+        else:
+            size = TESTED_RECORD.size
+            kept_entries = []
+            for i, (timestamp, _hash_bytes) in enumerate(TESTED_RECORD.iter_unpack(recs)):
                 if timestamp >= cutoff_time:
-                    kept_entries.append(entry)
+                    kept_entries.append(recs[i * size:(i + 1) * size])
                 else:
                     removed_count += 1
-
-        if removed_count > 0:
-            # Rewrite file with only kept entries
-            with open(tested_bin_file + '.tmp', 'wb') as f:
-                for entry in kept_entries:
-                    f.write(entry)
-            os.replace(tested_bin_file + '.tmp', tested_bin_file)
-
+            if removed_count > 0:
+                _write_records_atomic(tested_bin_file, b''.join(kept_entries))
     except Exception:
         pass  # Cleanup failure is non-critical
 
     return removed_count
 
+
+def dedup_tested_records(bin_file: str = None) -> int:
+    """Drop repeated digests from a .bin store, keeping each first occurrence. Returns removed count."""
+    bin_file = bin_file or get_tested_bin_file()
+    if not os.path.exists(bin_file):
+        return 0
+    removed_count = 0
+    try:
+        recs = read_tested_records(bin_file)
+        if _np is not None:
+            _u, first = _np.unique(recs['h'], return_index=True)
+            first.sort()
+            removed_count = int(len(recs) - len(first))
+            if removed_count > 0:
+                _write_records_atomic(bin_file, recs[first].tobytes())
+        else:
+            size = TESTED_RECORD.size
+            seen: Set[bytes] = set()
+            kept_entries = []
+            for i, (_ts, hash_bytes) in enumerate(TESTED_RECORD.iter_unpack(recs)):
+                if hash_bytes in seen:
+                    removed_count += 1
+                    continue
+                seen.add(hash_bytes)
+                kept_entries.append(recs[i * size:(i + 1) * size])
+            if removed_count > 0:
+                _write_records_atomic(bin_file, b''.join(kept_entries))
+    except Exception:
+        pass  # Dedup failure is non-critical
+    return removed_count
+
+
+def scan_tested_store(use_numpy: bool = None) -> Dict[str, int]:
+    """Entry/unique counts and timestamp range over every tested .bin file.
+
+    Vectorized with numpy when available (use_numpy=False forces the pure-Python path).
+    """
+    use_np = _np is not None if use_numpy is None else (bool(use_numpy) and _np is not None)
+    stats = {'files': 0, 'entries': 0, 'unique': 0, 'oldest': 0, 'newest': 0}
+    bins = [f + '.bin' for f in get_all_tested_files() if os.path.exists(f + '.bin')]
+    if use_np:
+        digests = []
+        for b in bins:
+            recs = read_tested_records(b)
+            stats['files'] += 1
+            stats['entries'] += len(recs)
+            if len(recs):
+                lo, hi = int(recs['ts'].min()), int(recs['ts'].max())
+                stats['oldest'] = lo if not stats['oldest'] else min(stats['oldest'], lo)
+                stats['newest'] = max(stats['newest'], hi)
+                digests.append(recs['h'])
+        if digests:
+            stats['unique'] = int(len(_np.unique(_np.concatenate(digests))))
+        return stats
+
+    seen: Set[bytes] = set()
+    for b in bins:
+        with open(b, 'rb') as f:
+            data = f.read()
+        mv = memoryview(data)[:len(data) - len(data) % TESTED_RECORD.size]
+        stats['files'] += 1
+        for ts, hash_bytes in TESTED_RECORD.iter_unpack(mv):
+            stats['entries'] += 1
+            seen.add(hash_bytes)
+            if not stats['oldest'] or ts < stats['oldest']:
+                stats['oldest'] = ts
+            if ts > stats['newest']:
+                stats['newest'] = ts
+    stats['unique'] = len(seen)
+    return stats
+
+
 def get_storage_stats() -> Dict[str, int]:
     """Get statistics about current storage usage."""
     stats = {
@@ -397,7 +597,10 @@ def get_storage_stats() -> Dict[str, int]:
         'binary_file_size': 0,
         'text_entries': 0,
         'binary_entries': 0,
-        'unique_hashes': 0
+        'unique_hashes': 0,
+        'binary_unique': 0,
+        'oldest_timestamp': 0,
+        'newest_timestamp': 0,
     }
 
     # Text file stats
@@ -418,6 +621,15 @@ def get_storage_stats() -> Dict[str, int]:
         stats['binary_file_size'] = os.path.getsize(tested_bin_file)
         stats['binary_entries'] = stats['binary_file_size'] // 28  # 28 bytes per entry
 
+    # Unique digests and age range across all tested .bin files (bulk scan)
+    try:
+        scan = scan_tested_store()
+        stats['binary_unique'] = scan['unique']
+        stats['oldest_timestamp'] = scan['oldest']
+        stats['newest_timestamp'] = scan['newest']
+    except Exception:
+        pass
+
     return stats
 
 
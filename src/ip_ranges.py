@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import csv
+import ipaddress
+import os
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .constants import GEO_CSV_FILE, GEO_RANGES_FILE, GEOIP_MMDB_FILE
+
+_MAGIC = b'ORGEO1\x00\x00'
+_HEADER = struct.Struct('<8sQQI')
+_V4_MAX = (1 << 32) - 1
+
+
+def _cc(value) -> Optional[str]:
+    if isinstance(value, str) and len(value) == 2 and value.isalpha():
+        return value.upper()
+    return None
+
+
+def _parse_ip(value: str) -> Optional[Tuple[int, int]]:
+    """(version, integer) of an address given as text or as a decimal integer (IP2Location CSV)."""
+    value = value.strip().strip('"')
+    if value.isdigit():
+        n = int(value)
+        return (4, n) if n <= _V4_MAX else (6, n)
+    try:
+        ip = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    return ip.version, int(ip)
+
+
+def _merge(ranges: List[Tuple[int, int, str]]) -> List[Tuple[int, int, str]]:
+    """Sort, clip overlaps (the earlier range keeps them) and join adjacent ranges of the same country."""
+    ranges.sort()
+    out: List[Tuple[int, int, str]] = []
+    for start, end, cc in ranges:
+        if out:
+            p_start, p_end, p_cc = out[-1]
+            if start <= p_end:
+                if end <= p_end:
+                    continue
+                start = p_end + 1
+            if cc == p_cc and start == p_end + 1:
+                out[-1] = (p_start, end, cc)
+                continue
+        out.append((start, end, cc))
+    return out
+
+
+class IpRangeTable:
+    """Offline IP -> country table of sorted, non-overlapping ranges.
+
+    IPv4 ranges live in two array('I') columns, IPv6 ranges in two lists of ints, and
+    the country codes in a flat 2-bytes-per-range string; lookup() is a bisect on the
+    start column, O(log n) and free of network or database I/O. The table is built
+    once from the GeoLite2 mmdb (or a CSV of network,cc / first_ip,last_ip,cc rows) and
+    cached in GEO_RANGES_FILE together with the size and mtime of its source, so it is
+    only rebuilt when the source changes.
+    """
+
+    def __init__(self, v4: List[Tuple[int, int, str]], v6: List[Tuple[int, int, str]], source: str = '') -> None:
+        self.source = source
+        self._v4_start = array('I', (r[0] for r in v4))
+        self._v4_end = array('I', (r[1] for r in v4))
+        self._v4_cc = ''.join(r[2] for r in v4)
+        self._v6_start = [r[0] for r in v6]
+        self._v6_end = [r[1] for r in v6]
+        self._v6_cc = ''.join(r[2] for r in v6)
+
+    def __len__(self) -> int:
+        return len(self._v4_start) + len(self._v6_start)
+
+    # ---- lookups ----
+    def lookup_int(self, version: int, n: int) -> Optional[str]:
+        # IPv4-mapped (::ffff:0:0/96) addresses are looked up in the IPv4 table
+        if version == 6 and (n >> 32) == 0xFFFF:
+            version, n = 4, n & _V4_MAX
+        if version == 4:
+            starts, ends, ccs = self._v4_start, self._v4_end, self._v4_cc
+        else:
+            starts, ends, ccs = self._v6_start, self._v6_end, self._v6_cc
+        i = bisect_right(starts, n) - 1
+        if i < 0 or n > ends[i]:
+            return None
+        return ccs[2 * i:2 * i + 2]
+
+    def lookup(self, ip: str) -> Optional[str]:
+        try:
+            return self.lookup_int(4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big'))
+        except (OSError, TypeError, ValueError):
+            pass
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        return self.lookup_int(addr.version, int(addr))
+
+    def lookup_many(self, ips: Iterable[str]) -> Dict[str, Optional[str]]:
+        return {ip: self.lookup(ip) for ip in ips}
+
+    # ---- building ----
+    @classmethod
+    def _from_ranges(cls, ranges: Iterable[Tuple[int, int, int, str]], source: str) -> 'IpRangeTable':
+        v4: List[Tuple[int, int, str]] = []
+        v6: List[Tuple[int, int, str]] = []
+        for version, start, end, cc in ranges:
+            if version == 6 and (start >> 32) == 0xFFFF and (end >> 32) == 0xFFFF:
+                version, start, end = 4, start & _V4_MAX, end & _V4_MAX
+            (v4 if version == 4 else v6).append((start, end, cc))
+        return cls(_merge(v4), _merge(v6), source)
+
+    @classmethod
+    def from_mmdb(cls, path: str) -> 'IpRangeTable':
+        """Walk every network of a MaxMind country database (needs maxminddb >= 2.3)."""
+        import maxminddb  # type: ignore
+
+        def _ranges():
+            with maxminddb.open_database(path) as reader:
+                for network, record in reader:
+                    cc = _cc(((record or {}).get('country') or {}).get('iso_code'))
+                    if cc:
+                        yield (network.version, int(network.network_address), int(network.broadcast_address), cc)
+        return cls._from_ranges(_ranges(), path)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'IpRangeTable':
+        """Rows of `network,cc` or `first_ip,last_ip,cc[,...]` (dotted, IPv6 or decimal addresses)."""
+        def _ranges():
+            with open(path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+                for row in csv.reader(f):
+                    if len(row) < 2 or row[0].lstrip().startswith('#'):
+                        continue
+                    if '/' in row[0]:
+                        try:
+                            net = ipaddress.ip_network(row[0].strip(), strict=False)
+                        except ValueError:
+                            continue
+                        cc = _cc(row[1].strip())
+                        if cc:
+                            yield (net.version, int(net.network_address), int(net.broadcast_address), cc)
+                        continue
+                    if len(row) < 3:
+                        continue
+                    first, last, cc = _parse_ip(row[0]), _parse_ip(row[1]), _cc(row[2].strip().strip('"'))
+                    if first and last and cc and first[0] == last[0] and first[1] <= last[1]:
+                        yield (first[0], first[1], last[1], cc)
+        return cls._from_ranges(_ranges(), path)
+
+    # ---- persistence ----
+    def save(self, path: str, signature: str) -> None:
+        v4s, v4e = array('I', self._v4_start), array('I', self._v4_end)
+        if sys.byteorder != 'little':
+            v4s.byteswap()
+            v4e.byteswap()
+        sig = signature.encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(v4s), len(self._v6_start), len(sig)))
+            f.write(sig)
+            f.write(v4s.tobytes())
+            f.write(v4e.tobytes())
+            f.write(self._v4_cc.encode('ascii'))
+            f.write(b''.join(n.to_bytes(16, 'big') for n in self._v6_start))
+            f.write(b''.join(n.to_bytes(16, 'big') for n in self._v6_end))
+            f.write(self._v6_cc.encode('ascii'))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, signature: Optional[str] = None) -> Optional['IpRangeTable']:
+        """Read a saved table; None when missing, corrupt or built from another source."""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            magic, n4, n6, slen = _HEADER.unpack_from(data, 0)
+            if magic != _MAGIC:
+                return None
+            pos = _HEADER.size
+            sig = data[pos:pos + slen].decode('utf-8', errors='ignore')
+            pos += slen
+            if signature is not None and sig != signature:
+                return None
+            table = cls([], [], sig)
+            for col in (table._v4_start, table._v4_end):
+                col.frombytes(data[pos:pos + 4 * n4])
+                if sys.byteorder != 'little':
+                    col.byteswap()
+                pos += 4 * n4
+            table._v4_cc = data[pos:pos + 2 * n4].decode('ascii')
+            pos += 2 * n4
+            for col in (table._v6_start, table._v6_end):
+                col.extend(int.from_bytes(data[i:i + 16], 'big') for i in range(pos, pos + 16 * n6, 16))
+                pos += 16 * n6
+            table._v6_cc = data[pos:pos + 2 * n6].decode('ascii')
+            if len(table._v4_cc) != 2 * n4 or len(table._v6_cc) != 2 * n6 or len(table._v4_end) != n4:
+                return None
+            return table
+        except Exception:
+            return None
+
+
+def _signature(path: str) -> Optional[str]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{os.path.basename(path)}|{st.st_size}|{int(st.st_mtime)}"
+
+
+def load_or_build(mmdb_path: str = GEOIP_MMDB_FILE, csv_path: str = GEO_CSV_FILE,
+                  cache_path: str = GEO_RANGES_FILE) -> Optional[IpRangeTable]:
+    """The offline table from the cache, rebuilt when its source changed.
+
+    The CSV (when configured) takes precedence over the mmdb. Without either source a
+    cached table is still used as is; None when there is nothing to build from.
+    """
+    source = csv_path if csv_path and os.path.exists(csv_path) else (mmdb_path if os.path.exists(mmdb_path) else '')
+    if not source:
+        return IpRangeTable.load(cache_path)
+    signature = _signature(source)
+    table = IpRangeTable.load(cache_path, signature)
+    if table is not None:
+        return table
+    try:
+        table = IpRangeTable.from_csv(source) if source == csv_path else IpRangeTable.from_mmdb(source)
+    except Exception:
+        return None
+    if not len(table):
+        return None
+    try:
+        table.save(cache_path, signature or '')
+    except Exception:
+        pass
+    return table
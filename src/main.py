@@ -1,49 +1,38 @@
 from __future__ import annotations
 
-import concurrent.futures
 import os
-import time
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from .common import log, progress, sha1_hex, get_proxy_connection_hash, get_v2rayn_connection_key, get_openray_dedup_key
-import json
+from .common import log, progress, dedup_key_bytes
 from .constants import (
     AVAILABLE_FILE,
-    CONSECUTIVE_REQUIRED,
-    FETCH_WORKERS,
-    FETCH_TIMEOUT,
-    PING_WORKERS,
     SOURCES_FILE,
-    ENABLE_STAGE2,
     ENABLE_STAGE3,
-    STAGE3_MAX,
     OUTPUT_DIR,
-    STATE_DIR,
-    STAGE3_WORKERS,
     NEW_URIS_LIMIT_ENABLED,
     NEW_URIS_LIMIT,
+    SOURCE_CACHE_ENABLED,
 )
-from .geo import _build_country_counters, _country_flag
+from .geo import _build_country_counters, _country_flag, geoip_stats
 from .grouping import regroup_available_by_country, write_grouped_outputs
 from .io_ops import (
     append_lines,
     ensure_dirs,
     load_existing_available,
-    load_streaks,
-    load_tested_hashes,
     load_tested_hashes_optimized,
     append_tested_hashes_optimized,
     read_lines,
-    save_streaks,
-    write_text_file_atomic,
 )
-from .net import _get_country_code_for_host, ping_host, connect_host_port, quick_protocol_probe, validate_with_v2ray_core, fetch_urls_async_batch, get_country_codes_batch, check_one_sync, is_dynamic_host, check_pair
+from .net import _get_country_code_for_host, ping_host, connect_host_port, validate_many_with_v2ray_core, get_country_codes_batch, is_dynamic_host, run_stage2_checks, CheckResult, VerdictCache, dns_cache_stats, fetch_stats, fetch_origin_stats, geo_http_stats
+from .check_counts import get_check_counts
+from .pipeline import run_pipeline
+from .ranking import RANKINGS, rank_proxies, write_fastest_outputs, write_if_changed
+from .scoring import get_scores, percentile
+from .source_state import SourceState
+from .streaks import StreakStore
+from .xray_pool import XrayPool
 from .parsing import (
-    _set_remark,
-    extract_host,
-    extract_port,
-    extract_uris,
-    maybe_decode_subscription,
+    ProxyRecord,
     parse_source_line,
 )
 
@@ -69,237 +58,80 @@ def _has_connectivity() -> bool:
 
 
 # Check counts functionality for main.py
-CHECK_COUNTS_FILE = os.path.join(STATE_DIR, 'check_counts.json')
 TOP100_FILE = os.path.join(os.path.dirname(AVAILABLE_FILE), 'main_top100_checked.txt')
 
 
-def _load_check_counts() -> Dict[str, Dict[str, int]]:
-    """Load check counts with dual counter system: {proxy: {"main": count, "iran": count}}"""
-    try:
-        if os.path.exists(CHECK_COUNTS_FILE):
-            with open(CHECK_COUNTS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    # Convert old format to new format if needed
-                    result = {}
-                    for proxy, value in data.items():
-                        if isinstance(value, dict) and "main" in value and "iran" in value:
-                            # New format
-                            result[str(proxy)] = {
-                                "main": int(value.get("main", 0)),
-                                "iran": int(value.get("iran", 0))
-                            }
-                        else:
-                            # Old format - convert to new format
-                            result[str(proxy)] = {
-                                "main": int(value) if isinstance(value, (int, str)) else 0,
-                                "iran": 0
-                            }
-                    return result
-    except Exception as e:
-        log(f"Failed to load check counts: {e}")
-    return {}
-
-
-def _save_check_counts(counts: Dict[str, Dict[str, int]]) -> None:
-    try:
-        ensure_dirs()
-        os.makedirs(os.path.dirname(CHECK_COUNTS_FILE), exist_ok=True)
-        tmp = CHECK_COUNTS_FILE + '.tmp'
-        with open(tmp, 'w', encoding='utf-8', errors='ignore') as f:
-            json.dump(counts, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, CHECK_COUNTS_FILE)
-    except Exception as e:
-        log(f"Failed to save check counts: {e}")
-
-
 def _update_check_counts_for_proxies(proxies: List[str], counter_type: str = "main") -> None:
-    """Update check counts for successfully validated proxies."""
+    """Update check counts for successfully validated proxies (one per dedup key)."""
     if not proxies:
         return
-    counts = _load_check_counts()
-
-    # Deduplicate proxies using custom OpenRay dedup key
-    seen_keys: set = set()
-    unique_proxies: List[str] = []
-    
-    for p in proxies:
-        if not p:
-            continue
-        
-        # Deduplicate using custom OpenRay dedup key
-        conn_key = get_openray_dedup_key(p)
-        if conn_key not in seen_keys:
-            seen_keys.add(conn_key)
-            unique_proxies.append(p)
-
-    # Update counts for all unique successfully validated proxies
-    updated_count = 0
-    for p in unique_proxies:
-        if p not in counts:
-            counts[p] = {"main": 0, "iran": 0}
-        
-        old_count = counts[p].get(counter_type, 0)
-        counts[p][counter_type] = old_count + 1
-        updated_count += 1
-    
+    updated_count = get_check_counts().increment(proxies, counter_type)
     if updated_count > 0:
-        _save_check_counts(counts)
         log(f"📈 Updated {counter_type} check counts for {updated_count} successfully validated proxies")
 
 
 def _sync_check_counts_with_available_file() -> None:
-    """Sync check_counts.json with all_valid_proxies.txt: remove entries for proxies no longer in file, add entries for new proxies."""
+    """Sync check counts with all_valid_proxies.txt: remove entries for proxies no longer in file, add entries for new proxies."""
     try:
         if not os.path.exists(AVAILABLE_FILE):
             return
-        
-        # Read all proxies from all_valid_proxies.txt
-        current_proxies = set()
-        for line in read_lines(AVAILABLE_FILE):
-            proxy = line.strip()
-            if proxy:
-                current_proxies.add(proxy)
-        
+        current_proxies = [line.strip() for line in read_lines(AVAILABLE_FILE) if line.strip()]
         if not current_proxies:
             return
-        
-        # Load current check counts
-        counts = _load_check_counts()
-        
-        # Track changes
-        removed_count = 0
-        added_count = 0
-        
-        # Remove entries for proxies no longer in the file
-        proxies_to_remove = []
-        for proxy in counts.keys():
-            if proxy not in current_proxies:
-                proxies_to_remove.append(proxy)
-                removed_count += 1
-        
-        for proxy in proxies_to_remove:
-            del counts[proxy]
-        
-        # Add entries for new proxies (with 0 counts)
-        for proxy in current_proxies:
-            if proxy not in counts:
-                counts[proxy] = {"main": 0, "iran": 0}
-                added_count += 1
-        
-        # Save if there were changes
-        if removed_count > 0 or added_count > 0:
-            _save_check_counts(counts)
-            if removed_count > 0:
-                log(f"🧹 Removed {removed_count} stale proxy entries from check_counts.json")
-            if added_count > 0:
-                log(f"➕ Added {added_count} new proxy entries to check_counts.json")
+        removed_count, added_count = get_check_counts().sync(current_proxies)
+        if removed_count > 0:
+            log(f"🧹 Removed {removed_count} stale proxy entries from check counts")
+        if added_count > 0:
+            log(f"➕ Added {added_count} new proxy entries to check counts")
     except Exception as e:
-        log(f"⚠️ Failed to sync check_counts.json with all_valid_proxies.txt: {e}")
+        log(f"⚠️ Failed to sync check counts with all_valid_proxies.txt: {e}")
 
 
-def _write_top100_by_checks(active_proxies: List[str]) -> None:
-    """Write top 100 most frequently checked proxies to main_top100_checked.txt.
-    Prioritizes main scores, then iran scores as tiebreaker."""
+def _log_top5(title: str, ranked: List[Tuple[str, Dict[str, int], float]], order: Tuple[str, str]) -> None:
+    if not ranked:
+        return
+    log(f"🥇 Top 5 most reliable {title}:")
+    for i, (proxy, proxy_counts, score) in enumerate(ranked[:5], 1):
+        labels = ', '.join(f"{c.capitalize()}:{proxy_counts.get(c, 0)}" for c in order)
+        log(f"  {i}. [Score:{score:.3f}, {labels}] {proxy[:60]}...")
+
+
+def _log_latency_summary(measured: Dict[str, CheckResult]) -> None:
+    """Median and p90 of each latency this run measured."""
+    parts = []
+    for name in ('icmp', 'tcp', 'tls', 'http'):
+        samples = [getattr(r, name + '_ms') for r in measured.values() if getattr(r, name + '_ms') is not None]
+        if samples:
+            parts.append(f"{name.upper()} p50={percentile(samples, 50):.0f}ms p90={percentile(samples, 90):.0f}ms (n={len(samples)})")
+    if parts:
+        log("⏱️ Latency: " + '; '.join(parts))
+
+
+def _write_top100_rankings(active_proxies: List[str]) -> None:
+    """Write main_top100_checked.txt (by main score) and output_iran/iran_top100_checked.txt
+    (by iran score) from one ranking pass; raw counts break ties. A file is only
+    rewritten when its list changed."""
     try:
-        counts = _load_check_counts()
-        
         if not active_proxies:
             log("⚠️ No active proxies to rank")
             return
-            
-        # Score each active proxy by main count first, then iran count as tiebreaker
-        scored = []
-        for idx, p in enumerate(active_proxies):
-            proxy_counts = counts.get(p, {"main": 0, "iran": 0})
-            main_count = proxy_counts.get("main", 0)
-            iran_count = proxy_counts.get("iran", 0)
-            scored.append((main_count, iran_count, idx, p))
-        
-        # Sort by main count desc, then iran count desc, then original order asc (stable tie-break)
-        scored.sort(key=lambda t: (-t[0], -t[1], t[2]))
-        
-        # Get top 100
-        top = [p for _, _, _, p in scored[:100]]
-        
-        # Log some statistics
-        if scored:
-            max_main = scored[0][0] if scored else 0
-            max_iran = max(t[1] for t in scored) if scored else 0
-            avg_main = sum(t[0] for t in scored) / len(scored) if scored else 0
-            avg_iran = sum(t[1] for t in scored) / len(scored) if scored else 0
-            
-            log(f"📊 Main check stats: max={max_main}, avg={avg_main:.1f}")
-            log(f"📊 Iran check stats: max={max_iran}, avg={avg_iran:.1f}")
-        
-        write_text_file_atomic(TOP100_FILE, top)
-        log(f"🏆 Wrote top {len(top)} most reliable proxies to {TOP100_FILE}")
-        
-        # Show top 5 for verification
-        if top:
-            log("🥇 Top 5 most reliable proxies:")
-            for i, proxy in enumerate(top[:5], 1):
-                proxy_counts = counts.get(proxy, {"main": 0, "iran": 0})
-                main_count = proxy_counts.get("main", 0)
-                iran_count = proxy_counts.get("iran", 0)
-                log(f"  {i}. [Main:{main_count}, Iran:{iran_count}] {proxy[:60]}...")
-                
-    except Exception as e:
-        log(f"❌ Failed to write top100 checked proxies: {e}")
+        # Iran-specific output directory (same level as output directory)
+        iran_top100_file = os.path.join(os.path.dirname(OUTPUT_DIR), 'output_iran', 'iran_top100_checked.txt')
 
+        ranked = rank_proxies(active_proxies, ('main', 'iran'))
+        for counter in ('main', 'iran'):
+            max_count, avg_count = ranked.stats[counter]
+            log(f"📊 {counter.capitalize()} check stats: max={max_count}, avg={avg_count:.1f}")
 
-def _write_iran_top100_by_checks(active_proxies: List[str]) -> None:
-    """Write top 100 most frequently checked proxies for Iran.
-    Prioritizes iran scores, then main scores as tiebreaker."""
-    try:
-        # Iran-specific output directory (same level as output directory)
-        iran_output_dir = os.path.join(os.path.dirname(OUTPUT_DIR), 'output_iran')
-        iran_top100_file = os.path.join(iran_output_dir, 'iran_top100_checked.txt')
-        
-        # Ensure directory exists
-        os.makedirs(iran_output_dir, exist_ok=True)
-        
-        counts = _load_check_counts()
-        
-        if not active_proxies:
-            log("⚠️ No active proxies to rank for Iran")
-            return
-            
-        # Score each active proxy by iran count first, then main count as tiebreaker
-        scored = []
-        for idx, p in enumerate(active_proxies):
-            proxy_counts = counts.get(p, {"main": 0, "iran": 0})
-            iran_count = proxy_counts.get("iran", 0)
-            main_count = proxy_counts.get("main", 0)
-            scored.append((iran_count, main_count, idx, p))
-        
-        # Sort by iran count desc, then main count desc, then original order asc (stable tie-break)
-        scored.sort(key=lambda t: (-t[0], -t[1], t[2]))
-        
-        # Get top 100
-        top = [p for _, _, _, p in scored[:100]]
-        
-        # Log Iran-specific statistics only
-        if scored:
-            max_iran = scored[0][0] if scored else 0
-            avg_iran = sum(t[0] for t in scored) / len(scored) if scored else 0
-            
-            log(f"📊 Iran check stats: max={max_iran}, avg={avg_iran:.1f}")
-        
-        write_text_file_atomic(iran_top100_file, top)
-        log(f"🏆 Wrote top {len(top)} most reliable Iran proxies to {iran_top100_file}")
-        
-        # Show top 5 for verification
-        if top:
-            log("🥇 Top 5 most reliable Iran proxies:")
-            for i, proxy in enumerate(top[:5], 1):
-                proxy_counts = counts.get(proxy, {"main": 0, "iran": 0})
-                iran_count = proxy_counts.get("iran", 0)
-                main_count = proxy_counts.get("main", 0)
-                log(f"  {i}. [Iran:{iran_count}, Main:{main_count}] {proxy[:60]}...")
-                
+        for name, path, title in (('main', TOP100_FILE, 'proxies'), ('iran', iran_top100_file, 'Iran proxies')):
+            top = ranked.uris(name)
+            if write_if_changed(path, top):
+                log(f"🏆 Wrote top {len(top)} most reliable {title} to {path}")
+            else:
+                log(f"🏆 Top {len(top)} most reliable {title} unchanged: {path}")
+            _log_top5(title, ranked[name], RANKINGS[name])
     except Exception as e:
-        log(f"❌ Failed to write Iran top100 checked proxies: {e}")
+        log(f"❌ Failed to write top100 checked proxies: {e}")
 
 
 def main() -> int:
@@ -316,8 +148,8 @@ def main() -> int:
         log("No Internet connectivity detected; skipping network operations and leaving existing outputs unchanged.")
         return 2
 
-    # Load streaks persistence
-    streaks: Dict[str, Dict[str, int]] = load_streaks()
+    # Endpoint verdicts are shared by the existing and new proxy Stage 2 passes of this run
+    verdicts = VerdictCache()
 
     # Optionally re-validate current available proxies to drop broken ones
     host_success_run: Dict[str, bool] = {}
@@ -325,6 +157,9 @@ def main() -> int:
     do_recheck = recheck_env not in ('0', 'false', 'no')
     alive: List[str] = []
     host_map_existing: Dict[str, Optional[str]] = {}
+    # Latencies measured this run (Stage 2 breakdown per URI; Stage 3 request ms per URI)
+    measured: Dict[str, CheckResult] = {}
+    http_ms: Dict[str, float] = {}
     if do_recheck and os.path.exists(AVAILABLE_FILE):
         existing_lines = [ln.strip() for ln in read_lines(AVAILABLE_FILE) if ln.strip()]
         if existing_lines:
@@ -334,7 +169,7 @@ def main() -> int:
             seen_connection_keys = set()
             deduplicated_existing = []
             for u in existing_lines:
-                conn_key = get_openray_dedup_key(u)
+                conn_key = dedup_key_bytes(u)
                 if conn_key not in seen_connection_keys:
                     seen_connection_keys.add(conn_key)
                     deduplicated_existing.append(u)
@@ -349,64 +184,11 @@ def main() -> int:
                 if h not in host_success_run:
                     host_success_run[h] = False
 
-            def check_existing(item: Tuple[str, str]) -> Optional[str]:
-                u, h = item
-
-                def _check_proxy_operation():
-                    try:
-                        # Quick ping check with very short timeout
-                        if not ping_host(h):
-                            return None
-                        scheme = u.split('://', 1)[0].lower()
-                        if scheme in ('vmess', 'vless', 'trojan', 'ss', 'ssr'):
-                            p = extract_port(u)
-                            if p is not None:
-                                # Connect check with short timeout
-                                ok = connect_host_port(h, int(p))
-                                if not ok:
-                                    return None
-                                if int(ENABLE_STAGE2) == 1:
-                                    # Protocol probe with short timeout
-                                    return u if quick_protocol_probe(u, h, int(p)) else None
-                                return u
-                        return u
-                    except Exception as e:
-                        # Log any exceptions that occur
-                        print(f"Warning: Exception checking proxy {h}: {e}", flush=True)
-                        return None
-
-                # Use timeout wrapper with hard 10-second limit per proxy
-                import threading
-                result = [None]
-                exception = [None]
-
-                def target():
-                    try:
-                        result[0] = _check_proxy_operation()
-                    except Exception as e:
-                        exception[0] = e
-
-                thread = threading.Thread(target=target, daemon=True)
-                thread.start()
-                thread.join(10.0)  # Hard 10-second timeout per proxy
-
-                if thread.is_alive():
-                    print(f"Warning: Proxy {h} timed out after 10 seconds", flush=True)
-                    return None
-
-                if exception[0]:
-                    raise exception[0]
-
-                return result[0]
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=PING_WORKERS) as pool:
-                print("Start Stage 2 for existing proxies")
-                for res in progress(pool.map(check_existing, items), total=len(items)):
-                    if res is not None:
-                        alive.append(res)
-                        h = host_map_existing.get(res)
-                        if h:
-                            host_success_run[h] = True
+            print("Start Stage 2 for existing proxies")
+            for u, h, ok in run_stage2_checks(items, verdicts=verdicts, timings=measured):
+                if ok:
+                    alive.append(u)
+                    host_success_run[h] = True
 
             # Optional Stage 3: validate a subset of revalidated existing proxies with V2Ray core (if configured)
             if int(ENABLE_STAGE3) == 1 and alive:
@@ -419,22 +201,10 @@ def main() -> int:
                 if not core_path:
                     log("Stage 3 enabled, but V2Ray/Xray core not found or OPENRAY_V2RAY_CORE is not set; skipping core validation for existing proxies.")
                 else:
-                    subset = alive # [:int(STAGE3_MAX)]
-                    kept_subset: List[str] = []
-
-                    def _core_check(u: str) -> Optional[str]:
-                        try:
-                            res = validate_with_v2ray_core(u, timeout_s=12)
-                        except Exception:
-                            return None
-                        return u if res is True else None
-
-                    workers = int(STAGE3_WORKERS)
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool2:
-                        print("Start Stage 3 for existing proxies")
-                        for r in progress(pool2.map(_core_check, subset), total=len(subset)):
-                            if r is not None:
-                                kept_subset.append(r)
+                    subset = alive
+                    print("Start Stage 3 for existing proxies")
+                    verdicts3 = validate_many_with_v2ray_core(subset, timeout_s=12, timings=http_ms)
+                    kept_subset: List[str] = [u for u, res in zip(subset, verdicts3) if res is True]
                     # Merge: replace subset portion with validated ones
                     alive = kept_subset + alive[len(subset):]
 
@@ -457,135 +227,27 @@ def main() -> int:
     tested_hashes = load_tested_hashes_optimized()
     existing_available = load_existing_available()
 
-    # Fetch and process sources concurrently; deduplicate URIs and collect only new ones
-    seen_connection_keys: Set[str] = set()
-    new_uris: List[str] = []
-    new_hashes: List[str] = []
-    fetched_count = 0
-    total_extracted = 0  # Track total URIs extracted from all sources
-    # Parse sources and fetch asynchronously using aiohttp (fallbacks built-in)
+    # Sources stream through fetch -> decode/extract -> dedup -> Stage 2 -> Stage 3 as each one lands
     parsed_sources = []
     for line in source_lines:
         url, flags = parse_source_line(line)
         if not url:
             continue
         parsed_sources.append((url, flags))
-    urls_only = [u for (u, _) in parsed_sources]
-    content_map = {}
-    log("Start fetching sources...")
-    try:
-        import asyncio  # type: ignore
-        content_map = asyncio.run(fetch_urls_async_batch(urls_only, concurrency=int(FETCH_WORKERS), timeout=int(FETCH_TIMEOUT)))
-    except Exception as e:
-        log(f"Async fetch failed to run event loop; falling back to sequential urllib: {e}")
-        # Fallback: sequential
-        from .net import fetch_url as _fetch_url_sync  # local import to avoid circulars
-        from .common import progress as _progress
-        for u in _progress(urls_only, total=len(urls_only)):
-            content_map[u] = _fetch_url_sync(u)
-
-    for (url, flags) in parsed_sources:
-        content = content_map.get(url)
-        if content is None:
-            continue
-        fetched_count += 1
-        decoded = maybe_decode_subscription(content, hinted_base64=flags.get('base64', False))
-        for u in extract_uris(decoded):
-            total_extracted += 1  # Count all URIs extracted from all sources
-            # Use custom OpenRay dedup key for deduplication
-            conn_key = get_openray_dedup_key(u)
-            if conn_key not in seen_connection_keys:
-                seen_connection_keys.add(conn_key)
-                h = get_proxy_connection_hash(u)  # Still use original hash for tested_hashes
-                if h not in tested_hashes:
-                    new_uris.append(u)
-                    new_hashes.append(h)
-
-    log(f"Fetched {fetched_count} contents")
-    log(f"Extracted: {total_extracted} proxy URIs; Unique: {len(seen_connection_keys)} proxy URIs; New for testing: {len(new_uris)}")
 
     # Optionally limit the number of new URIs processed per run
+    new_limit = 0
     try:
         if int(NEW_URIS_LIMIT_ENABLED) == 1:
-            _limit = int(NEW_URIS_LIMIT)
-            if _limit > 0 and len(new_uris) > _limit:
-                pre = len(new_uris)
-                new_uris = new_uris[:_limit]
-                new_hashes = new_hashes[:_limit]
-                log(f"Limiting new URIs to {_limit} of {pre} due to NEW_URIS_LIMIT")
+            new_limit = max(0, int(NEW_URIS_LIMIT))
     except Exception:
         # On any misconfiguration, proceed without limiting
-        pass
-
-    # Extract hosts for new proxies
-    host_map: Dict[str, Optional[str]] = {}
-    for u in new_uris:
-        host_map[u] = extract_host(u)
-    to_test = [(u, host) for u, host in host_map.items() if host]
-    log(f"New proxies with resolvable hosts: {len(to_test)}")
-
-    # Stage 2 for new proxies: prefilter via fast batch ping, then connect/probe using asyncio or multiprocessing for large sets
-    available_to_add: List[str] = []
+        new_limit = 0
 
-    def check_one(item: Tuple[str, str]) -> Tuple[str, str, bool]:
-        uri, host = item
-
-        def _check_new_proxy_operation():
-            try:
-                # First, ensure host is reachable (ICMP/TCP fallback)
-                if not ping_host(host):
-                    return (uri, host, False)
-                # Then, for TCP-based schemes, also ensure we can connect to the specific port
-                scheme = uri.split('://', 1)[0].lower()
-                if scheme in ('vmess', 'vless', 'trojan', 'ss', 'ssr'):
-                    p = extract_port(uri)
-                    if p is not None:
-                        ok2 = connect_host_port(host, int(p))
-                        if ok2 and int(ENABLE_STAGE2) == 1:
-                            ok2 = quick_protocol_probe(uri, host, int(p))
-                        return (uri, host, ok2)
-                return (uri, host, True)
-            except Exception:
-                return (uri, host, False)
-
-        # Use timeout wrapper with hard 10-second limit per proxy
-        import threading
-        result = [None]
-        exception = [None]
-
-        def target():
-            try:
-                result[0] = _check_new_proxy_operation()
-            except Exception as e:
-                exception[0] = e
-
-        thread = threading.Thread(target=target, daemon=True)
-        thread.start()
-        thread.join(10.0)  # Hard 10-second timeout per proxy
-
-        if thread.is_alive():
-            print(f"Warning: New proxy {host} timed out after 10 seconds", flush=True)
-            return (uri, host, False)
-
-        if exception[0]:
-            return (uri, host, False)
-
-        return result[0] if result[0] else (uri, host, False)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=PING_WORKERS) as pool:
-        print("Start Stage 2 for new proxies")
-        for uri, host, ok in progress(pool.map(check_one, to_test), total=len(to_test)):
-            # Mark host as tested this run
-            if host not in host_success_run:
-                host_success_run[host] = False
-            if ok:
-                host_success_run[host] = True
-                available_to_add.append(uri)
-
-    log(f"Available proxies found this run (ping/connect ok): {len(available_to_add)}")
-
-    # Optional Stage 3: validate a subset with V2Ray core (if configured)
-    if int(ENABLE_STAGE3) == 1 and available_to_add:
+    # Optional Stage 3: validate Stage 2 survivors with V2Ray core (if configured)
+    stage3_check = None
+    xray_pool: Optional[XrayPool] = None
+    if int(ENABLE_STAGE3) == 1:
         core_path = ''
         try:
             from .constants import V2RAY_CORE_PATH  # local import to avoid circulars in some contexts
@@ -595,33 +257,58 @@ def main() -> int:
         if not core_path:
             log("Stage 3 enabled, but V2Ray/Xray core not found or OPENRAY_V2RAY_CORE is not set; skipping core validation.")
         else:
-            subset = available_to_add # [:int(STAGE3_MAX)]
-            kept_subset: List[str] = []
-
-            def _core_check(u: str) -> Optional[str]:
-                try:
-                    res = validate_with_v2ray_core(u, timeout_s=12)
-                except Exception:
-                    return None
-                return u if res is True else None
-
-            workers = int(STAGE3_WORKERS)
-            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool2:
-                print("Start Stage 3 for new proxies")
-                for r in progress(pool2.map(_core_check, subset), total=len(subset)):
-                    if r is not None:
-                        kept_subset.append(r)
-            # Merge: replace subset portion with validated ones
-            available_to_add = kept_subset + available_to_add[len(subset):]
+            xray_pool = XrayPool(core_path, timeout_s=12)
+            stage3_check = xray_pool.run_batch
+
+    # Per-source validators/digests and health: unchanged, fully tested sources are not
+    # parsed again; fetch order and backoff follow each source's track record
+    source_state: Optional[SourceState] = None
+    if int(SOURCE_CACHE_ENABLED) == 1:
+        source_state = SourceState()
+        source_state.load()
+
+    log("Start fetching and testing sources...")
+    run = run_pipeline(parsed_sources, tested_hashes, host_success_run, verdicts=verdicts,
+                       stage3=stage3_check, new_limit=new_limit, source_state=source_state)
+    new_hashes: List[bytes] = run.new_hashes
+    available_to_add: List[ProxyRecord] = run.available
+    measured.update(run.checks)
+    if xray_pool is not None:
+        http_ms.update(xray_pool.http_ms)
+
+    log(f"Fetched {run.fetched} contents")
+    fs = fetch_stats()
+    if fs['requests']:
+        log(f"Fetch: {fs['requests']} downloads from {fs['origins']} origins, {fs['bytes']/1024/1024:.1f} MB; "
+            f"{fs['opened']} connections opened, {fs['reused']} reused ({fs['tls_saved']} TLS handshakes saved)")
+        for origin, st in fetch_origin_stats(3):
+            log(f"  {origin}: {int(st['requests'])} sources, {st['bytes']/1024/1024:.1f} MB at {st['throughput']/1024:.0f} KB/s, "
+                f"{int(st['reused'])}/{int(st['opened'] + st['reused'])} connections reused")
+    if source_state is not None:
+        ss = source_state.stats()
+        log(f"Source cache: {run.skipped} sources skipped ({ss['not_modified']} not modified, {ss['unchanged']} unchanged body)")
+        if ss['deferred']:
+            log(f"Source health: {ss['deferred']} failing sources backed off this run ({ss['quarantined']} quarantined)")
+    log(f"Extracted: {run.extracted} proxy URIs; Unique: {run.unique} proxy URIs; New for testing: {len(new_hashes)}")
+    if run.limited:
+        log(f"Limiting new URIs to {new_limit}; skipped {run.limited} more due to NEW_URIS_LIMIT")
+    log(f"New proxies with resolvable hosts: {run.to_test}")
+    log(f"Available proxies found this run (ping/connect ok): {run.stage2_ok}")
+    vs = verdicts.stats()
+    log(f"Stage 2 endpoint cache: {vs['entries']} endpoints probed, {vs['hits']} hits, {vs['shared']} shared in-flight, {vs['misses']} misses")
+    ts = tested_hashes.stats()
+    log(f"Tested index: {ts['entries']} hashes; Bloom filter answered {ts['bloom_negatives']} of {ts['lookups']} lookups")
+    if xray_pool is not None:
+        log(f"Stage 3 kept {len(available_to_add)} of {run.stage2_ok} proxies")
+        xray_pool.log_stats()
 
     # Deduplicate against existing available file and write (custom OpenRay dedup rules)
-    new_available_unique: List[str] = []
-    existing_connection_keys = {get_openray_dedup_key(u) for u in existing_available}
-    for u in available_to_add:
-        conn_key = get_openray_dedup_key(u)
-        if conn_key not in existing_connection_keys:
-            existing_connection_keys.add(conn_key)
-            new_available_unique.append(u)
+    new_available_unique: List[ProxyRecord] = []
+    existing_connection_keys = {dedup_key_bytes(u) for u in existing_available}
+    for rec in available_to_add:
+        if rec.dedup_key not in existing_connection_keys:
+            existing_connection_keys.add(rec.dedup_key)
+            new_available_unique.append(rec)
 
     if new_available_unique:
         # Build per-country counters from existing entries
@@ -630,10 +317,9 @@ def main() -> int:
         print("Start formatting new available proxies")
         # Batch resolve country codes for hosts of new entries
         hosts_to_resolve: List[str] = []
-        for u in new_available_unique:
-            h = host_map.get(u)
-            if h:
-                hosts_to_resolve.append(h)
+        for rec in new_available_unique:
+            if rec.host:
+                hosts_to_resolve.append(rec.host)
         # Deduplicate while preserving order
         hosts_to_resolve = list(dict.fromkeys(hosts_to_resolve))
         cc_map: Dict[str, Optional[str]] = {}
@@ -646,8 +332,15 @@ def main() -> int:
                     cc_map[h] = _get_country_code_for_host(h)
                 except Exception:
                     cc_map[h] = None
-        for u in progress(new_available_unique, total=len(new_available_unique)):
-            host = host_map.get(u)
+        gs = geoip_stats()
+        hs = geo_http_stats()
+        if gs['lookups']:
+            log(f"GeoIP ({gs['engine']}): {gs['lookups']} lookups ({gs['hits']} cached), {gs['db_lookups']} reads in {gs['db_ms']:.1f} ms"
+                + ("" if gs['available'] else " (no offline data)"))
+        log(f"Geolocation source: {gs['engine'] if gs['available'] else 'no offline data'}"
+            + (f" + ip-api.com ({hs['ips']} IPs)" if hs['enabled'] else " (ip-api.com disabled)"))
+        for rec in progress(new_available_unique, total=len(new_available_unique)):
+            host = rec.host
             cc = cc_map.get(host) if host else None
             if not cc:
                 cc = 'XX'
@@ -660,7 +353,7 @@ def main() -> int:
                 remark = f"[OpenRay] Dynamic-{next_num}"
             else:
                 remark = f"[OpenRay] {flag} {cc}-{next_num}"
-            new_u = _set_remark(u, remark)
+            new_u = rec.with_remark(remark)
             formatted_to_append.append(new_u)
         append_lines(AVAILABLE_FILE, formatted_to_append)
         log(f"Appended {len(formatted_to_append)} new available proxies to {AVAILABLE_FILE} with formatted remarks")
@@ -689,10 +382,11 @@ def main() -> int:
         pass
 
     # Persist tested hashes (append all newly tested regardless of success)
-    from .constants import TESTED_FILE
-
     append_tested_hashes_optimized(new_hashes)
     log(f"Recorded {len(new_hashes)} newly tested proxies to optimized storage")
+    # Only after the hashes it relies on are recorded as tested
+    if source_state is not None:
+        source_state.save(keep=[u for u, _ in parsed_sources])
 
     # Update streaks based on this run's host successes
     try:
@@ -700,39 +394,63 @@ def main() -> int:
         if total_successes == 0 and not _has_connectivity():
             log("Suspected Internet outage affected tests; skipping streaks update to avoid false resets.")
         else:
-            now_ts = int(time.time())
-            for host, success in host_success_run.items():
-                rec = streaks.get(host, {'streak': 0, 'last_test': 0, 'last_success': 0})
-                rec['last_test'] = now_ts
-                if success:
-                    rec['streak'] = int(rec.get('streak', 0)) + 1
-                    rec['last_success'] = now_ts
-                else:
-                    rec['streak'] = 0
-                streaks[host] = rec
-            save_streaks(streaks)
+            # Only the hosts tested this run are looked up and written
+            streaks = StreakStore()
+            streaks.load()
+            streaks.record(host_success_run)
+            written = streaks.save()
+            log(f"Streaks: {len(host_success_run)} hosts updated, {written / 1024:.1f} KB written"
+                + (f", {streaks.evicted} expired hosts dropped" if streaks.evicted else ""))
     except Exception as e:
         log(f"Streaks update failed: {e}")
 
+    # Decayed reliability: this run's outcome for every rechecked existing proxy and each new find
+    scores = get_scores()
+    try:
+        alive_set = set(alive)
+        outcomes = [(u, u in alive_set) for u, h in host_map_existing.items() if h]
+        if outcomes and not alive_set and not _has_connectivity():
+            log("Suspected Internet outage affected rechecks; not recording them in proxy scores.")
+            outcomes = []
+        outcomes += [(rec.uri, True) for rec in new_available_unique]
+        for uri, ms in http_ms.items():
+            measured.setdefault(uri, CheckResult(True)).http_ms = ms
+        scores.observe_many(outcomes, "main", latencies={u: r.stage_latency() for u, r in measured.items()},
+                            details={u: r.as_dict() for u, r in measured.items()})
+        _log_latency_summary(measured)
+        scores.save()
+    except Exception as e:
+        log(f"Proxy score update failed: {e}")
+
     # Update check counts for successfully validated proxies
+    current_available: List[str] = []
     try:
         # Load current available proxies to update counts
         current_available = load_existing_available()
         if current_available:
             _update_check_counts_for_proxies(current_available, "main")
-            _write_top100_by_checks(current_available)
-            
-            # Generate Iran top100 ranking (without updating iran counter)
-            _write_iran_top100_by_checks(current_available)
+            # Main and Iran top100 rankings (without updating the iran counter)
+            _write_top100_rankings(current_available)
     except Exception as e:
         log(f"Check counts update failed: {e}")
 
+    # Fastest proxies overall and per country, by the stored latency medians
+    try:
+        if current_available:
+            n = write_fastest_outputs(current_available, scores)
+            log(f"Fastest lists: {n} of {len(current_available)} available proxies have measured latency")
+    except Exception as e:
+        log(f"Fastest outputs step failed: {e}")
+
     # Generate grouped outputs by kind and country
     try:
         write_grouped_outputs()
     except Exception as e:
         log(f"Grouped outputs step failed: {e}")
 
+    st = dns_cache_stats()
+    log(f"DNS cache: {st['hits']} hits, {st['misses']} lookups, {st['coalesced']} coalesced")
+
     return 0
 
 
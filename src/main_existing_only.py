@@ -17,11 +17,10 @@ from .constants import (
 from .grouping import write_grouped_outputs
 from .io_ops import (
     ensure_dirs,
-    load_streaks,
     read_lines,
-    save_streaks,
 )
-from .net import ping_host, connect_host_port, quick_protocol_probe, validate_with_v2ray_core
+from .streaks import StreakStore
+from .net import ping_host, connect_host_port, quick_protocol_probe, validate_many_with_v2ray_core
 from .parsing import (
     extract_host,
     extract_port,
@@ -66,9 +65,6 @@ def main() -> int:
         log("No Internet connectivity detected; skipping network operations and leaving existing outputs unchanged.")
         return 2
 
-    # Load streaks persistence
-    streaks: Dict[str, Dict[str, int]] = load_streaks()
-
     # Re-validate current available proxies to drop broken ones
     host_success_run: Dict[str, bool] = {}
     alive: List[str] = []
@@ -141,19 +137,9 @@ def main() -> int:
                     subset = alive # [:int(STAGE3_MAX)]
                     kept_subset: List[str] = []
 
-                    def _core_check(u: str) -> Optional[str]:
-                        try:
-                            res = validate_with_v2ray_core(u, timeout_s=12)
-                        except Exception:
-                            return None
-                        return u if res is True else None
-
-                    workers = int(STAGE3_WORKERS)
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool2:
-                        print("Start Stage 3 for existing proxies")
-                        for r in progress(pool2.map(_core_check, subset), total=len(subset)):
-                            if r is not None:
-                                kept_subset.append(r)
+                    print("Start Stage 3 for existing proxies")
+                    verdicts3 = validate_many_with_v2ray_core(subset, timeout_s=12)
+                    kept_subset.extend(u for u, res in zip(subset, verdicts3) if res is True)
                     # Merge: replace subset portion with validated ones
                     alive = kept_subset + alive[len(subset):]
 
@@ -185,17 +171,11 @@ def main() -> int:
         log(f"No existing proxies file found: {AVAILABLE_FILE}")
         return 0
 
-    # Update streaks for hosts that were successfully tested
-    for host, success in host_success_run.items():
-        if host not in streaks:
-            streaks[host] = {}
-        if success:
-            streaks[host]['consecutive'] = streaks[host].get('consecutive', 0) + 1
-            streaks[host]['last_success'] = int(time.time())
-        else:
-            streaks[host]['consecutive'] = 0
-
-    save_streaks(streaks)
+    # Update streaks for hosts that were tested
+    streaks = StreakStore()
+    streaks.load()
+    streaks.record(host_success_run)
+    streaks.save()
 
     # Group and write outputs
     if deduplicated_alive:
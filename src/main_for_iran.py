@@ -25,7 +25,7 @@ C.OUTPUT_DIR = os.path.join(C.REPO_ROOT, 'output_iran')
 # Recompute dependent constant paths
 C.TESTED_FILE = os.path.join(C.STATE_DIR, 'tested.txt')
 C.AVAILABLE_FILE = os.path.join(C.OUTPUT_DIR, 'all_valid_proxies_for_iran.txt')
-C.STREAKS_FILE = os.path.join(C.STATE_DIR, 'streaks.json')
+C.STREAKS_FILE = os.path.join(C.STATE_DIR, 'streaks.bin')
 C.KIND_DIR = os.path.join(C.OUTPUT_DIR, 'kind')
 C.COUNTRY_DIR = os.path.join(C.OUTPUT_DIR, 'country')
 
@@ -40,8 +40,7 @@ os.environ['OPENRAY_RECHECK_EXISTING'] = '1'
 # Set NEW_URIS_LIMIT to a lower value for Iran-specific processing
 C.NEW_URIS_LIMIT = 10000  # Reduced from default 25000 for Iran-specific processing
 
-# Iran-specific check count tracking files (shared with main.py)
-CHECK_COUNTS_FILE = os.path.join(C.REPO_ROOT, '.state', 'check_counts.json')
+# Iran-specific top list (check counts are shared with main.py)
 TOP100_FILE = os.path.join(C.OUTPUT_DIR, 'iran_top100_checked.txt')
 
 # Internet connectivity monitoring
@@ -245,6 +244,9 @@ def _patch_network_functions():
 from .common import log  # noqa: E402
 from .io_ops import ensure_dirs, read_lines, write_text_file_atomic  # noqa: E402
 from . import main as main_pipeline  # noqa: E402
+from .check_counts import get_check_counts  # noqa: E402
+from .ranking import RANKINGS, rank_proxies, write_if_changed  # noqa: E402
+from .scoring import get_scores  # noqa: E402
 
 
 def _seed_available_from_input() -> None:
@@ -267,152 +269,47 @@ def _seed_available_from_input() -> None:
     except Exception as e:
         log(f"Seeding available proxies failed: {e}")
 
-def _load_check_counts() -> Dict[str, Dict[str, int]]:
-    """Load check counts with dual counter system: {proxy: {"main": count, "iran": count}}"""
-    try:
-        if os.path.exists(CHECK_COUNTS_FILE):
-            with open(CHECK_COUNTS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    # Convert old format to new format if needed
-                    result = {}
-                    for proxy, value in data.items():
-                        if isinstance(value, dict) and "main" in value and "iran" in value:
-                            # New format
-                            result[str(proxy)] = {
-                                "main": int(value.get("main", 0)),
-                                "iran": int(value.get("iran", 0))
-                            }
-                        else:
-                            # Old format - convert to new format
-                            result[str(proxy)] = {
-                                "main": int(value) if isinstance(value, (int, str)) else 0,
-                                "iran": 0
-                            }
-                    return result
-    except Exception as e:
-        log(f"Failed to load check counts: {e}")
-    return {}
-
-
 def _cleanup_check_counts(active_proxies: List[str]) -> None:
     """Remove check counts for proxies that are no longer active."""
     if not active_proxies:
         return
-
-    counts = _load_check_counts()
-    active_set = set(active_proxies)
-
-    # Filter counts to only include active proxies
-    cleaned_counts = {proxy: counts for proxy, counts in counts.items() if proxy in active_set}
-
-    # Only save if there are changes
-    if len(cleaned_counts) != len(counts):
-        removed_count = len(counts) - len(cleaned_counts)
+    removed_count = get_check_counts().retain(active_proxies)
+    if removed_count:
         log(f"Cleaned up check counts: removed {removed_count} stale proxies from state (not in current input list)")
-        _save_check_counts(cleaned_counts)
-
-
-def _save_check_counts(counts: Dict[str, Dict[str, int]]) -> None:
-    try:
-        ensure_dirs()
-        os.makedirs(os.path.dirname(CHECK_COUNTS_FILE), exist_ok=True)
-        tmp = CHECK_COUNTS_FILE + '.tmp'
-        with open(tmp, 'w', encoding='utf-8', errors='ignore') as f:
-            json.dump(counts, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, CHECK_COUNTS_FILE)
-    except Exception as e:
-        log(f"Failed to save check counts: {e}")
 
 
 def _update_check_counts_for_proxies(proxies: List[str], active_proxies: List[str] = None, counter_type: str = "iran") -> None:
     """Update check counts for successfully validated proxies."""
     if not proxies:
         return
-    counts = _load_check_counts()
-
     # If active_proxies is provided, only update counts for active proxies
-    active_set = set(active_proxies) if active_proxies else None
-
-    # Deduplicate proxies using custom OpenRay dedup key
-    from .common import get_openray_dedup_key
-    seen_keys: set = set()
-    unique_proxies: List[str] = []
-    
-    for p in proxies:
-        if not p:
-            continue
-        # Skip if proxy is not in active list (when provided)
-        if active_set is not None and p not in active_set:
-            continue
-        
-        # Deduplicate using custom OpenRay dedup key
-        conn_key = get_openray_dedup_key(p)
-        if conn_key not in seen_keys:
-            seen_keys.add(conn_key)
-            unique_proxies.append(p)
-
-    # Update counts for all unique successfully validated proxies
-    updated_count = 0
-    for p in unique_proxies:
-        if p not in counts:
-            counts[p] = {"main": 0, "iran": 0}
-        
-        old_count = counts[p].get(counter_type, 0)
-        counts[p][counter_type] = old_count + 1
-        updated_count += 1
-    
+    if active_proxies:
+        active_set = set(active_proxies)
+        proxies = [p for p in proxies if p in active_set]
+    updated_count = get_check_counts().increment(proxies, counter_type)
     if updated_count > 0:
-        _save_check_counts(counts)
         log(f"📈 Updated {counter_type} check counts for {updated_count} successfully validated proxies")
 
 
 def _write_top100_by_checks(active_proxies: List[str]) -> None:
     """Write top 100 most frequently checked proxies to iran_top100_checked.txt.
-    Prioritizes iran scores, then main scores as tiebreaker."""
+    Ordered by the decayed iran score, then iran and main counts as tiebreakers."""
     try:
-        counts = _load_check_counts()
-        
         if not active_proxies:
             log("⚠️ No active proxies to rank")
             return
-            
-        # Score each active proxy by iran count first, then main count as tiebreaker
-        scored = []
-        for idx, p in enumerate(active_proxies):
-            proxy_counts = counts.get(p, {"main": 0, "iran": 0})
-            iran_count = proxy_counts.get("iran", 0)
-            main_count = proxy_counts.get("main", 0)
-            scored.append((iran_count, main_count, idx, p))
-        
-        # Sort by iran count desc, then main count desc, then original order asc (stable tie-break)
-        scored.sort(key=lambda t: (-t[0], -t[1], t[2]))
-        
-        # Get top 100
-        top = [p for _, _, _, p in scored[:100]]
-        
-        # Log some statistics
-        if scored:
-            max_iran = scored[0][0] if scored else 0
-            max_main = max(t[1] for t in scored) if scored else 0
-            avg_iran = sum(t[0] for t in scored) / len(scored) if scored else 0
-            avg_main = sum(t[1] for t in scored) / len(scored) if scored else 0
-            
-            log(f"📊 Iran check stats: max={max_iran}, avg={avg_iran:.1f}")
-            log(f"📊 Main check stats: max={max_main}, avg={avg_main:.1f}")
-        
-        write_text_file_atomic(TOP100_FILE, top)
-        log(f"🏆 Wrote top {len(top)} most reliable proxies to {TOP100_FILE}")
-        
-        # Show top 5 for verification
-        if top:
-            log("🥇 Top 5 most reliable proxies:")
-            for i, proxy in enumerate(top[:5], 1):
-                proxy_counts = counts.get(proxy, {"main": 0, "iran": 0})
-                iran_count = proxy_counts.get("iran", 0)
-                main_count = proxy_counts.get("main", 0)
-                log(f"  {i}. [Iran:{iran_count}, Main:{main_count}] {proxy[:60]}...")
-                
+
+        ranked = rank_proxies(active_proxies, ('iran',))
+        for counter in ('iran', 'main'):
+            max_count, avg_count = ranked.stats[counter]
+            log(f"📊 {counter.capitalize()} check stats: max={max_count}, avg={avg_count:.1f}")
+
+        top = ranked.uris('iran')
+        if write_if_changed(TOP100_FILE, top):
+            log(f"🏆 Wrote top {len(top)} most reliable proxies to {TOP100_FILE}")
+        else:
+            log(f"🏆 Top {len(top)} most reliable proxies unchanged: {TOP100_FILE}")
+        main_pipeline._log_top5('proxies', ranked['iran'], RANKINGS['iran'])
     except Exception as e:
         log(f"❌ Failed to write top100 checked proxies: {e}")
 
@@ -530,8 +427,15 @@ def main() -> int:
         # Update counts only for successful proxies
         _update_check_counts_for_proxies(successful_proxies, all_proxies)
 
+        # Decayed reliability for every checked proxy (skipped when nothing passed: core or network down)
+        scores = get_scores()
+        if successful_proxies:
+            ok_set = set(successful_proxies)
+            scores.observe_many(((p, p in ok_set) for p in all_proxies), "iran")
+
         # Generate top 100 ranking among existing proxies
         _write_top100_by_checks(all_proxies)
+        scores.save()
 
         log("✅ Completed: counts updated and top100 generated (no file rewrites)")
         return 0
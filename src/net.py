@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import hashlib
+import http.client
 import json
 import os
 import socket
@@ -8,12 +10,18 @@ import sys
 import ssl
 import shutil
 import tempfile
-from typing import List, Optional, Dict, Set, Tuple
-from urllib.request import Request, urlopen
-
-from .constants import USER_AGENT, PING_TIMEOUT_MS, TCP_FALLBACK_PORTS, FETCH_TIMEOUT, CONNECT_TIMEOUT_MS, PROBE_TIMEOUT_MS, V2RAY_CORE_PATH, ENABLE_STAGE2, FETCH_WORKERS, PING_WORKERS
+import threading
+import time
+import concurrent.futures
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Dict, Set, Tuple, Union
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, urlopen
+
+from .constants import USER_AGENT, PING_TIMEOUT_MS, TCP_FALLBACK_PORTS, FETCH_TIMEOUT, FETCH_PER_HOST, FETCH_KEEPALIVE_S, CONNECT_TIMEOUT_MS, PROBE_TIMEOUT_MS, V2RAY_CORE_PATH, ENABLE_STAGE2, FETCH_WORKERS, PING_WORKERS, STAGE2_CONCURRENCY, STAGE2_ITEM_TIMEOUT, DNS_CACHE_TTL, DNS_NEGATIVE_TTL, DNS_CACHE_MAX, DNS_TIMEOUT_MS, DNS_WORKERS, GEO_HTTP_FALLBACK
 from .common import log, progress
-from .geo import get_country_code_geoip2
+from .geo import get_country_code_geoip2, lookup_many as geoip_lookup_many, offline_geo_available
+from .icmp import AsyncIcmpPinger, icmp_supported, ping_many as icmp_ping_many
 
 
 def _idna(host: str) -> str:
@@ -23,70 +31,277 @@ def _idna(host: str) -> str:
         return host
 
 
+def _local_source_path(url: str) -> Optional[str]:
+    """Absolute path of a file:// or relative/local source, None for remote URLs."""
+    if url.startswith('file://'):
+        file_path = url[7:]  # Remove 'file://' prefix
+    elif url.startswith('./') or url.startswith('../') or (not url.startswith(('http://', 'https://')) and os.path.exists(url)):
+        file_path = url
+    else:
+        return None
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(os.getcwd(), file_path)
+    return file_path
+
+
+def _origin(url: str) -> str:
+    """scheme://host[:port] of a source URL; sources sharing it share connections and limits."""
+    try:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+    except Exception:
+        return url
+
+
+class FetchStats:
+    """Per-origin source download counters.
+
+    Tracks requests, bytes and the wall-clock span per origin (for throughput) plus how
+    many connections were opened versus reused from the keep-alive pool; every reuse on
+    an https origin is a TLS handshake saved.
+    """
+
+    def __init__(self) -> None:
+        self._origins: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, origin: str) -> Dict[str, float]:
+        ent = self._origins.get(origin)
+        if ent is None:
+            ent = self._origins[origin] = {'requests': 0, 'bytes': 0, 'first': 0.0, 'last': 0.0,
+                                           'opened': 0, 'reused': 0}
+        return ent
+
+    def record(self, origin: str, nbytes: int, started: float, finished: float) -> None:
+        with self._lock:
+            ent = self._entry(origin)
+            ent['requests'] += 1
+            ent['bytes'] += int(nbytes)
+            ent['first'] = started if not ent['first'] else min(ent['first'], started)
+            ent['last'] = max(ent['last'], finished)
+
+    def connection(self, origin: str, reused: bool) -> None:
+        with self._lock:
+            self._entry(origin)['reused' if reused else 'opened'] += 1
+
+    def origins(self, top: int = 5) -> List[Tuple[str, Dict[str, float]]]:
+        """Busiest origins first, each with requests, bytes, throughput (bytes/s) and connection counts."""
+        with self._lock:
+            items = [(o, dict(e)) for o, e in self._origins.items()]
+        for _o, e in items:
+            span = max(1e-3, e['last'] - e['first'])
+            e['throughput'] = e['bytes'] / span
+        items.sort(key=lambda kv: (kv[1]['requests'], kv[1]['bytes']), reverse=True)
+        return items[:top] if top else items
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            ents = list(self._origins.items())
+        return {
+            'origins': len(ents),
+            'requests': int(sum(e['requests'] for _o, e in ents)),
+            'bytes': int(sum(e['bytes'] for _o, e in ents)),
+            'opened': int(sum(e['opened'] for _o, e in ents)),
+            'reused': int(sum(e['reused'] for _o, e in ents)),
+            'tls_saved': int(sum(e['reused'] for o, e in ents if o.startswith('https://'))),
+        }
+
+
+_fetch_stats = FetchStats()
+
+
+def fetch_stats() -> Dict[str, int]:
+    return _fetch_stats.stats()
+
+
+def fetch_origin_stats(top: int = 5) -> List[Tuple[str, Dict[str, float]]]:
+    return _fetch_stats.origins(top)
+
+
+class _KeepAlivePool:
+    """Idle http.client connections per origin for the synchronous fetch path.
+
+    urlopen opens (and TLS-handshakes) a new connection for every source; this keeps the
+    connection after a fully read response and hands it to the next request for the same
+    origin within keepalive_s. A reused connection the server has meanwhile closed is
+    retried once on a fresh one.
+    """
+
+    _REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, keepalive_s: int = FETCH_KEEPALIVE_S, per_origin: int = FETCH_PER_HOST) -> None:
+        self.keepalive_s = int(keepalive_s)
+        self.per_origin = max(1, int(per_origin))
+        self._idle: Dict[str, List[Tuple[float, http.client.HTTPConnection]]] = {}
+        self._lock = threading.Lock()
+        self._ssl_ctx: Optional[ssl.SSLContext] = None
+
+    def _acquire(self, origin: str, parts, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(origin) or []
+            while idle:
+                last_used, conn = idle.pop()
+                if now - last_used <= self.keepalive_s:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        host = parts.hostname or ''
+        if parts.scheme == 'https':
+            if self._ssl_ctx is None:
+                self._ssl_ctx = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, parts.port, timeout=timeout, context=self._ssl_ctx), False
+        return http.client.HTTPConnection(host, parts.port, timeout=timeout), False
+
+    def _release(self, origin: str, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(origin, [])
+            if len(idle) < self.per_origin:
+                idle.append((time.monotonic(), conn))
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _t, conn in conns:
+                conn.close()
+
+    def _request(self, origin: str, parts, path: str, headers: Dict[str, str], timeout: float):
+        conn, reused = self._acquire(origin, parts, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse(), reused
+        except (http.client.RemoteDisconnected, ConnectionError) as e:
+            conn.close()
+            if not reused:
+                raise
+            stale = e
+        except Exception:
+            conn.close()
+            raise
+        # The server dropped the idle connection (and likely its siblings): one fresh attempt
+        with self._lock:
+            for _t, old in self._idle.pop(origin, []):
+                old.close()
+        conn, _reused = self._acquire(origin, parts, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse(), False
+        except Exception:
+            conn.close()
+            raise stale
+
+    def get(self, url: str, headers: Dict[str, str], timeout: float, max_bytes: int) -> bytes:
+        """GET url (following redirects) and return at most max_bytes + 1 bytes of the body."""
+        for _ in range(5):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f"unsupported scheme: {parts.scheme}")
+            origin = _origin(url)
+            path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+            conn, resp, reused = self._request(origin, parts, path, headers, timeout)
+            _fetch_stats.connection(origin, reused)
+            try:
+                data = resp.read(max_bytes + 1)
+                # Only a fully drained response leaves the connection reusable
+                complete = resp.isclosed() or not resp.read(1)
+            except Exception:
+                conn.close()
+                raise
+            if complete and not resp.will_close:
+                self._release(origin, conn)
+            else:
+                conn.close()
+            if resp.status in self._REDIRECTS and resp.getheader('Location'):
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status >= 400:
+                raise http.client.HTTPException(f"HTTP Error {resp.status}: {resp.reason}")
+            return data
+        raise http.client.HTTPException("too many redirects")
+
+
+_http_pool = _KeepAlivePool()
+
+
 def fetch_url(url: str, timeout: int = FETCH_TIMEOUT) -> Optional[str]:
     try:
         # Handle local file paths
-        if url.startswith('file://'):
-            file_path = url[7:]  # Remove 'file://' prefix
-            if not os.path.isabs(file_path):
-                file_path = os.path.join(os.getcwd(), file_path)
+        file_path = _local_source_path(url)
+        if file_path is not None:
             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                 return f.read()
-        elif url.startswith('./') or url.startswith('../') or (not url.startswith(('http://', 'https://')) and os.path.exists(url)):
-            # Handle relative file paths
-            if not os.path.isabs(url):
-                url = os.path.join(os.getcwd(), url)
-            with open(url, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read()
 
         # Handle HTTP URLs
-        req = Request(url, headers={'User-Agent': USER_AGENT, 'Accept': '*/*'})
-        with urlopen(req, timeout=timeout) as resp:
-            # limit size to 10 MB to avoid memory blowups
-            max_bytes = 10 * 1024 * 1024
-            data = resp.read(max_bytes + 1)
-            if len(data) > max_bytes:
-                data = data[:max_bytes]
-            return data.decode('utf-8', errors='ignore')
+        # limit size to 10 MB to avoid memory blowups
+        max_bytes = 10 * 1024 * 1024
+        headers = {'User-Agent': USER_AGENT, 'Accept': '*/*'}
+        started = time.perf_counter()
+        if getproxies():
+            # Honour HTTP(S)_PROXY the way urllib does; no pooling through a proxy
+            req = Request(url, headers=headers)
+            with urlopen(req, timeout=timeout) as resp:
+                data = resp.read(max_bytes + 1)
+            _fetch_stats.connection(_origin(url), False)
+        else:
+            data = _http_pool.get(url, headers, timeout, max_bytes)
+        if len(data) > max_bytes:
+            data = data[:max_bytes]
+        _fetch_stats.record(_origin(url), len(data), started, time.perf_counter())
+        return data.decode('utf-8', errors='ignore')
     except Exception as e:
         log(f"Fetch failed: {url} -> {e}")
         return None
 
 
+def _ping_commands(host_ascii: str, timeout_ms: int) -> List[List[str]]:
+    """Build candidate ping commands (IPv4 then IPv6) for the current platform."""
+    is_windows = os.name == 'nt' or sys.platform.startswith('win')
+    if is_windows:
+        # Windows: -n (count), -w (timeout in ms), -4/-6 to force family
+        return [
+            ["ping", "-n", "1", "-w", str(timeout_ms), "-4", host_ascii],
+            ["ping", "-n", "1", "-w", str(timeout_ms), "-6", host_ascii],
+        ]
+    if sys.platform == 'darwin':
+        # macOS/BSD: -c (count), -W timeout in ms. BSD ping typically lacks -4/-6; use ping then ping6.
+        return [
+            ["ping", "-c", "1", "-W", str(timeout_ms), host_ascii],
+            ["ping6", "-c", "1", "-W", str(timeout_ms), host_ascii],
+        ]
+    # Linux: -c (count), -W timeout in seconds. Use -4/-6 to force family.
+    timeout_sec = max(1, int(round(timeout_ms / 1000.0)))
+    return [
+        ["ping", "-c", "1", "-W", str(timeout_sec), "-4", host_ascii],
+        ["ping", "-c", "1", "-W", str(timeout_sec), "-6", host_ascii],
+    ]
+
+
+def _icmp_forced_off() -> bool:
+    # If running in GitHub Actions, skip ICMP and go straight to TCP fallback to avoid CAP_NET_RAW issues.
+    return os.environ.get('GITHUB_ACTIONS', '').lower() == 'true'
+
+
 def ping_host(host: str) -> bool:
     """Check host reachability via ICMP or TCP fallback."""
     host_ascii = _idna(host)
     timeout_ms = int(PING_TIMEOUT_MS)
     is_windows = os.name == 'nt' or sys.platform.startswith('win')
 
-    # If running in GitHub Actions, skip ICMP and go straight to TCP fallback to avoid CAP_NET_RAW issues.
-    force_tcp = os.environ.get('GITHUB_ACTIONS', '').lower() == 'true'
-
-    if not force_tcp:
-        # Build candidate commands depending on platform
-        cmds: List[List[str]] = []
-        if is_windows:
-            # Windows: -n (count), -w (timeout in ms), -4/-6 to force family
-            cmds = [
-                ["ping", "-n", "1", "-w", str(timeout_ms), "-4", host_ascii],
-                ["ping", "-n", "1", "-w", str(timeout_ms), "-6", host_ascii],
-            ]
-        else:
-            is_darwin = sys.platform == 'darwin'
-            if is_darwin:
-                # macOS/BSD: -c (count), -W timeout in ms. BSD ping typically lacks -4/-6; use ping then ping6.
-                cmds = [
-                    ["ping", "-c", "1", "-W", str(timeout_ms), host_ascii],
-                    ["ping6", "-c", "1", "-W", str(timeout_ms), host_ascii],
-                ]
-            else:
-                # Linux: -c (count), -W timeout in seconds. Use -4/-6 to force family.
-                timeout_sec = max(1, int(round(timeout_ms / 1000.0)))
-                cmds = [
-                    ["ping", "-c", "1", "-W", str(timeout_sec), "-4", host_ascii],
-                    ["ping", "-c", "1", "-W", str(timeout_sec), "-6", host_ascii],
-                ]
-
+    if not _icmp_forced_off() and icmp_supported():
+        # In-process echo over an ICMP socket; no ping binary fork per host
+        try:
+            addrs = resolve_host(host_ascii, max(0.5, min(3.0, timeout_ms / 1000.0)))
+            if addrs and icmp_ping_many(addrs, timeout_ms):
+                return True
+        except Exception:
+            pass
+    elif not _icmp_forced_off():
+        cmds = _ping_commands(host_ascii, timeout_ms)
         py_timeout = (timeout_ms / 1000.0) + 1.0
         for cmd in cmds:
             try:
@@ -107,23 +322,8 @@ def ping_host(host: str) -> bool:
 
     # TCP fallback: try to connect to a few common ports with a short timeout
     try:
-        # Resolve host (prefer IPv4 first)
-        # Set DNS timeout
-        original_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(max(0.5, min(3.0, timeout_ms / 1000.0)))
-        try:
-            infos = socket.getaddrinfo(host_ascii, None, proto=socket.IPPROTO_TCP)
-        finally:
-            socket.setdefaulttimeout(original_timeout)
-        # Order: IPv4 first, then others
-        addrs: List[str] = []
-        for fam, _, _, _, sockaddr in infos:
-            ip = sockaddr[0]
-            if fam == socket.AF_INET:
-                addrs.append(ip)
-        for fam, _, _, _, sockaddr in infos:
-            if fam != socket.AF_INET:
-                addrs.append(sockaddr[0])
+        # Resolve host through the shared cache (IPv4 first)
+        addrs = resolve_host(host_ascii, max(0.5, min(3.0, timeout_ms / 1000.0)))
         timeout_sec = max(0.2, min(2.0, timeout_ms / 1000.0))
         for ip in addrs:
             for port in TCP_FALLBACK_PORTS:
@@ -150,22 +350,8 @@ def connect_host_port(host: str, port: int, timeout_ms: int = CONNECT_TIMEOUT_MS
     except Exception:
         timeout_sec = 1.5
     try:
-        # Resolve both IPv4/IPv6; prefer IPv4 order like in ping_host
-        # Set DNS timeout
-        original_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(max(0.5, min(3.0, timeout_ms / 1000.0)))
-        try:
-            infos = socket.getaddrinfo(host_ascii, port, proto=socket.IPPROTO_TCP)
-        finally:
-            socket.setdefaulttimeout(original_timeout)
-        addrs = []
-        for fam, _, _, _, sockaddr in infos:
-            ip = sockaddr[0]
-            if fam == socket.AF_INET:
-                addrs.append((ip, port))
-        for fam, _, _, _, sockaddr in infos:
-            if fam != socket.AF_INET:
-                addrs.append((sockaddr[0], port))
+        # Resolve both IPv4/IPv6 through the shared cache; IPv4 first like in ping_host
+        addrs = [(ip, port) for ip in resolve_host(host_ascii, max(0.5, min(3.0, timeout_ms / 1000.0)))]
         for addr in addrs:
             try:
                 with socket.create_connection(addr, timeout=timeout_sec):
@@ -185,6 +371,167 @@ def _is_ip_address(host: str) -> bool:
     except Exception:
         return False
 
+
+# ---------- Shared DNS resolver ----------
+# One cache for every stage (ping fallback, connect, TLS probe, dynamic-host heuristic,
+# geolocation and the async engine). Lookups run on a small dedicated thread pool so a
+# timeout never touches the process-global socket.setdefaulttimeout, and concurrent
+# lookups of the same host share one getaddrinfo call.
+
+class DnsCache:
+    """TTL-bounded LRU of host -> resolved addresses (IPv4 first) with in-flight coalescing."""
+
+    def __init__(self, ttl: int = DNS_CACHE_TTL, negative_ttl: int = DNS_NEGATIVE_TTL,
+                 max_entries: int = DNS_CACHE_MAX, workers: int = DNS_WORKERS) -> None:
+        self.ttl = int(ttl)
+        self.negative_ttl = int(negative_ttl)
+        self.max_entries = int(max_entries)
+        self._workers = max(1, int(workers))
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[str, ...]]]" = OrderedDict()
+        self._inflight: Dict[str, "concurrent.futures.Future"] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, host: str) -> Optional[Tuple[str, ...]]:
+        """Return cached addresses (possibly empty for a cached failure) or None on miss."""
+        with self._lock:
+            ent = self._entries.get(host)
+            if ent is None:
+                return None
+            if ent[0] < time.time():
+                del self._entries[host]
+                return None
+            self._entries.move_to_end(host)
+            return ent[1]
+
+    def put(self, host: str, addrs: Tuple[str, ...], expires_at: Optional[float] = None) -> None:
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if addrs else self.negative_ttl)
+        with self._lock:
+            self._entries[host] = (float(expires_at), tuple(addrs))
+            self._entries.move_to_end(host)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, host: str) -> Tuple[str, ...]:
+        try:
+            infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+            addrs = tuple(_order_addrs(infos))
+        except Exception:
+            addrs = ()
+        self.put(host, addrs)
+        return addrs
+
+    def _submit(self, host: str) -> "concurrent.futures.Future":
+        with self._lock:
+            fut = self._inflight.get(host)
+            if fut is not None:
+                self.coalesced += 1
+                return fut
+            self.misses += 1
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._workers, thread_name_prefix='openray-dns')
+            # Registered under the same lock as the check, so concurrent callers share one lookup
+            fut = self._inflight[host] = self._executor.submit(self._lookup, host)
+        fut.add_done_callback(lambda _f, _h=host: self._forget(_h, _f))
+        return fut
+
+    def _forget(self, host: str, fut: "concurrent.futures.Future") -> None:
+        with self._lock:
+            if self._inflight.get(host) is fut:
+                del self._inflight[host]
+
+    def _key(self, host: str) -> Optional[str]:
+        if not host:
+            return None
+        return _idna(host.strip().strip('[]')).lower()
+
+    def resolve(self, host: str, timeout: Optional[float] = None) -> List[str]:
+        """Blocking resolve with cache, coalescing and a per-call timeout."""
+        key = self._key(host)
+        if not key:
+            return []
+        if _is_ip_address(key):
+            return [key]
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return list(cached)
+        fut = self._submit(key)
+        try:
+            return list(fut.result(timeout=timeout if timeout is not None else DNS_TIMEOUT_MS / 1000.0))
+        except Exception:
+            return []
+
+    async def resolve_async(self, host: str, timeout: Optional[float] = None) -> List[str]:
+        """Non-blocking resolve for the asyncio engine; shares cache and in-flight lookups with resolve()."""
+        key = self._key(host)
+        if not key:
+            return []
+        if _is_ip_address(key):
+            return [key]
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return list(cached)
+        fut = self._submit(key)
+        try:
+            # shield: a cancelled waiter must not cancel the lookup other waiters share
+            res = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)),
+                                         timeout=timeout if timeout is not None else DNS_TIMEOUT_MS / 1000.0)
+            return list(res)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return []
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            size = len(self._entries)
+        return {'entries': size, 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+_dns = DnsCache()
+
+
+def resolve_host(host: str, timeout: Optional[float] = None) -> List[str]:
+    """Resolve host through the shared cache; addresses are ordered IPv4 first."""
+    return _dns.resolve(host, timeout)
+
+
+async def resolve_host_async(host: str, timeout: Optional[float] = None) -> List[str]:
+    """Async variant of resolve_host backed by the same cache."""
+    return await _dns.resolve_async(host, timeout)
+
+
+def resolve_many(hosts: List[str], timeout: Optional[float] = None) -> Dict[str, List[str]]:
+    """Resolve many hosts at once: cache misses are submitted together, then collected."""
+    for h in dict.fromkeys(hosts):
+        key = _dns._key(h)
+        if key and not _is_ip_address(key) and _dns.get(key) is None:
+            _dns._submit(key)
+    return {h: _dns.resolve(h, timeout) for h in hosts}
+
+
+def dns_cache_stats() -> Dict[str, int]:
+    return _dns.stats()
+
+
+def _order_addrs(infos) -> List[str]:
+    """Return resolved addresses from getaddrinfo results, IPv4 first (deduplicated)."""
+    addrs: List[str] = []
+    for fam, _, _, _, sockaddr in infos:
+        if fam == socket.AF_INET and sockaddr[0] not in addrs:
+            addrs.append(sockaddr[0])
+    for fam, _, _, _, sockaddr in infos:
+        if fam != socket.AF_INET and sockaddr[0] not in addrs:
+            addrs.append(sockaddr[0])
+    return addrs
+
 # Cache for dynamic classification to avoid repeated DNS lookups in a run
 _dynamic_cache: Dict[str, bool] = {}
 
@@ -204,23 +551,7 @@ def is_dynamic_host(host: str) -> bool:
         key = host.lower()
         if key in _dynamic_cache:
             return _dynamic_cache[key]
-        host_ascii = _idna(host)
-        # Resolve without specific port, prefer TCP info for consistency
-        # Set DNS timeout (use reasonable default since function has no timeout parameter)
-        original_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(3.0)
-        try:
-            infos = socket.getaddrinfo(host_ascii, None, proto=socket.IPPROTO_TCP)
-        finally:
-            socket.setdefaulttimeout(original_timeout)
-        ips: Set[str] = set()
-        for _, _, _, _, sockaddr in infos:
-            try:
-                ip = sockaddr[0]
-                if ip:
-                    ips.add(ip)
-            except Exception:
-                continue
+        ips: Set[str] = set(resolve_host(host))
         # Heuristic decision
         result = True if len(ips) != 1 else False
         _dynamic_cache[key] = result
@@ -229,13 +560,30 @@ def is_dynamic_host(host: str) -> bool:
         return True
 
 
+# IPs sent to ip-api.com this run (see geo_http_stats)
+_geo_http_ips = [0]
+
+
+def _geo_http_enabled() -> bool:
+    """Whether ip-api.com may be asked: OPENRAY_GEO_HTTP=1/0 forces it on/off; by default
+    it is used only when no offline geolocation data (range table or mmdb) could be loaded."""
+    if GEO_HTTP_FALLBACK >= 0:
+        return bool(GEO_HTTP_FALLBACK)
+    return not offline_geo_available()
+
+
+def geo_http_stats() -> Dict[str, int]:
+    return {'enabled': int(_geo_http_enabled()), 'ips': _geo_http_ips[0]}
+
+
 def _get_country_code_for_host(host: str, timeout: int = 5) -> Optional[str]:
     try:
         if _is_ip_address(host):
             cc = get_country_code_geoip2(host)
-            if cc:
+            if cc or not _geo_http_enabled():
                 return cc
-            # fallback to old method if GeoIP2 fails
+            # Ask ip-api.com when the offline data has no answer (see _geo_http_enabled)
+            _geo_http_ips[0] += 1
             url = f"http://ip-api.com/json/{host}?fields=countryCode"
             with urlopen(url, timeout=timeout) as resp:
                 data = resp.read(1024)
@@ -276,12 +624,12 @@ def quick_protocol_probe(uri: str, host: str, port: int, timeout_ms: int = PROBE
             return True
         host_ascii = _idna(host)
         timeout_sec = max(0.1, min(10.0, timeout_ms / 1000.0))
-        # Create TCP socket
-        with socket.create_connection((host_ascii, port), timeout=timeout_sec) as raw_sock:
-            ctx = ssl.create_default_context()
-            # Do not fail on certificate issues; we only care about TLS capability
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
+        addrs = resolve_host(host_ascii, max(0.5, min(3.0, timeout_ms / 1000.0)))
+        if not addrs:
+            return False
+        # Create TCP socket to the resolved address; SNI still carries the hostname
+        with socket.create_connection((addrs[0], port), timeout=timeout_sec) as raw_sock:
+            ctx = _get_probe_ssl_context()
             server_name = None if _is_ip_address(host_ascii) else host_ascii
             with ctx.wrap_socket(raw_sock, server_hostname=server_name) as ssock:
                 # If handshake completes, it's good
@@ -299,378 +647,774 @@ def validate_with_v2ray_core(uri: str, timeout_s: int = 10) -> Optional[bool]:
       True  -> validated by core (actual HTTP(S) fetch succeeded)
       False -> core executed but fetch failed (treat as invalid)
       None  -> core not configured/available or unsupported URI
+
+    For more than a handful of URIs use validate_many_with_v2ray_core, which loads many
+    outbounds into each core process.
     """
     try:
         path = (V2RAY_CORE_PATH or '').strip()
         if not path or not os.path.exists(path):
             return None
-
         # Import here to avoid a hard dependency when Stage 3 is disabled
+        from .xray_pool import run_xray_batch, XrayStartError
         try:
-            from .v2ray import build_config_for_uri  # type: ignore
-        except Exception:
-            return None
+            return run_xray_batch(path, [uri], timeout_s)[0]
+        except XrayStartError:
+            return False
+    except Exception:
+        return None
 
-        built = build_config_for_uri(uri)
-        if not built:
-            return None
-        tag, cfg = built
-        # Add a temporary HTTP inbound on a free port
-        import socket as _sock
-        import tempfile
-        import time
-        import json as _json
-
-        http_port = None
-        s = None
-        try:
-            s = _sock.socket(_sock.AF_INET, _sock.SOCK_STREAM)
-            s.bind(('127.0.0.1', 0))
-            http_port = s.getsockname()[1]
-        except Exception:
-            http_port = 10809
-        finally:
-            try:
-                if s:
-                    s.close()
-            except Exception:
-                pass
 
-        try:
-            inb = cfg.get('inbounds') or []
-        except Exception:
-            inb = []
-        # Ensure list
-        if not isinstance(inb, list):
-            inb = []
-        inb.append({
-            'listen': '127.0.0.1',
-            'port': int(http_port),
-            'protocol': 'http',
-            'settings': {}
-        })
-        cfg['inbounds'] = inb
-
-        # Write temp config file
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
-        tmp_path = tmp.name
-        try:
-            tmp.write(_json.dumps(cfg).encode('utf-8'))
-            tmp.flush()
-        finally:
-            tmp.close()
+def validate_many_with_v2ray_core(uris: List[str], timeout_s: int = 12,
+                                  timings: Optional[Dict[str, float]] = None) -> List[Optional[bool]]:
+    """Batch counterpart of validate_with_v2ray_core (same True/False/None per URI, input order).
 
-        # Start Xray
-        creation = (subprocess.CREATE_NO_WINDOW if os.name == 'nt' and hasattr(subprocess, 'CREATE_NO_WINDOW') else 0)
-        proc = subprocess.Popen([path, '-config', tmp_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=creation)
+    When timings is given, the request time (ms) of every validated URI is stored in it.
+    """
+    try:
+        from .xray_pool import XrayPool
+        pool = XrayPool(timeout_s=timeout_s)
+        results = pool.validate_many(uris)
+        pool.log_stats()
+        if timings is not None:
+            timings.update(pool.http_ms)
+        return results
+    except Exception:
+        return [None] * len(uris)
 
-        # Give it a brief moment to start
-        start = time.time()
-        time.sleep(0.25)
 
-        # Prepare proxy opener
-        try:
-            from urllib.request import build_opener, ProxyHandler
-        except Exception:
-            build_opener = None
-            ProxyHandler = None
-        if build_opener is None or ProxyHandler is None:
-            # Cannot construct proxy opener; abort and cleanup
-            try:
-                proc.terminate()
-            except Exception:
-                pass
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
-            return None
+# ------------------ Async and Batch Helpers ------------------
+import asyncio
 
-        # Try a small set of endpoints
-        test_urls = [
-            'https://www.google.com/generate_204',
-            'https://cp.cloudflare.com/generate_204',
-        ]
-        ok = False
-        # Time budget
-        deadline = start + max(2.0, float(timeout_s))
-        for url in test_urls:
-            if time.time() >= deadline:
-                break
-            try:
-                opener = build_opener(ProxyHandler({
-                    'http': f'http://127.0.0.1:{http_port}',
-                    'https': f'http://127.0.0.1:{http_port}',
-                }))
-                req = Request(url, headers={'User-Agent': USER_AGENT, 'Accept': '*/*'})
-                rem = max(0.5, deadline - time.time())
-                with opener.open(req, timeout=rem) as resp:
-                    code = getattr(resp, 'status', None) or getattr(resp, 'code', None)
-                    if isinstance(code, int) and code in (200, 204):
-                        ok = True
-                        break
-            except Exception:
-                continue
+def _fetch_meta(status: Optional[int], digest: str = '', headers=None) -> Dict:
+    meta = {'status': status, 'etag': '', 'last_modified': '', 'digest': digest}
+    if headers is not None:
+        meta['etag'] = headers.get('ETag') or ''
+        meta['last_modified'] = headers.get('Last-Modified') or ''
+    return meta
 
-        # Cleanup
-        try:
-            proc.terminate()
-        except Exception:
-            pass
-        try:
-            # If still alive, kill
-            try:
-                proc.wait(timeout=0.2)
-            except Exception:
-                if hasattr(proc, 'kill'):
-                    proc.kill()
-        except Exception:
-            pass
-        try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
 
-        return True if ok else False
-    except Exception:
-        return None
+# Source bodies are read in chunks of this size (the cap is enforced per chunk)
+_FETCH_CHUNK = 64 * 1024
+# Hard cap on a source body (after content decoding)
+_FETCH_MAX_BYTES = 10 * 1024 * 1024
 
 
-# ------------------ Async and Batch Helpers ------------------
-import asyncio
+class _BodyReader:
+    """Consumes a source body chunk by chunk without holding on to it.
 
-async def fetch_urls_async_batch(urls: List[str], concurrency: int = None, timeout: int = FETCH_TIMEOUT) -> Dict[str, Optional[str]]:
-    """Fetch multiple URLs concurrently using aiohttp when available.
-    Falls back to sequential urllib if aiohttp is not installed.
-    Returns mapping url -> content (str) or None on failure.
-    Uses a bounded worker-queue to avoid creating a task per URL for very large lists.
-    Includes simple retries with exponential backoff.
+    Every chunk updates the digest and is passed to sink (an incremental scanner with
+    feed(bytes)/close()) when one is given; otherwise the chunks are kept and joined into
+    the usual str. feed() returns False once max_bytes is reached, the excess is dropped.
+    """
+
+    __slots__ = ('sink', 'max_bytes', 'size', 'truncated', '_sha', '_parts')
+
+    def __init__(self, sink: Any = None, max_bytes: int = _FETCH_MAX_BYTES) -> None:
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.truncated = False
+        self._sha = hashlib.sha1()
+        self._parts: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> bool:
+        room = self.max_bytes - self.size
+        if len(chunk) > room:
+            chunk = chunk[:room]
+            self.truncated = True
+        if chunk:
+            self.size += len(chunk)
+            self._sha.update(chunk)
+            if self.sink is not None:
+                self.sink.feed(chunk)
+            else:
+                self._parts.append(chunk)
+        return not self.truncated
+
+    def digest(self) -> str:
+        return self._sha.hexdigest()
+
+    def result(self) -> Any:
+        if self.sink is not None:
+            return self.sink.close()
+        data = b''.join(self._parts)
+        self._parts = []
+        return data.decode('utf-8', errors='ignore')
+
+
+class _OriginQueue:
+    """Hands out source URLs in the given order with at most per_origin in flight per origin.
+
+    A worker never blocks on a throttled origin while another origin has sources
+    waiting: take() returns the earliest pending URL whose origin has a free slot.
+    Local files are not limited.
+    """
+
+    def __init__(self, urls: List[str], per_origin: int) -> None:
+        self.per_origin = max(1, int(per_origin))
+        self._pending: "OrderedDict[str, List[Tuple[int, str]]]" = OrderedDict()
+        for i, u in enumerate(urls):
+            key = '' if _local_source_path(u) is not None else _origin(u)
+            self._pending.setdefault(key, []).append((i, u))
+        for items in self._pending.values():
+            items.reverse()  # pop() from the end yields the earliest
+        self._active: Dict[str, int] = {}
+        self._cond = asyncio.Condition()
+
+    async def take(self) -> Optional[str]:
+        async with self._cond:
+            while True:
+                if not self._pending:
+                    return None
+                best = None
+                for key, items in self._pending.items():
+                    if key and self._active.get(key, 0) >= self.per_origin:
+                        continue
+                    if best is None or items[-1][0] < self._pending[best][-1][0]:
+                        best = key
+                if best is not None:
+                    items = self._pending[best]
+                    _i, url = items.pop()
+                    if not items:
+                        del self._pending[best]
+                    self._active[best] = self._active.get(best, 0) + 1
+                    return url
+                await self._cond.wait()
+
+    async def release(self, url: str) -> None:
+        key = '' if _local_source_path(url) is not None else _origin(url)
+        async with self._cond:
+            self._active[key] = max(0, self._active.get(key, 0) - 1)
+            self._cond.notify_all()
+
+
+async def iter_fetch_async(urls: List[str], concurrency: int = None, timeout: int = FETCH_TIMEOUT,
+                           queue_size: int = 0, validators: Optional[Dict[str, Dict[str, str]]] = None,
+                           with_meta: bool = False, retries: Optional[Dict[str, int]] = None,
+                           scanner_factory: Optional[Callable[[str], Any]] = None):
+    """Async generator yielding (url, content or None) as each source finishes downloading.
+
+    A bounded worker pool fetches with aiohttp (retries with exponential backoff). Finished
+    bodies go through a queue of `queue_size` slots (default: the worker count), so a slow
+    consumer holds the workers back instead of letting downloaded bodies pile up.
+    Falls back to urllib in a thread when aiohttp is not installed.
+
+    Sources are dispatched per origin: at most FETCH_PER_HOST downloads run against one
+    host at a time, over keep-alive connections that are reused for the next source from
+    the same origin; fetch_stats()/fetch_origin_stats() report throughput and reuse.
+
+    Bodies are streamed in _FETCH_CHUNK pieces with gzip/deflate negotiated and the 10 MB
+    cap enforced while reading. With scanner_factory, each attempt gets a fresh
+    scanner_factory(url) that is fed the raw chunks; its close() result (e.g. the URI list
+    of a SubscriptionScanner) is yielded as content instead of the body text, so no source
+    is ever held in memory as a whole.
+
+    validators maps a url to conditional request headers (If-None-Match/If-Modified-Since).
+    With with_meta=True the generator yields (url, content, meta) instead, meta holding the
+    HTTP status (304: not modified, content None), ETag, Last-Modified, a body digest and
+    the fetch time in ms. retries overrides OPENRAY_FETCH_RETRIES per url. Sources are
+    started in the order given.
     """
-    results: Dict[str, Optional[str]] = {u: None for u in urls}
     if not urls:
-        return results
+        return
+    validators = validators or {}
+    retries = retries or {}
     if concurrency is None:
         try:
             concurrency = int(os.environ.get('OPENRAY_FETCH_WORKERS', '0')) or int(FETCH_WORKERS)
         except Exception:
             concurrency = 16
+    concurrency = max(1, int(concurrency))
+
+    def _reader(url: str) -> _BodyReader:
+        return _BodyReader(scanner_factory(url) if scanner_factory is not None else None)
+
     try:
         import aiohttp  # type: ignore
     except Exception as e:
         print(f"fail to import aiohttp: {e}")
-        # Fallback: sequential (to avoid new threads here)
-        for u in progress(urls, total=len(urls)):
-            results[u] = fetch_url(u, timeout=timeout)
-        return results
+        loop = asyncio.get_running_loop()
+        for u in urls:
+            t0 = time.perf_counter()
+            body = await loop.run_in_executor(None, fetch_url, u, timeout)
+            content, meta = None, _fetch_meta(None)
+            if body is not None:
+                reader = _reader(u)
+                reader.feed(body.encode('utf-8'))
+                body = None
+                content, meta = reader.result(), _fetch_meta(200, reader.digest())
+            meta['elapsed_ms'] = int((time.perf_counter() - t0) * 1000)
+            if with_meta:
+                yield u, content, meta
+            else:
+                yield u, content
+        return
 
-    # Read optional retry and size limits from env
+    # Read optional retry limit from env
     try:
         max_retries = int(os.environ.get('OPENRAY_FETCH_RETRIES', '2'))
     except Exception:
         max_retries = 2
-    max_bytes = 10 * 1024 * 1024  # 10 MB hard cap
 
     client_timeout = aiohttp.ClientTimeout(total=max(1, int(timeout)))
-    connector = aiohttp.TCPConnector(limit=max(1, int(concurrency)))
+    per_origin = max(1, int(FETCH_PER_HOST))
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_origin,
+                                     keepalive_timeout=int(FETCH_KEEPALIVE_S), ttl_dns_cache=300)
+
+    # Count new vs reused pooled connections per origin
+    trace = aiohttp.TraceConfig()
+
+    async def _on_request_start(_session, ctx, params) -> None:
+        ctx.origin = _origin(str(params.url))
+
+    async def _on_connection_create_end(_session, ctx, _params) -> None:
+        _fetch_stats.connection(getattr(ctx, 'origin', ''), False)
+
+    async def _on_connection_reuseconn(_session, ctx, _params) -> None:
+        _fetch_stats.connection(getattr(ctx, 'origin', ''), True)
+
+    trace.on_request_start.append(_on_request_start)
+    trace.on_connection_create_end.append(_on_connection_create_end)
+    trace.on_connection_reuseconn.append(_on_connection_reuseconn)
 
     import random  # local to avoid module import cost if not needed
 
-    async def _fetch_one(session: "aiohttp.ClientSession", url: str) -> None:
+    async def _fetch_one(session: "aiohttp.ClientSession", url: str) -> Tuple[Any, Dict]:
         # Handle local files first
-        if url.startswith('file://') or url.startswith('./') or url.startswith('../') or (not url.startswith(('http://', 'https://')) and os.path.exists(url)):
+        file_path = _local_source_path(url)
+        if file_path is not None:
+            reader = _reader(url)
             try:
-                results[url] = fetch_url(url, timeout=timeout)
-                return
+                with open(file_path, 'rb') as f:
+                    while True:
+                        chunk = f.read(_FETCH_CHUNK)
+                        if not chunk or not reader.feed(chunk):
+                            break
             except Exception as e:
                 log(f"Local file fetch failed: {url} -> {e}")
-                results[url] = None
-                return
+                return None, _fetch_meta(None)
+            return reader.result(), _fetch_meta(200, reader.digest())
 
         # retry with exponential backoff
         attempt = 0
         backoff = 0.4
         while True:
+            reader = _reader(url)
             try:
-                headers = {'User-Agent': USER_AGENT, 'Accept': '*/*'}
+                headers = {'User-Agent': USER_AGENT, 'Accept': '*/*', 'Accept-Encoding': 'gzip, deflate'}
+                headers.update(validators.get(url) or {})
+                started = time.perf_counter()
                 async with session.get(url, headers=headers, timeout=client_timeout) as resp:
-                    # limit size to 10 MB
-                    if resp.content_length and resp.content_length > max_bytes:
-                        data = await resp.content.readexactly(max_bytes)
-                    else:
-                        data = await resp.content.read()
-                    if len(data) > max_bytes:
-                        data = data[:max_bytes]
-                    results[url] = data.decode('utf-8', errors='ignore')
-                    return
-            except asyncio.IncompleteReadError as e:
-                try:
-                    partial = e.partial
-                    results[url] = partial.decode('utf-8', errors='ignore') if partial else None
-                    return
-                except Exception:
-                    pass
+                    if resp.status == 304:
+                        return None, _fetch_meta(304, headers=resp.headers)
+                    # aiohttp inflates gzip/deflate as it goes; the cap counts decoded bytes
+                    async for chunk in resp.content.iter_chunked(_FETCH_CHUNK):
+                        if not reader.feed(chunk):
+                            break
+                    _fetch_stats.record(_origin(url), reader.size, started, time.perf_counter())
+                    return reader.result(), _fetch_meta(resp.status, reader.digest(), resp.headers)
             except Exception as e:
-                if attempt >= max_retries:
+                if reader.size and isinstance(e, (asyncio.IncompleteReadError, aiohttp.ClientPayloadError)):
+                    try:
+                        # Truncated bodies are used but never cached as a source's known state
+                        return reader.result(), _fetch_meta(None)
+                    except Exception:
+                        return None, _fetch_meta(None)
+                if attempt >= retries.get(url, max_retries):
                     log(f"Async fetch failed: {url} -> {e}")
-                    results[url] = None
-                    return
+                    return None, _fetch_meta(None)
                 # backoff with jitter
                 await asyncio.sleep(backoff + random.random() * 0.3)
                 attempt += 1
                 backoff *= 2.0
 
-    # Bounded worker queue
-    queue: "asyncio.Queue[str]" = asyncio.Queue()
-    for u in urls:
-        queue.put_nowait(u)
-
-    done_q: "asyncio.Queue[int]" = asyncio.Queue()
+    pending = _OriginQueue(urls, per_origin)
+    done_q: "asyncio.Queue[Tuple[str, Any, Dict]]" = asyncio.Queue(maxsize=max(1, int(queue_size or concurrency)))
+    _END = ('', None, {})
 
     async def _worker(session: "aiohttp.ClientSession") -> None:
         while True:
-            try:
-                u = queue.get_nowait()
-            except Exception:
+            u = await pending.take()
+            if u is None:
                 break
+            content, meta = None, None
+            t0 = time.perf_counter()
             try:
-                await _fetch_one(session, u)
+                content, meta = await _fetch_one(session, u)
+            except Exception:
+                content = None
             finally:
-                try:
-                    queue.task_done()
-                except Exception:
-                    pass
-                try:
-                    done_q.put_nowait(1)
-                except Exception:
-                    pass
+                await pending.release(u)
+            meta = meta or _fetch_meta(None)
+            meta['elapsed_ms'] = int((time.perf_counter() - t0) * 1000)
+            await done_q.put((u, content, meta))
+        await done_q.put(_END)
+
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[trace]) as session:
+        workers_n = min(concurrency, len(urls))
+        workers = [asyncio.create_task(_worker(session)) for _ in range(workers_n)]
+        try:
+            finished = 0
+            while finished < workers_n:
+                item = await done_q.get()
+                if item is _END:
+                    finished += 1
+                    continue
+                yield item if with_meta else item[:2]
+        finally:
+            for t in workers:
+                if not t.done():
+                    t.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-    async def _progress_consumer(total: int) -> None:
-        # Advance a progress bar as each URL is processed
-        for _ in progress(range(total), total=total):
-            try:
-                await done_q.get()
-            finally:
-                try:
-                    done_q.task_done()
-                except Exception:
-                    pass
 
-    async with aiohttp.ClientSession(connector=connector) as session:
-        workers = [asyncio.create_task(_worker(session)) for _ in range(max(1, int(concurrency)))]
-        p_task = asyncio.create_task(_progress_consumer(len(urls)))
-        await asyncio.gather(*workers, return_exceptions=True)
-        try:
-            await done_q.join()
-        except Exception:
-            pass
-        try:
-            await p_task
-        except Exception:
-            pass
+async def fetch_urls_async_batch(urls: List[str], concurrency: int = None, timeout: int = FETCH_TIMEOUT) -> Dict[str, Optional[str]]:
+    """Fetch multiple URLs concurrently using aiohttp when available.
+    Falls back to sequential urllib if aiohttp is not installed.
+    Returns mapping url -> content (str) or None on failure.
+    Collects iter_fetch_async; use that directly to process sources as they arrive.
+    """
+    results: Dict[str, Optional[str]] = {u: None for u in urls}
+    if not urls:
+        return results
+    ticks = iter(progress(range(len(urls)), total=len(urls)))
+    async for url, content in iter_fetch_async(urls, concurrency=concurrency, timeout=timeout):
+        results[url] = content
+        next(ticks, None)
+    next(ticks, None)
     return results
 
 
-async def _ping_one_async(host: str, timeout_sec: float) -> Optional[str]:
+# ------------------ Async Stage 2 engine ------------------
+# Single event loop replacement for the thread-per-proxy watchdogs: every proxy is a
+# coroutine, each network stage is bounded by its own semaphore and the per-proxy
+# deadline is enforced with asyncio.wait_for (cancellation closes sockets natively).
+
+_STAGE2_TCP_SCHEMES = ('vmess', 'vless', 'trojan', 'ss', 'ssr')
+_probe_ssl_ctx: Optional[ssl.SSLContext] = None
+
+
+def _get_probe_ssl_context() -> ssl.SSLContext:
+    # Building a default context loads the CA bundle; do it once per process
+    global _probe_ssl_ctx
+    if _probe_ssl_ctx is None:
+        ctx = ssl.create_default_context()
+        # Do not fail on certificate issues; we only care about TLS capability
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        _probe_ssl_ctx = ctx
+    return _probe_ssl_ctx
+
+
+async def _tcp_connect_timed(ip: str, port: int, timeout_sec: float) -> Optional[float]:
+    """TCP connect time in ms, None when the connection fails."""
+    writer = None
     try:
-        import aioping # type: ignore
-        # aioping.ping returns delay in ms, or raises exception on timeout/error
-        await aioping.ping(host, timeout=timeout_sec)
-        return host
+        t0 = time.perf_counter()
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout_sec)
+        return (time.perf_counter() - t0) * 1000.0
+    except Exception:
+        return None
+    finally:
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+
+async def _tls_handshake_timed(ip: str, port: int, timeout_sec: float, ssl_ctx: ssl.SSLContext,
+                               server_hostname: Optional[str] = None) -> Optional[float]:
+    """TLS handshake time in ms (after the TCP connect), None when it fails.
+
+    Without StreamWriter.start_tls (Python < 3.11) the connect is timed together with
+    the handshake.
+    """
+    writer = None
+    try:
+        t0 = time.perf_counter()
+        if hasattr(asyncio.StreamWriter, 'start_tls'):
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout_sec)
+            t1 = time.perf_counter()
+            remaining = max(0.05, timeout_sec - (t1 - t0))
+            await asyncio.wait_for(writer.start_tls(ssl_ctx, server_hostname=server_hostname or None), timeout=remaining)
+            return (time.perf_counter() - t1) * 1000.0
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port, ssl=ssl_ctx, server_hostname=server_hostname or ''), timeout=timeout_sec)
+        return (time.perf_counter() - t0) * 1000.0
     except Exception:
         return None
+    finally:
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
 
-async def _ping_hosts_async(hosts: List[str], timeout_sec: float) -> Set[str]:
-    tasks = [_ping_one_async(h, timeout_sec) for h in hosts]
-    results = await asyncio.gather(*tasks)
-    return {res for res in results if res is not None}
 
-def ping_host(host: str) -> bool:
-    """Check host reachability via ICMP or TCP fallback."""
-    host_ascii = _idna(host)
-    timeout_ms = int(PING_TIMEOUT_MS)
-    is_windows = os.name == 'nt' or sys.platform.startswith('win')
+async def _tcp_connect_async(ip: str, port: int, timeout_sec: float, ssl_ctx: Optional[ssl.SSLContext] = None,
+                             server_hostname: Optional[str] = None) -> bool:
+    if ssl_ctx is not None:
+        return (await _tls_handshake_timed(ip, port, timeout_sec, ssl_ctx, server_hostname)) is not None
+    return (await _tcp_connect_timed(ip, port, timeout_sec)) is not None
 
-    # If running in GitHub Actions, skip ICMP and go straight to TCP fallback to avoid CAP_NET_RAW issues.
-    force_tcp = os.environ.get('GITHUB_ACTIONS', '').lower() == 'true'
-
-    if not force_tcp:
-        # Build candidate commands depending on platform
-        cmds: List[List[str]] = []
-        if is_windows:
-            # Windows: -n (count), -w (timeout in ms), -4/-6 to force family
-            cmds = [
-                ["ping", "-n", "1", "-w", str(timeout_ms), "-4", host_ascii],
-                ["ping", "-n", "1", "-w", str(timeout_ms), "-6", host_ascii],
-            ]
-        else:
-            is_darwin = sys.platform == 'darwin'
-            if is_darwin:
-                # macOS/BSD: -c (count), -W timeout in ms. BSD ping typically lacks -4/-6; use ping then ping6.
-                cmds = [
-                    ["ping", "-c", "1", "-W", str(timeout_ms), host_ascii],
-                    ["ping6", "-c", "1", "-W", str(timeout_ms), host_ascii],
-                ]
-            else:
-                # Linux: -c (count), -W timeout in seconds. Use -4/-6 to force family.
-                timeout_sec = max(1, int(round(timeout_ms / 1000.0)))
-                cmds = [
-                    ["ping", "-c", "1", "-W", str(timeout_sec), "-4", host_ascii],
-                    ["ping", "-c", "1", "-W", str(timeout_sec), "-6", host_ascii],
-                ]
 
-        py_timeout = (timeout_ms / 1000.0) + 1.0
-        for cmd in cmds:
+async def _first_success(coros: List) -> bool:
+    """Run coroutines concurrently; return True on the first truthy result and cancel the rest."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        for fut in asyncio.as_completed(tasks):
             try:
-                res = subprocess.run(
-                    cmd,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    timeout=py_timeout,
-                    creationflags=(subprocess.CREATE_NO_WINDOW if is_windows and hasattr(subprocess, 'CREATE_NO_WINDOW') else 0),
-                )
-                if res.returncode == 0:
+                if await fut:
                     return True
-            except FileNotFoundError:
-                # e.g., ping6 not present
-                continue
             except Exception:
                 continue
+        return False
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
 
-    # TCP fallback: try to connect to a few common ports with a short timeout
-    try:
-        # Resolve host (prefer IPv4 first)
-        # Set DNS timeout
-        original_timeout = socket.getdefaulttimeout()
-        socket.setdefaulttimeout(max(0.5, min(3.0, timeout_ms / 1000.0)))
+
+async def _icmp_ping_async(target: str, timeout_ms: int) -> bool:
+    """ICMP echo through the system ping binary (IPv4 then IPv6 command).
+
+    Only used when ICMP sockets cannot be opened (no ping_group_range access, no CAP_NET_RAW).
+    """
+    py_timeout = (timeout_ms / 1000.0) + 1.0
+    for cmd in _ping_commands(target, timeout_ms):
+        proc = None
         try:
-            infos = socket.getaddrinfo(host_ascii, None, proto=socket.IPPROTO_TCP)
-        finally:
-            socket.setdefaulttimeout(original_timeout)
-        # Order: IPv4 first, then others
-        addrs: List[str] = []
-        for fam, _, _, _, sockaddr in infos:
-            ip = sockaddr[0]
-            if fam == socket.AF_INET:
-                addrs.append(ip)
-        for fam, _, _, _, sockaddr in infos:
-            if fam != socket.AF_INET:
-                addrs.append(sockaddr[0])
-        timeout_sec = max(0.2, min(2.0, timeout_ms / 1000.0))
-        for ip in addrs:
-            for port in TCP_FALLBACK_PORTS:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            rc = await asyncio.wait_for(proc.wait(), timeout=py_timeout)
+            if rc == 0:
+                return True
+        except FileNotFoundError:
+            continue
+        except BaseException as e:
+            if proc is not None and proc.returncode is None:
                 try:
-                    with socket.create_connection((ip, port), timeout=timeout_sec):
-                        return True
+                    proc.kill()
                 except Exception:
-                    continue
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            continue
+    return False
+
+
+async def _tcp_fallback_async(ip: str, timeout_ms: int) -> bool:
+    timeout_sec = max(0.2, min(2.0, timeout_ms / 1000.0))
+    return await _first_success([_tcp_connect_async(ip, port, timeout_sec) for port in TCP_FALLBACK_PORTS])
+
+
+async def _reach_ip_timed(ip: str, pinger: Optional[AsyncIcmpPinger] = None) -> Union[float, bool]:
+    """Reachability of one resolved address: ICMP first, then TCP fallback ports.
+
+    Returns the ICMP round trip in ms when the shared socket measured one, True when the
+    address answered otherwise (ping binary or a fallback port), False when it did not.
+    With a pinger the echo goes over its shared ICMP socket; the ping binary is only
+    spawned when the process cannot open ICMP sockets.
+    """
+    timeout_ms = int(PING_TIMEOUT_MS)
+    if not _icmp_forced_off():
+        if pinger is not None and pinger.supports(ip):
+            rtt = await pinger.ping(ip, timeout_ms)
+            if rtt is not None:
+                return float(rtt)
+        elif await _icmp_ping_async(ip, timeout_ms):
+            return True
+    return await _tcp_fallback_async(ip, timeout_ms)
+
+
+async def _quick_protocol_probe_timed(uri: str, host: str, port: int, timeout_ms: int = PROBE_TIMEOUT_MS,
+                                      ip: Optional[str] = None) -> Union[float, bool]:
+    """Async quick_protocol_probe returning the handshake time in ms when one was made."""
+    if not host or not isinstance(port, int) or port < 1 or port > 65535:
+        return False
+    if not _is_tls_likely(uri, port):
+        return True
+    host_ascii = _idna(host)
+    timeout_sec = max(0.1, min(10.0, timeout_ms / 1000.0))
+    if ip is None:
+        addrs = await resolve_host_async(host_ascii, max(0.5, min(3.0, timeout_ms / 1000.0)))
+        if not addrs:
+            return False
+        ip = addrs[0]
+    server_name = None if _is_ip_address(host_ascii) else host_ascii
+    ms = await _tls_handshake_timed(ip, port, timeout_sec, _get_probe_ssl_context(), server_name)
+    return ms if ms is not None else False
+
+
+class CheckResult:
+    """Outcome of one proxy check with the latencies it measured (ms; None when not measured).
+
+    icmp_ms is the echo round trip to the host, tcp_ms the connect to the proxy port,
+    tls_ms the TLS handshake after it and http_ms a request through the proxy (Stage 3).
+    Truthy exactly when the check passed, so it stands in for the former bool verdicts.
+    """
+
+    __slots__ = ('ok', 'icmp_ms', 'tcp_ms', 'tls_ms', 'http_ms')
+
+    def __init__(self, ok: bool = False, icmp_ms: Optional[float] = None, tcp_ms: Optional[float] = None,
+                 tls_ms: Optional[float] = None, http_ms: Optional[float] = None) -> None:
+        self.ok = ok
+        self.icmp_ms = icmp_ms
+        self.tcp_ms = tcp_ms
+        self.tls_ms = tls_ms
+        self.http_ms = http_ms
+
+    def __bool__(self) -> bool:
+        return bool(self.ok)
+
+    def stage_latency(self) -> Dict[str, float]:
+        """Per-stage latency for scoring: s2 is the TCP connect, s3 the request.
+
+        Only the connect time is comparable across proxies (a TLS handshake costs extra round
+        trips, ICMP skips the proxy port); the other timings stay in as_dict().
+        """
+        out: Dict[str, float] = {}
+        if self.tcp_ms is not None:
+            out['s2'] = self.tcp_ms
+        if self.http_ms is not None:
+            out['s3'] = self.http_ms
+        return out
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: round(getattr(self, name + '_ms'), 1) for name in ('icmp', 'tcp', 'tls', 'http')
+                if getattr(self, name + '_ms') is not None}
+
+
+def _measured(v) -> Optional[float]:
+    return v if isinstance(v, float) else None
+
+
+class VerdictCache:
+    """Per-run memo of Stage 2 network verdicts keyed by resolved endpoint.
+
+    Keys are ('reach', ip, 0), ('tcp', ip, port) and ('tls', ip, port, sni), so URIs that
+    differ only in path/UUID but share a server are probed once. A probe already in flight
+    is awaited by every other worker asking for the same key instead of being repeated.
+    Probes may return a timing in ms instead of True; measure() hands it back.
+    """
+
+    def __init__(self) -> None:
+        self._done: Dict[Tuple, Union[float, bool]] = {}
+        self._inflight: Dict[Tuple, "asyncio.Future"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    async def run(self, key: Tuple, factory) -> bool:
+        return (await self.measure(key, factory)) is not False
+
+    async def measure(self, key: Tuple, factory) -> Union[float, bool]:
+        """The probe's value: a time in ms or True on success, False on failure."""
+        while True:
+            v = self._done.get(key)
+            if v is not None:
+                self.hits += 1
+                return v
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+            self.shared += 1
+            res = await asyncio.shield(fut)
+            if res is not None:
+                return res
+            # The owning probe was cancelled by its own deadline; run it ourselves
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            v = await factory()
+            if not isinstance(v, float):
+                v = bool(v)
+        except asyncio.CancelledError:
+            self._inflight.pop(key, None)
+            fut.set_result(None)
+            raise
+        except Exception:
+            v = False
+        self._done[key] = v
+        self._inflight.pop(key, None)
+        fut.set_result(v)
+        return v
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._done), 'hits': self.hits, 'misses': self.misses, 'shared': self.shared}
+
+
+async def _limited(sem: asyncio.Semaphore, coro) -> Union[float, bool]:
+    async with sem:
+        return await coro
+
+
+class _Stage2Limits:
+    """Per-stage concurrency limits and the ICMP socket shared by all proxies of one engine run."""
+
+    __slots__ = ('ping', 'connect', 'probe', 'icmp')
+
+    def __init__(self, concurrency: int) -> None:
+        self.icmp = AsyncIcmpPinger()
+        if icmp_supported():
+            self.ping = asyncio.Semaphore(max(1, concurrency))
+        else:
+            # Falling back to the ping binary forks a process per host, keep the historical worker count
+            self.ping = asyncio.Semaphore(max(1, min(concurrency, int(PING_WORKERS))))
+        self.connect = asyncio.Semaphore(max(1, concurrency))
+        self.probe = asyncio.Semaphore(max(1, concurrency))
+
+
+async def check_proxy_async(uri: str, host: str, limits: _Stage2Limits,
+                            verdicts: Optional[VerdictCache] = None) -> CheckResult:
+    """Stage 2 for one proxy: host reachability, then port connect and TLS probe for TCP schemes.
+
+    The result carries the ICMP round trip, connect and handshake times that were measured
+    along the way (shared endpoints reuse the first measurement of the run).
+    """
+    from .parsing import extract_port  # local import to avoid cycles at module load
+
+    if verdicts is None:
+        verdicts = VerdictCache()
+    res = CheckResult()
+    host_ascii = _idna(host)
+    addrs = await resolve_host_async(host_ascii, max(0.5, min(3.0, int(PING_TIMEOUT_MS) / 1000.0)))
+    if not addrs:
+        return res
+
+    reachable = False
+    for ip in addrs:
+        v = await verdicts.measure(('reach', ip, 0), lambda ip=ip: _limited(limits.ping, _reach_ip_timed(ip, limits.icmp)))
+        if v is not False:
+            res.icmp_ms = _measured(v)
+            reachable = True
+            break
+    if not reachable:
+        return res
+
+    scheme = (uri.split('://', 1)[0] or '').lower()
+    if scheme not in _STAGE2_TCP_SCHEMES:
+        res.ok = True
+        return res
+    p = extract_port(uri)
+    if p is None:
+        res.ok = True
+        return res
+    port = int(p)
+    if port < 1 or port > 65535:
+        return res
+
+    timeout_sec = max(0.1, min(10.0, int(CONNECT_TIMEOUT_MS) / 1000.0))
+    connected_ip = None
+    for ip in addrs:
+        v = await verdicts.measure(('tcp', ip, port), lambda ip=ip: _limited(limits.connect, _tcp_connect_timed(ip, port, timeout_sec)))
+        if v is not False:
+            res.tcp_ms = _measured(v)
+            connected_ip = ip
+            break
+    if connected_ip is None:
+        return res
+    if int(ENABLE_STAGE2) != 1 or not _is_tls_likely(uri, port):
+        res.ok = True
+        return res
+    sni = None if _is_ip_address(host_ascii) else host_ascii.lower()
+    v = await verdicts.measure(
+        ('tls', connected_ip, port, sni),
+        lambda: _limited(limits.probe, _quick_protocol_probe_timed(uri, host, port, ip=connected_ip)),
+    )
+    res.ok = v is not False
+    res.tls_ms = _measured(v)
+    return res
+
+
+def _effective_stage2_concurrency(requested: int) -> int:
+    """Clamp concurrency to what the fd limit allows, raising the soft limit when possible."""
+    try:
+        import resource  # POSIX only
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        if soft != resource.RLIM_INFINITY and soft < target:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                soft = target
+            except Exception:
+                pass
+        if soft == resource.RLIM_INFINITY:
+            soft = 65536
+        # TCP fallback may hold one socket per fallback port at once
+        cap = max(16, int(soft) // (len(TCP_FALLBACK_PORTS) + 2))
     except Exception:
-        pass
+        cap = 256
+    return max(1, min(int(requested), cap))
 
-    return False
+
+async def check_many_async(items: List[Tuple[str, str]], concurrency: Optional[int] = None,
+                           item_timeout: Optional[float] = None,
+                           verdicts: Optional[VerdictCache] = None,
+                           timings: Optional[Dict[str, CheckResult]] = None) -> List[Tuple[str, str, bool]]:
+    """Run Stage 2 over (uri, host) pairs on one event loop.
+
+    Results are returned in input order as (uri, host, ok). A fixed number of worker
+    coroutines pull from a shared iterator, so memory stays flat regardless of len(items).
+    Pass the same VerdictCache to several calls to share endpoint verdicts across them.
+    When timings is given, the CheckResult of every passing proxy is stored in it by URI.
+    """
+    results: List[Tuple[str, str, bool]] = [(u, h, False) for u, h in items]
+    if not items:
+        return results
+    workers_n = _effective_stage2_concurrency(concurrency or int(STAGE2_CONCURRENCY))
+    workers_n = min(workers_n, len(items))
+    deadline = float(item_timeout or STAGE2_ITEM_TIMEOUT)
+    limits = _Stage2Limits(workers_n)
+    if verdicts is None:
+        verdicts = VerdictCache()
+    pending = iter(enumerate(items))
+    ticks = iter(progress(range(len(items)), total=len(items)))
+    timed_out = [0]
+
+    async def _worker() -> None:
+        for idx, (uri, host) in pending:
+            ok = False
+            try:
+                res = await asyncio.wait_for(check_proxy_async(uri, host, limits, verdicts), timeout=deadline)
+                ok = bool(res)
+                if ok and timings is not None:
+                    timings[uri] = res
+            except asyncio.TimeoutError:
+                timed_out[0] += 1
+            except Exception:
+                ok = False
+            results[idx] = (uri, host, ok)
+            next(ticks, None)
+
+    try:
+        await asyncio.gather(*(_worker() for _ in range(workers_n)))
+    finally:
+        limits.icmp.close()
+    next(ticks, None)
+    if timed_out[0]:
+        log(f"Stage 2: {timed_out[0]} proxies hit the {deadline:.0f}s per-proxy deadline")
+    return results
+
+
+def run_stage2_checks(items: List[Tuple[str, str]], concurrency: Optional[int] = None,
+                      verdicts: Optional[VerdictCache] = None,
+                      timings: Optional[Dict[str, CheckResult]] = None) -> List[Tuple[str, str, bool]]:
+    """Synchronous entry point for the asyncio Stage 2 engine."""
+    if not items:
+        return []
+    return asyncio.run(check_many_async(items, concurrency=concurrency, verdicts=verdicts, timings=timings))
 
 
 def get_country_codes_batch(hosts: List[str], timeout: int = 5, batch_size: int = 100) -> Dict[str, Optional[str]]:
-    """Resolve country codes for many hosts using ip-api.com batch endpoint.
+    """Resolve country codes for many hosts.
+    Resolved IPs are looked up offline (IP-range table / GeoLite2 database) in one batch;
+    the IPs it cannot place go to the ip-api.com batch endpoint when _geo_http_enabled().
     Fallback to per-host _get_country_code_for_host on errors.
     Returns host -> country code (2 letters) or None.
     """
@@ -678,29 +1422,15 @@ def get_country_codes_batch(hosts: List[str], timeout: int = 5, batch_size: int
     if not hosts:
         return result
 
-    # Resolve to IPs first
+    # Resolve to IPs first (shared cache; misses are looked up in parallel)
+    resolved = resolve_many([h for h in hosts if h], timeout=max(0.5, min(3.0, timeout)))
     ip_to_hosts: Dict[str, List[str]] = {}
     for host in hosts:
         if not host:
             continue
         try:
-            if _is_ip_address(host):
-                ip = host
-            else:
-                # Set DNS timeout
-                original_timeout = socket.getdefaulttimeout()
-                socket.setdefaulttimeout(max(0.5, min(3.0, timeout)))
-                try:
-                    infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
-                    ip = None
-                finally:
-                    socket.setdefaulttimeout(original_timeout)
-                for fam, _, _, _, sockaddr in infos:
-                    if fam == socket.AF_INET:
-                        ip = sockaddr[0]
-                        break
-                if not ip and infos:
-                    ip = infos[0][4][0]
+            addrs = resolved.get(host) or []
+            ip = addrs[0] if addrs else None
             if ip:
                 ip_to_hosts.setdefault(ip, []).append(host)
         except Exception:
@@ -717,6 +1447,14 @@ def get_country_codes_batch(hosts: List[str], timeout: int = 5, batch_size: int
                 result[h] = None
         return result
 
+    for ip, cc in geoip_lookup_many(ips).items():
+        if cc:
+            for h in ip_to_hosts[ip]:
+                result[h] = cc
+    ips = [ip for ip in ips if not result[ip_to_hosts[ip][0]]]
+    if not ips or not _geo_http_enabled():
+        return result
+
     # Query in batches
     try:
         endpoint = f"http://ip-api.com/batch?fields=countryCode"
@@ -724,6 +1462,7 @@ def get_country_codes_batch(hosts: List[str], timeout: int = 5, batch_size: int
         for i in range(0, len(ips), max(1, int(batch_size))):
             chunk = ips[i:i+batch_size]
             body = json.dumps([{'query': ip} for ip in chunk]).encode('utf-8')
+            _geo_http_ips[0] += len(chunk)
             req = Request(endpoint, data=body, headers=headers, method='POST')
             with urlopen(req, timeout=timeout) as resp:
                 data = resp.read()
@@ -743,8 +1482,10 @@ def get_country_codes_batch(hosts: List[str], timeout: int = 5, batch_size: int
                             for h in ip_to_hosts[ip]:
                                 result[h] = cc
     except Exception as e:
-        # Fallback to per-host
+        # Fallback to per-host (keeping what the local database already answered)
         for h in hosts:
+            if result.get(h):
+                continue
             try:
                 result[h] = _get_country_code_for_host(h, timeout=timeout)
             except Exception:
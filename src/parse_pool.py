@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from .common import DEDUP_KEY_SIZE, log, proxy_keys
+from .constants import PARSE_PROCESSES, PARSE_POOL_MIN_URIS
+
+# URIs per task; a large source is split so its keying spreads over all workers
+_KEY_CHUNK = 4096
+# Raw SHA-1 connection keys
+_CONN_KEY_SIZE = 20
+
+
+def key_chunk(uris: List[str]) -> Tuple[bytes, bytes, List[str]]:
+    """Worker task: (dedup keys, connection keys, uris) for the first occurrence of each proxy.
+
+    Keys are packed back to back (DEDUP_KEY_SIZE and 20 bytes each) so the result
+    pickles as two flat byte strings instead of a list of small objects.
+    """
+    seen = set()
+    dkeys: List[bytes] = []
+    ckeys: List[bytes] = []
+    kept: List[str] = []
+    for u in uris:
+        try:
+            d, c = proxy_keys(u)
+        except Exception:
+            continue
+        if d in seen:
+            continue
+        seen.add(d)
+        dkeys.append(d)
+        ckeys.append(c)
+        kept.append(u)
+    return b''.join(dkeys), b''.join(ckeys), kept
+
+
+def _mp_context():
+    """forkserver where available: workers fork from a clean single-threaded server rather
+    than from this process, which already runs resolver and Stage 2 threads."""
+    for method in ('forkserver', 'spawn'):
+        try:
+            return multiprocessing.get_context(method)
+        except ValueError:
+            continue
+    return None
+
+
+class ParsePool:
+    """Process pool that computes dedup/connection keys of large sources on all cores.
+
+    Normalizing and hashing is pure-Python CPU work; for sources of PARSE_POOL_MIN_URIS
+    URIs and more it is sharded into _KEY_CHUNK slices and run in worker processes while
+    the event loop keeps fetching and probing. Smaller sources stay in-process, where the
+    IPC would cost more than it saves. The workers are started lazily by the first source
+    that wants() them (see _mp_context), so runs without large sources never pay for
+    them; a pool that fails to start stays disabled for the run.
+    """
+
+    def __init__(self, processes: int = PARSE_PROCESSES, min_uris: int = PARSE_POOL_MIN_URIS) -> None:
+        self.processes = max(0, int(processes))
+        self.min_uris = max(1, int(min_uris))
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._failed = False
+        self.sources = 0
+        self.uris = 0
+
+    def start(self) -> bool:
+        if self._executor is not None:
+            return True
+        if self.processes < 1 or self._failed:
+            return False
+        ctx = _mp_context()
+        if ctx is None:
+            self._failed = True
+            return False
+        try:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=ctx)
+        except Exception as e:
+            log(f"Parse pool unavailable, keying in-process: {e}")
+            self._failed = True
+            self.close()
+            return False
+        return True
+
+    def wants(self, count: int) -> bool:
+        return self.processes > 0 and not self._failed and count >= self.min_uris
+
+    async def key_uris(self, uris: List[str]) -> List[Tuple[str, bytes, bytes]]:
+        """(uri, dedup key, connection key) in source order, duplicates within the source dropped."""
+        if not self.start():
+            raise RuntimeError("parse pool unavailable")
+        loop = asyncio.get_running_loop()
+        chunks = [uris[i:i + _KEY_CHUNK] for i in range(0, len(uris), _KEY_CHUNK)]
+        parts = await asyncio.gather(*(loop.run_in_executor(self._executor, key_chunk, c) for c in chunks))
+        self.sources += 1
+        self.uris += len(uris)
+        out: List[Tuple[str, bytes, bytes]] = []
+        seen = set()
+        for dblob, cblob, kept in parts:
+            for i, u in enumerate(kept):
+                d = dblob[i * DEDUP_KEY_SIZE:(i + 1) * DEDUP_KEY_SIZE]
+                if d in seen:
+                    continue
+                seen.add(d)
+                out.append((u, d, cblob[i * _CONN_KEY_SIZE:(i + 1) * _CONN_KEY_SIZE]))
+        return out
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
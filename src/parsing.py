@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import base64
+import functools
 import json
 import re
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from urllib.parse import urlsplit, parse_qs, unquote, quote
 
-from .common import safe_b64decode_to_bytes
+from .common import safe_b64decode_to_bytes, decode_vmess_payload, proxy_keys, connection_key
+from .constants import PROXY_RECORD_CACHE
 
 # Regex and schemes
 SCHEMES = [
@@ -13,6 +16,9 @@ SCHEMES = [
 ]
 URI_REGEX = re.compile(r'(?i)\b(?:' + '|'.join(map(re.escape, SCHEMES)) + r')://[^\s<>"\']+')
 HOSTPORT_REGEX = re.compile(r'([A-Za-z0-9_.\-\[\]:]+):(\d{2,5})')
+OUR_REMARK_REGEX = re.compile(r'^\[OpenRay\]\s+.+\s+([A-Z]{2})-(\d+)$')
+# vmess JSON fields that shape the transport (kept in ProxyRecord.params)
+_VMESS_PARAM_KEYS = ('net', 'type', 'host', 'path', 'tls', 'sni', 'alpn', 'fp', 'scy', 'aid')
 
 
 def _idna(host: str) -> str:
@@ -32,29 +38,109 @@ def parse_source_line(line: str) -> Tuple[str, Dict[str, bool]]:
     return url, {'base64': flags.get('base64', False)}
 
 
-def maybe_decode_subscription(content: str, hinted_base64: bool = False) -> str:
-    """Decode subscription content when required.
+# Scanner: find every '://' with str/bytes.find, check the word before it against SCHEMES,
+# then cut at the first delimiter. Yields the same URIs as URI_REGEX.finditer without
+# running a 10-way alternation at every offset of multi-MB bodies.
+_SCHEME_SET = frozenset(SCHEMES)
+# Scheme lengths, most common first (vmess/vless, trojan, ss, ...)
+_SCHEME_SIZES = tuple(sorted({len(x) for x in SCHEMES}, key=lambda n: (n != 5, n != 6, n)))
+_URI_END = re.compile(r'[\s<>"\']')
+_URI_END_B = re.compile(rb'[\s\x1c-\x1f<>"\']')
+_URI_STRIP = ')>,;"\'\n\r'
 
-    Logic:
-    - If hinted_base64 is True, attempt decode once; if result contains URIs, return lines; else fallback to original.
-    - Else, if original content has no URI scheme patterns, try to base64-decode once or twice, stopping when URIs are found.
-    """
 
-    def contains_uri(txt: str) -> bool:
-        return URI_REGEX.search(txt) is not None
+_WORD_BYTES = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_')
+_SCHEME_SET_B = frozenset(x.encode('ascii') for x in SCHEMES)
 
+
+def _word_before(data: bytes, j: int) -> bool:
+    """Whether the UTF-8 character ending at data[j] (exclusive) is a word character."""
+    k = j - 1
+    while k > 0 and j - k < 4 and 0x80 <= data[k] <= 0xBF:
+        k -= 1
+    ch = bytes(data[k:j]).decode('utf-8', errors='ignore')
+    return bool(ch) and (ch[-1].isalnum() or ch[-1] == '_')
+
+
+def iter_uris(data: Union[str, bytes]) -> Iterator[str]:
+    """Yield proxy URIs found in text or raw bytes, in order (duplicates included)."""
+    if not data:
+        return
+    is_bytes = isinstance(data, (bytes, bytearray))
+    if is_bytes:
+        sep, end_re, schemes = b'://', _URI_END_B, _SCHEME_SET_B
+    else:
+        sep, end_re, schemes = '://', _URI_END, _SCHEME_SET
+    n = len(data)
+    pos = 0
+    while True:
+        i = data.find(sep, pos)
+        if i < 0:
+            return
+        # The scheme must end right at '://' and start on a word boundary (\b in URI_REGEX)
+        j = -1
+        for size in _SCHEME_SIZES:
+            k = i - size
+            if k < 0 or data[k:i].lower() not in schemes:
+                continue
+            if k == 0:
+                j = k
+            elif is_bytes:
+                c = data[k - 1]
+                if c not in _WORD_BYTES and (c < 0x80 or not _word_before(data, k)):
+                    j = k
+            else:
+                c = data[k - 1]
+                if not (c.isalnum() or c == '_'):
+                    j = k
+            if j >= 0:
+                break
+        if j < 0:
+            pos = i + 1
+            continue
+        m = end_re.search(data, i + 3)
+        end = m.start() if m else n
+        if end == i + 3:
+            pos = i + 1
+            continue
+        uri = data[j:end]
+        if is_bytes:
+            if uri.isascii():
+                uri = uri.decode('ascii')
+            else:
+                uri = uri.decode('utf-8', errors='ignore')
+                # Unicode whitespace (NBSP, ...) also ends a URI in text
+                cut = _URI_END.search(uri)
+                if cut is not None:
+                    if cut.start() <= i - j + 3:
+                        pos = i + 1
+                        continue
+                    uri = uri[:cut.start()]
+                    end = j + len(uri.encode('utf-8'))
+        # strip trailing punctuation that often follows links
+        yield uri.rstrip(_URI_STRIP)
+        pos = end
+
+
+def contains_uri(data: Union[str, bytes]) -> bool:
+    return next(iter_uris(data), None) is not None
+
+
+def decode_subscription(content: Union[str, bytes], hinted_base64: bool = False) -> Union[str, bytes]:
+    """Return the layer of content that holds proxy URIs.
+
+    Same rules as maybe_decode_subscription, but decoded base64 layers are returned as
+    raw bytes so iter_uris()/extract_uris() can scan them without a full text copy.
+    """
     if hinted_base64:
         b = safe_b64decode_to_bytes(content)
         if b:
-            text = b.decode('utf-8', errors='ignore')
-            if contains_uri(text):
-                return text
+            if contains_uri(b):
+                return b
             # sometimes the decoded content still is base64 layer
-            b2 = safe_b64decode_to_bytes(text)
-            if b2:
-                t2 = b2.decode('utf-8', errors='ignore')
-                if contains_uri(t2):
-                    return t2
+            b2 = safe_b64decode_to_bytes(b)
+            if b2 and contains_uri(b2):
+                return b2
         return content
 
     # Auto-detect: if already contains URIs, return as-is
@@ -64,30 +150,204 @@ def maybe_decode_subscription(content: str, hinted_base64: bool = False) -> str:
     # Try base64 decode once or twice
     b = safe_b64decode_to_bytes(content)
     if b:
-        text = b.decode('utf-8', errors='ignore')
-        if contains_uri(text):
-            return text
-        b2 = safe_b64decode_to_bytes(text)
-        if b2:
-            t2 = b2.decode('utf-8', errors='ignore')
-            if contains_uri(t2):
-                return t2
+        if contains_uri(b):
+            return b
+        b2 = safe_b64decode_to_bytes(b)
+        if b2 and contains_uri(b2):
+            return b2
     return content
 
 
-def extract_uris(text: str) -> List[str]:
+def maybe_decode_subscription(content: str, hinted_base64: bool = False) -> str:
+    """Decode subscription content when required.
+
+    Logic:
+    - If hinted_base64 is True, attempt decode once; if result contains URIs, return lines; else fallback to original.
+    - Else, if original content has no URI scheme patterns, try to base64-decode once or twice, stopping when URIs are found.
+    """
+    out = decode_subscription(content, hinted_base64=hinted_base64)
+    if isinstance(out, (bytes, bytearray)):
+        return out.decode('utf-8', errors='ignore')
+    return out
+
+
+def extract_uris(text: Union[str, bytes]) -> List[str]:
     if not text:
         return []
-    found = set()
-    uris: List[str] = []
-    for m in URI_REGEX.finditer(text):
-        uri = m.group(0)
-        # strip trailing punctuation that often follows links
-        uri = uri.rstrip(')>,;"\'\n\r')
-        if uri not in found:
-            found.add(uri)
-            uris.append(uri)
-    return uris
+    # dict keeps first-seen order while dropping repeats
+    return list(dict.fromkeys(iter_uris(text)))
+
+
+# Streaming counterparts of extract_uris(decode_subscription(...)) for bodies read in chunks
+_DELIMS_B = tuple(bytes([c]) for c in b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f<>"\'')
+# Enough bytes to re-check a scheme (and the UTF-8 character before it) split across chunks
+_SCAN_KEEP = max(len(x) for x in SCHEMES) + 4
+_B64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_B64_URLSAFE = bytes.maketrans(b'-_', b'+/')
+_B64_DROP = bytes(c for c in range(256) if c not in _B64_ALPHABET and c not in b'-_=')
+# Whitespace removed by str.split() / bytes.split() before safe_b64decode_to_bytes pads
+_WS_STR = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+_WS_BYTES = b' \t\n\r\x0b\x0c'
+
+
+class _ChunkScanner:
+    """iter_uris over a byte stream; the unfinished tail of each chunk is carried over."""
+
+    __slots__ = ('uris', '_carry')
+
+    def __init__(self) -> None:
+        self.uris: Dict[str, None] = {}
+        self._carry = b''
+
+    def feed(self, chunk: bytes) -> None:
+        data = self._carry + chunk if self._carry else chunk
+        # Text up to the last delimiter is final; the rest may continue in the next chunk
+        cut = max(data.rfind(d) for d in _DELIMS_B) + 1
+        if cut:
+            for uri in iter_uris(data[:cut]):
+                self.uris[uri] = None
+        tail = data[cut:]
+        if b'://' not in tail:
+            # e.g. one long base64 line: only a possibly split scheme needs to survive
+            tail = tail[-_SCAN_KEEP:]
+        self._carry = tail
+
+    def close(self) -> List[str]:
+        if self._carry:
+            for uri in iter_uris(self._carry):
+                self.uris[uri] = None
+            self._carry = b''
+        return list(self.uris)
+
+
+class _Base64Layer:
+    """Lenient streaming base64 decode (as safe_b64decode_to_bytes) feeding another sink.
+
+    Mirrors binascii.a2b_base64 in non-strict mode: characters outside the alphabet are
+    skipped, and a pad sequence that completes a quad ends the decode, so nothing after
+    it is emitted. Without one, the end is padded as safe_b64decode_to_bytes pads the
+    compacted text (by its length, invalid characters included).
+    """
+
+    __slots__ = ('inner', 'ok', 'decoded', '_buf', '_pads', '_chars', '_done', '_ascii_only', '_ws')
+
+    def __init__(self, inner, ascii_only: bool = False) -> None:
+        self.inner = inner
+        self.ok = True
+        self.decoded = 0
+        self._buf = b''
+        self._pads = 0
+        self._chars = 0
+        self._done = False
+        # Text bodies with non-ASCII characters never decode as a whole (str b64decode raises)
+        self._ascii_only = ascii_only
+        self._ws = _WS_STR if ascii_only else _WS_BYTES
+
+    def feed(self, chunk: bytes) -> None:
+        if not self.ok:
+            return
+        if self._ascii_only and not chunk.isascii():
+            self.ok = False
+            return
+        if self._done:
+            return
+        # safe_b64decode_to_bytes pads by the length of the text with whitespace removed
+        self._chars += len(chunk.translate(None, self._ws))
+        parts = chunk.translate(_B64_URLSAFE, _B64_DROP).split(b'=')
+        buf = self._buf
+        for i, seg in enumerate(parts):
+            if seg:
+                buf += seg
+                self._pads = 0
+            if i + 1 < len(parts) and self._pad(len(buf) % 4):
+                self._finish(buf)
+                return
+        n = len(buf) - len(buf) % 4
+        if n:
+            self._emit(buf[:n])
+        self._buf = buf[n:]
+
+    def _pad(self, quad_pos: int) -> bool:
+        """Account for one '='; True when it completes the quad and ends the data."""
+        if quad_pos < 2:
+            return False
+        self._pads += 1
+        return quad_pos + self._pads >= 4
+
+    def _finish(self, buf: bytes) -> None:
+        self._done = True
+        self._buf = b''
+        if buf:
+            self._emit(buf + b'=' * (-len(buf) % 4))
+
+    def _emit(self, quads: bytes) -> None:
+        try:
+            out = base64.b64decode(quads)
+        except Exception:
+            self.ok = False
+            return
+        if out:
+            self.decoded += len(out)
+            self.inner.feed(out)
+
+    def close(self) -> None:
+        if self.ok and not self._done:
+            buf = self._buf
+            for _ in range(-self._chars % 4):
+                if self._pad(len(buf) % 4):
+                    self._finish(buf)
+                    break
+            else:
+                if len(buf) % 4:
+                    # "Incorrect padding": the whole-body decode fails
+                    self.ok = False
+        self._buf = b''
+
+
+class SubscriptionScanner:
+    """Chunk-fed equivalent of extract_uris(decode_subscription(body, hinted_base64)).
+
+    The body is scanned as text and, at the same time, through one and two base64
+    layers; close() applies decode_subscription's choice between the three. Memory is
+    bounded by the chunk size plus the URIs found, never by the body size.
+    """
+
+    def __init__(self, hinted_base64: bool = False) -> None:
+        self.hinted_base64 = bool(hinted_base64)
+        self._plain = _ChunkScanner()
+        self._scan1 = _ChunkScanner()
+        self._scan2 = _ChunkScanner()
+        self._layer2 = _Base64Layer(self._scan2)
+        self._layer1 = _Base64Layer(_Fanout(self._scan1, self._layer2), ascii_only=True)
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        self._plain.feed(chunk)
+        self._layer1.feed(chunk)
+
+    def close(self) -> List[str]:
+        self._layer1.close()
+        self._layer2.close()
+        plain = self._plain.close()
+        first = self._scan1.close() if self._layer1.ok and self._layer1.decoded else []
+        second = []
+        if not first and self._layer1.ok and self._layer1.decoded and self._layer2.ok and self._layer2.decoded:
+            second = self._scan2.close()
+        if not self.hinted_base64 and plain:
+            return plain
+        return first or second or plain
+
+
+class _Fanout:
+    __slots__ = ('sinks',)
+
+    def __init__(self, *sinks) -> None:
+        self.sinks = sinks
+
+    def feed(self, chunk: bytes) -> None:
+        for sink in self.sinks:
+            sink.feed(chunk)
 
 
 def _split_netloc_for_host(netloc: str) -> Optional[str]:
@@ -109,16 +369,16 @@ def _split_netloc_for_host(netloc: str) -> Optional[str]:
 def host_from_vmess(uri: str) -> Optional[str]:
     # vmess://<base64-json>
     try:
-        payload_b64 = uri.split('://', 1)[1]
-        b = safe_b64decode_to_bytes(payload_b64)
-        if not b:
-            return None
-        obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
-        host = obj.get('add') or obj.get('address') or obj.get('host')
-        if isinstance(host, str) and host:
-            return _idna(host.strip())
+        obj = decode_vmess_payload(uri.split('://', 1)[1])
+        return _vmess_host(obj) if obj is not None else None
     except Exception:
         return None
+
+
+def _vmess_host(obj: Dict) -> Optional[str]:
+    host = obj.get('add') or obj.get('address') or obj.get('host')
+    if isinstance(host, str) and host:
+        return _idna(host.strip())
     return None
 
 
@@ -204,8 +464,7 @@ def host_from_generic(uri: str) -> Optional[str]:
     return None
 
 
-def extract_host(uri: str) -> Optional[str]:
-    scheme = uri.split('://', 1)[0].lower()
+def _host_by_scheme(uri: str, scheme: str) -> Optional[str]:
     if scheme == 'vmess':
         return host_from_vmess(uri)
     if scheme == 'ss':
@@ -216,21 +475,25 @@ def extract_host(uri: str) -> Optional[str]:
     return host_from_generic(uri)
 
 
+def extract_host(uri: str) -> Optional[str]:
+    return parse_proxy(uri).host
+
+
 def port_from_vmess(uri: str) -> Optional[int]:
     try:
-        payload_b64 = uri.split('://', 1)[1]
-        b = safe_b64decode_to_bytes(payload_b64)
-        if not b:
-            return None
-        obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
-        port = obj.get('port') or obj.get('portNumber')
-        if isinstance(port, str) and port.isdigit():
-            n = int(port)
-            return n if 1 <= n <= 65535 else None
-        if isinstance(port, int):
-            return port if 1 <= port <= 65535 else None
+        obj = decode_vmess_payload(uri.split('://', 1)[1])
+        return _vmess_port(obj) if obj is not None else None
     except Exception:
         return None
+
+
+def _vmess_port(obj: Dict) -> Optional[int]:
+    port = obj.get('port') or obj.get('portNumber')
+    if isinstance(port, str) and port.isdigit():
+        n = int(port)
+        return n if 1 <= n <= 65535 else None
+    if isinstance(port, int):
+        return port if 1 <= port <= 65535 else None
     return None
 
 
@@ -319,8 +582,7 @@ def port_from_generic(uri: str) -> Optional[int]:
     return None
 
 
-def extract_port(uri: str) -> Optional[int]:
-    scheme = uri.split('://', 1)[0].lower()
+def _port_by_scheme(uri: str, scheme: str) -> Optional[int]:
     if scheme == 'vmess':
         return port_from_vmess(uri)
     if scheme == 'ss':
@@ -330,6 +592,10 @@ def extract_port(uri: str) -> Optional[int]:
     return port_from_generic(uri)
 
 
+def extract_port(uri: str) -> Optional[int]:
+    return parse_proxy(uri).port
+
+
 def is_ip_address(host: str) -> bool:
     import ipaddress
     try:
@@ -339,57 +605,121 @@ def is_ip_address(host: str) -> bool:
         return False
 
 
-def _set_remark(uri: str, remark: str) -> str:
-    scheme = uri.split('://', 1)[0].lower()
+class ProxyRecord:
+    """One proxy URI parsed once.
+
+    Carries what the pipeline, grouping and exporters need (scheme, host, port,
+    credentials, transport params, remark) so the URI, and in particular a vmess
+    base64/JSON payload, is not decoded again at every step. Records come from
+    parse_proxy(), which caches them, so treat them as read-only.
+    """
+
+    __slots__ = ('uri', 'scheme', 'host', 'port', 'user', 'params', 'remark', 'vmess',
+                 '_dedup_key', '_conn_key')
+
+    def __init__(self, uri: str, scheme: str) -> None:
+        self.uri = uri
+        self.scheme = scheme
+        self.host: Optional[str] = None
+        self.port: Optional[int] = None
+        # vmess/vless id, trojan password or other userinfo
+        self.user: Optional[str] = None
+        self.params: Dict[str, str] = {}
+        self.remark: Optional[str] = None
+        # Decoded vmess JSON (vmess only)
+        self.vmess: Optional[Dict] = None
+        self._dedup_key: Optional[bytes] = None
+        self._conn_key: Optional[bytes] = None
+
+    def __repr__(self) -> str:
+        return f'ProxyRecord({self.scheme}://{self.host}:{self.port})'
+
+    @property
+    def dedup_key(self) -> bytes:
+        """16-byte OpenRay dedup key (binary form of common.get_openray_dedup_key)."""
+        if self._dedup_key is None:
+            self._dedup_key, conn = proxy_keys(self.uri, with_conn=False)
+            if conn is not None:
+                self._conn_key = conn
+        return self._dedup_key
+
+    @property
+    def conn_key(self) -> bytes:
+        """20-byte SHA1 of the normalized connection, as stored in the tested .bin files."""
+        if self._conn_key is None:
+            if self._dedup_key is None:
+                self._dedup_key, self._conn_key = proxy_keys(self.uri)
+            else:
+                self._conn_key = connection_key(self.uri)
+        return self._conn_key
+
+    @property
+    def conn_hash(self) -> str:
+        """Hex form of conn_key (common.get_proxy_connection_hash)."""
+        return self.conn_key.hex()
+
+    def with_remark(self, remark: str) -> str:
+        """The URI with its remark replaced (vmess 'ps', URL fragment otherwise)."""
+        if self.scheme == 'vmess':
+            if self.vmess is None:
+                return self.uri
+            try:
+                obj = dict(self.vmess)
+                obj['ps'] = remark
+                new_json = json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+                return 'vmess://' + base64.b64encode(new_json.encode('utf-8')).decode('ascii')
+            except Exception:
+                return self.uri
+        return self.uri.split('#', 1)[0] + '#' + quote(remark, safe='')
+
+
+def _parse_proxy(uri: str) -> ProxyRecord:
+    scheme = uri.split('://', 1)[0].lower() if '://' in uri else ''
+    rec = ProxyRecord(uri, scheme)
     if scheme == 'vmess':
-        try:
-            payload_b64 = uri.split('://', 1)[1]
-            b = safe_b64decode_to_bytes(payload_b64)
-            if b:
-                obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
-                if isinstance(obj, dict):
-                    obj['ps'] = remark
-                    new_json = json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
-                    import base64 as _b64
-                    new_b64 = _b64.b64encode(new_json.encode('utf-8')).decode('ascii')
-                    return 'vmess://' + new_b64
-        except Exception:
-            pass
-        return uri
-    # For non-vmess, set URL fragment
+        obj = decode_vmess_payload(uri.split('://', 1)[1])
+        if obj is None:
+            return rec
+        rec.vmess = obj
+        rec.host = _vmess_host(obj)
+        rec.port = _vmess_port(obj)
+        uid = obj.get('id')
+        rec.user = str(uid) if uid else None
+        rec.params = {k: str(obj[k]) for k in _VMESS_PARAM_KEYS if obj.get(k) not in (None, '')}
+        ps = obj.get('ps')
+        rec.remark = ps if isinstance(ps, str) and ps else None
+        return rec
+    rec.host = _host_by_scheme(uri, scheme)
+    rec.port = _port_by_scheme(uri, scheme)
     try:
-        base = uri.split('#', 1)[0]
-        return base + '#' + quote(remark, safe='')
+        p = urlsplit(uri)
+        if p.fragment:
+            rec.remark = unquote(p.fragment)
+        if scheme not in ('ss', 'ssr'):
+            if p.username:
+                rec.user = unquote(p.username)
+            if p.query:
+                rec.params = {k: v[0] for k, v in parse_qs(p.query).items() if v}
     except Exception:
-        if '#' in uri:
-            uri = uri.split('#', 1)[0]
-        return uri + '#' + quote(remark, safe='')
+        pass
+    return rec
+
+
+@functools.lru_cache(maxsize=PROXY_RECORD_CACHE)
+def parse_proxy(uri: str) -> ProxyRecord:
+    """Parse a proxy URI into a (cached, shared) ProxyRecord."""
+    return _parse_proxy(uri)
+
+
+def _set_remark(uri: str, remark: str) -> str:
+    return parse_proxy(uri).with_remark(remark)
 
 
 def _extract_our_cc_and_num_from_uri(uri: str) -> Optional[Tuple[str, int]]:
-    scheme = uri.split('://', 1)[0].lower()
-    tag = None
-    if scheme == 'vmess':
-        try:
-            payload_b64 = uri.split('://', 1)[1]
-            b = safe_b64decode_to_bytes(payload_b64)
-            if b:
-                obj = json.loads(b.decode('utf-8', errors='ignore') or '{}')
-                ps = obj.get('ps')
-                if isinstance(ps, str):
-                    tag = ps
-        except Exception:
-            tag = None
-    else:
-        try:
-            frag = urlsplit(uri).fragment
-            if frag:
-                tag = unquote(frag)
-        except Exception:
-            tag = None
+    tag = parse_proxy(uri).remark
     if not tag:
         return None
-    m = re.match(r'^\[OpenRay\]\s+.+\s+([A-Z]{2})-(\d+)$', tag)
+    m = OUR_REMARK_REGEX.match(tag)
     if not m:
         return None
     try:
@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+from typing import Callable, Container, Dict, List, Optional, Set, Tuple
+
+from .common import log, progress
+from .constants import FETCH_WORKERS, FETCH_TIMEOUT, STAGE2_CONCURRENCY, STAGE2_ITEM_TIMEOUT, PIPELINE_QUEUE_SIZE, XRAY_BATCH_SIZE, XRAY_INSTANCES
+from .net import iter_fetch_async, check_proxy_async, CheckResult, VerdictCache, _Stage2Limits, _effective_stage2_concurrency
+from .parse_pool import ParsePool
+from .parsing import ProxyRecord, SubscriptionScanner, parse_proxy
+from .source_state import SourceState
+
+
+_STOP = object()
+# How long a Stage 3 batch waits for more Stage 2 survivors before starting the core
+_STAGE3_LINGER_S = 1.0
+
+
+class PipelineResult:
+    """Counters and outputs of one streaming run over the sources."""
+
+    __slots__ = ('fetched', 'skipped', 'extracted', 'unique', 'new_hashes', 'limited', 'to_test',
+                 'stage2_ok', 'timed_out', 'available', 'checks')
+
+    def __init__(self) -> None:
+        self.fetched = 0
+        # Sources answered 304 or with an unchanged body (not parsed again)
+        self.skipped = 0
+        self.extracted = 0
+        self.unique = 0
+        # Connection keys (20-byte digests) of every new URI admitted for testing (recorded as tested regardless of outcome)
+        self.new_hashes: List[bytes] = []
+        self.limited = 0
+        self.to_test = 0
+        self.stage2_ok = 0
+        self.timed_out = 0
+        # Proxies that passed Stage 2 (and Stage 3 when enabled), in completion order
+        self.available: List[ProxyRecord] = []
+        # URI -> Stage 2 CheckResult (measured latencies) of every proxy that passed Stage 2
+        self.checks: Dict[str, CheckResult] = {}
+
+
+async def run_pipeline_async(sources: List[Tuple[str, Dict[str, bool]]], tested_hashes: Container[bytes],
+                             host_success: Dict[str, bool],
+                             verdicts: Optional[VerdictCache] = None,
+                             stage3: Optional[Callable[[List[str]], List[Optional[bool]]]] = None,
+                             new_limit: int = 0, source_state: Optional[SourceState] = None,
+                             parse_pool: Optional[ParsePool] = None) -> PipelineResult:
+    """Fetch, decode, dedup and test proxies as each source lands.
+
+    Stages are connected by bounded queues: when Stage 2 or Stage 3 fall behind, the
+    parser blocks, which in turn holds back the fetch workers, so at most a handful of
+    source bodies are alive at any time. host_success is updated in place per tested host.
+    stage3 (when given) is a blocking batch core check (e.g. XrayPool.run_batch) fed with
+    up to XRAY_BATCH_SIZE survivors at a time on XRAY_INSTANCES threads; only URIs for
+    which it returns True are kept.
+    With source_state, sources whose previous pass is still fully covered by the tested
+    store are fetched conditionally and skipped when unchanged; fully processed sources
+    are recorded back into it (the caller saves it).
+    Large sources are keyed on parse_pool's worker processes when one is given.
+    """
+    res = PipelineResult()
+    flags_by_url: Dict[str, Dict[str, bool]] = {}
+    for url, flags in sources:
+        flags_by_url.setdefault(url, flags)
+    urls = list(flags_by_url)
+    if not urls:
+        return res
+    retry_overrides: Dict[str, int] = {}
+    if source_state is not None:
+        # Most productive sources first; backing-off and quarantined ones wait
+        urls, retry_overrides = source_state.schedule(urls)
+    if verdicts is None:
+        verdicts = VerdictCache()
+
+    loop = asyncio.get_running_loop()
+    qsize = max(1, int(PIPELINE_QUEUE_SIZE))
+    stage2_q: "asyncio.Queue" = asyncio.Queue(maxsize=qsize)
+    stage3_q: "asyncio.Queue" = asyncio.Queue(maxsize=qsize)
+    workers2 = _effective_stage2_concurrency(int(STAGE2_CONCURRENCY))
+    workers3 = max(1, int(XRAY_INSTANCES))
+    batch_size = max(1, int(XRAY_BATCH_SIZE))
+    limits = _Stage2Limits(workers2)
+    deadline = float(STAGE2_ITEM_TIMEOUT)
+    seen_keys: Set[bytes] = set()
+
+    reusable: Set[str] = set()
+    validators: Dict[str, Dict[str, str]] = {}
+    # Per-source yield of this run: new URIs admitted for testing, URIs that passed
+    new_by_source: Dict[str, int] = {}
+    valid_by_source: Dict[str, int] = {}
+    if source_state is not None:
+        reusable = {u for u in urls if source_state.reusable(u)}
+        validators = {u: source_state.validators(u) for u in reusable}
+
+    def _scanner(url: str) -> SubscriptionScanner:
+        # Bodies are decoded and scanned chunk by chunk as they download
+        return SubscriptionScanner(bool((flags_by_url.get(url) or {}).get('base64', False)))
+
+    async def _producer() -> None:
+        ticks = iter(progress(range(len(urls)), total=len(urls)))
+        try:
+            async for url, content, meta in iter_fetch_async(urls, concurrency=int(FETCH_WORKERS), timeout=int(FETCH_TIMEOUT),
+                                                             validators=validators, with_meta=True,
+                                                             retries=retry_overrides, scanner_factory=_scanner):
+                next(ticks, None)
+                status = meta.get('status')
+                if source_state is not None:
+                    ok = status == 304 or (content is not None and status is not None and 200 <= int(status) < 300)
+                    source_state.record_fetch(url, ok, int(meta.get('elapsed_ms') or 0))
+                if url in reusable and (meta.get('status') == 304 or
+                                        (content is not None and meta.get('digest') == source_state.digest(url))):
+                    # Nothing new in this source since a pass that tested all of it
+                    if meta.get('status') == 304:
+                        source_state.not_modified += 1
+                    else:
+                        source_state.unchanged += 1
+                    source_state.touch(url, meta)
+                    new_by_source[url] = 0
+                    res.skipped += 1
+                    continue
+                if content is None:
+                    continue
+                res.fetched += 1
+                uris, content = content, None
+                res.extracted += len(uris)
+                keyed = None
+                if parse_pool is not None and parse_pool.wants(len(uris)):
+                    try:
+                        # (uri, dedup key, connection key) computed on the worker processes
+                        keyed = await parse_pool.key_uris(uris)
+                    except Exception as e:
+                        log(f"Parse pool failed for {url}, keying in-process: {e}")
+                if keyed is None:
+                    keyed = ((u, None, None) for u in uris)
+                # Complete once every proxy of the body is tested or admitted now (none held back)
+                complete = True
+                new_by_source[url] = 0
+                for u, dkey, h in keyed:
+                    rec = None
+                    if dkey is None:
+                        rec = parse_proxy(u)
+                        dkey = rec.dedup_key
+                    if dkey in seen_keys:
+                        continue
+                    seen_keys.add(dkey)
+                    if h is None:
+                        h = rec.conn_key
+                    if h in tested_hashes:
+                        continue
+                    if new_limit > 0 and len(res.new_hashes) >= new_limit:
+                        res.limited += 1
+                        complete = False
+                        continue
+                    res.new_hashes.append(h)
+                    new_by_source[url] += 1
+                    if rec is None:
+                        rec = parse_proxy(u)
+                    if rec.host:
+                        res.to_test += 1
+                        await stage2_q.put((rec, url))
+                if source_state is not None and meta.get('digest'):
+                    source_state.update(url, meta, complete)
+        except Exception as e:
+            log(f"Source pipeline stopped early: {e}")
+        finally:
+            next(ticks, None)
+            res.unique = len(seen_keys)
+        for _ in range(workers2):
+            await stage2_q.put(_STOP)
+
+    async def _stage2_worker() -> None:
+        while True:
+            item = await stage2_q.get()
+            if item is _STOP:
+                return
+            rec, src = item
+            host = rec.host
+            ok = False
+            try:
+                checked = await asyncio.wait_for(check_proxy_async(rec.uri, host, limits, verdicts), timeout=deadline)
+                ok = bool(checked)
+                if ok and isinstance(checked, CheckResult):
+                    res.checks[rec.uri] = checked
+            except asyncio.TimeoutError:
+                res.timed_out += 1
+            except Exception:
+                ok = False
+            # Mark host as tested this run
+            if host not in host_success:
+                host_success[host] = False
+            if not ok:
+                continue
+            host_success[host] = True
+            res.stage2_ok += 1
+            if stage3 is None:
+                res.available.append(rec)
+                valid_by_source[src] = valid_by_source.get(src, 0) + 1
+            else:
+                await stage3_q.put(item)
+
+    async def _stage3_worker(pool: concurrent.futures.ThreadPoolExecutor) -> None:
+        stopped = False
+        while not stopped:
+            first = await stage3_q.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            # Fill the batch with whatever Stage 2 hands over within the linger window
+            linger_until = loop.time() + _STAGE3_LINGER_S
+            while len(batch) < batch_size:
+                remaining = linger_until - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = await asyncio.wait_for(stage3_q.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if nxt is _STOP:
+                    stopped = True
+                    break
+                batch.append(nxt)
+            try:
+                oks = await loop.run_in_executor(pool, stage3, [rec.uri for rec, _src in batch])
+            except Exception:
+                oks = [None] * len(batch)
+            for (rec, src), ok in zip(batch, oks):
+                if ok is True:
+                    res.available.append(rec)
+                    valid_by_source[src] = valid_by_source.get(src, 0) + 1
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers3) if stage3 is not None else None
+    s3_tasks = [asyncio.ensure_future(_stage3_worker(pool)) for _ in range(workers3)] if pool is not None else []
+    try:
+        await asyncio.gather(_producer(), *(_stage2_worker() for _ in range(workers2)))
+        for _ in s3_tasks:
+            await stage3_q.put(_STOP)
+        await asyncio.gather(*s3_tasks)
+    finally:
+        for t in s3_tasks:
+            if not t.done():
+                t.cancel()
+        limits.icmp.close()
+        if pool is not None:
+            pool.shutdown(wait=True)
+    if res.timed_out:
+        log(f"Stage 2: {res.timed_out} proxies hit the {deadline:.0f}s per-proxy deadline")
+    if source_state is not None:
+        for url, n in new_by_source.items():
+            source_state.record_yield(url, n, valid_by_source.get(url, 0))
+    return res
+
+
+def run_pipeline(sources: List[Tuple[str, Dict[str, bool]]], tested_hashes: Container[bytes],
+                 host_success: Dict[str, bool], verdicts: Optional[VerdictCache] = None,
+                 stage3: Optional[Callable[[List[str]], List[Optional[bool]]]] = None,
+                 new_limit: int = 0, source_state: Optional[SourceState] = None) -> PipelineResult:
+    """Synchronous entry point for run_pipeline_async.
+
+    The parse pool is created here but only starts its workers for the first large source.
+    """
+    parse_pool = ParsePool()
+    try:
+        res = asyncio.run(run_pipeline_async(sources, tested_hashes, host_success, verdicts=verdicts,
+                                             stage3=stage3, new_limit=new_limit, source_state=source_state,
+                                             parse_pool=parse_pool))
+    finally:
+        parse_pool.close()
+    if parse_pool.sources:
+        log(f"Parse pool: keyed {parse_pool.uris} URIs of {parse_pool.sources} large sources on {parse_pool.processes} processes")
+    return res
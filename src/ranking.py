@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import heapq
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .check_counts import COUNTERS, CheckCountStore, get_check_counts
+from .constants import FASTEST_DIR, FASTEST_FILE, FASTEST_PER_COUNTRY, FASTEST_TOP
+from .io_ops import read_lines, write_text_file_atomic
+from .parsing import _extract_our_cc_and_num_from_uri
+from .scoring import ScoreStore, get_scores
+
+# Entries kept per ranking (the *_top100_checked.txt lists)
+TOP_K = 100
+# Ranking name -> (primary counter, tiebreak counter). Proxies are ordered by the decayed,
+# latency-weighted score of the primary counter, then by the raw counts; then list order
+RANKINGS: Dict[str, Tuple[str, str]] = {
+    'main': ('main', 'iran'),
+    'iran': ('iran', 'main'),
+}
+
+Ranked = List[Tuple[str, Dict[str, int], float]]  # (uri, counts, score)
+
+
+class Rankings:
+    """Several top-K rankings of one proxy list, computed from a single pass over the counts."""
+
+    def __init__(self, top: Dict[str, Ranked], stats: Dict[str, Tuple[int, float]], size: int) -> None:
+        self.top = top
+        self.stats = stats  # counter -> (max, average) over the ranked list
+        self.size = size
+
+    def __getitem__(self, name: str) -> Ranked:
+        return self.top[name]
+
+    def uris(self, name: str) -> List[str]:
+        return [uri for uri, _, _ in self.top[name]]
+
+
+def rank_proxies(proxies: Sequence[str], names: Iterable[str] = tuple(RANKINGS), k: int = TOP_K,
+                 counts: Optional[CheckCountStore] = None, scores: Optional[ScoreStore] = None) -> Rankings:
+    """Top k of proxies for each ranking in names.
+
+    Counts are looked up once per proxy; each ranking then scores those rows and keeps
+    its top k with heapq.nlargest, O(n log k) instead of sorting the whole list per
+    output file.
+    """
+    counts = counts if counts is not None else get_check_counts()
+    scores = scores if scores is not None else get_scores()
+    rows: List[Tuple[int, str, Dict[str, int]]] = []
+    totals = {c: 0 for c in COUNTERS}
+    maxima = {c: 0 for c in COUNTERS}
+    for idx, uri in enumerate(proxies):
+        c = counts.get(uri)
+        rows.append((idx, uri, c))
+        for name in COUNTERS:
+            v = c.get(name, 0)
+            totals[name] += v
+            if v > maxima[name]:
+                maxima[name] = v
+    now = time.time()
+    top: Dict[str, Ranked] = {}
+    for name in names:
+        primary, tiebreak = RANKINGS[name]
+        scored = [(scores.score(uri, primary, now), idx, uri, c) for idx, uri, c in rows]
+        best = heapq.nlargest(k, scored, key=lambda r: (r[0], r[3].get(primary, 0), r[3].get(tiebreak, 0), -r[1]))
+        top[name] = [(uri, c, score) for score, _, uri, c in best]
+    stats = {name: (maxima[name], totals[name] / len(rows) if rows else 0.0) for name in COUNTERS}
+    return Rankings(top, stats, len(rows))
+
+
+def write_if_changed(path: str, lines: List[str]) -> bool:
+    """Write lines to path unless it already holds exactly them; True when written."""
+    try:
+        if os.path.exists(path) and read_lines(path) == lines:
+            return False
+    except Exception:
+        pass
+    write_text_file_atomic(path, lines)
+    return True
+
+
+def rank_fastest(proxies: Sequence[str], scores: Optional[ScoreStore] = None) -> List[Tuple[str, float, float]]:
+    """Proxies with a measured latency as (uri, s3 p50, s2 p50), fastest first.
+
+    Proxies measured end to end (Stage 3) come first by their request median, then the
+    ones with only Stage 2 samples by their TCP connect median; a missing median is
+    reported as -1. Unmeasured proxies are left out.
+    """
+    scores = scores if scores is not None else get_scores()
+    rows = []
+    for idx, uri in enumerate(proxies):
+        s3 = scores.latency(uri, 's3')
+        s2 = scores.latency(uri, 's2')
+        if s3 is None and s2 is None:
+            continue
+        key = (0, s3, s2 if s2 is not None else 0.0, idx) if s3 is not None else (1, s2, 0.0, idx)
+        rows.append((key, uri, s3 if s3 is not None else -1.0, s2 if s2 is not None else -1.0))
+    rows.sort(key=lambda r: r[0])
+    return [(uri, s3, s2) for _, uri, s3, s2 in rows]
+
+
+def write_fastest_outputs(proxies: Sequence[str], scores: Optional[ScoreStore] = None,
+                          top: int = FASTEST_TOP, per_country: int = FASTEST_PER_COUNTRY) -> int:
+    """Write output/fastest.txt and output/fastest/<CC>.txt from the measured latencies.
+
+    Country files hold the per_country fastest proxies of each remark country (XX when the
+    remark has none); files of countries without measured proxies are removed. Returns the
+    number of measured proxies.
+    """
+    fastest = rank_fastest(proxies, scores)
+    write_if_changed(FASTEST_FILE, [uri for uri, _, _ in fastest[:max(1, int(top))]])
+    by_cc: Dict[str, List[str]] = {}
+    for uri, _, _ in fastest:
+        parsed = _extract_our_cc_and_num_from_uri(uri)
+        group = by_cc.setdefault(parsed[0] if parsed else 'XX', [])
+        if len(group) < per_country:
+            group.append(uri)
+    os.makedirs(FASTEST_DIR, exist_ok=True)
+    for cc, uris in by_cc.items():
+        write_if_changed(os.path.join(FASTEST_DIR, f'{cc}.txt'), uris)
+    try:
+        for name in os.listdir(FASTEST_DIR):
+            path = os.path.join(FASTEST_DIR, name)
+            if name.lower().endswith('.txt') and name[:-4] not in by_cc and os.path.isfile(path):
+                os.remove(path)
+    except Exception:
+        pass
+    return len(fastest)
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .check_counts import _key
+from .common import log
+from .constants import (
+    SCORES_COMPACT_KB,
+    SCORES_FILE,
+    SCORES_LOG_FILE,
+    SCORE_TTL_DAYS,
+    SCORE_HALF_LIFE_H,
+    SCORE_LATENCY_SAMPLES,
+    SCORE_STAGE2_REF_MS,
+    SCORE_STAGE3_REF_MS,
+)
+
+# Share of the score that depends on latency (the rest is decayed reliability)
+_LATENCY_WEIGHT = 0.5
+# Latency stages: sample key -> ms at which the latency factor is one half
+_STAGES = {'s2': SCORE_STAGE2_REF_MS, 's3': SCORE_STAGE3_REF_MS}
+# First line of the outcome log
+_LOG_HEADER = '#openray-scores 1'
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100) of samples; None when there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+class ScoreStore:
+    """Time-decayed reliability and rolling latency per proxy, in .state/scores.json.
+
+    Every check outcome of a proxy updates, per counter ("main", "iran"), a decayed
+    success sum and trial count: both are multiplied by 0.5 ** (elapsed / half-life)
+    before the new outcome is added, so last week's record outweighs last year's.
+    Reliability is the Laplace-smoothed rate (s + 1) / (n + 2), which drifts back to 0.5
+    for a proxy that has not been checked in a long time. Measured latencies are kept as
+    the last SCORE_LATENCY_SAMPLES samples per stage ("s2": Stage 2 TCP connect,
+    "s3": Stage 3 request through the proxy); the full breakdown of the latest check
+    (icmp, tcp, tls, http in ms, plus its time as "ts") is kept under "last".
+
+    score() is reliability * (1 - w + w * factor) with w = _LATENCY_WEIGHT (0.5) and the
+    latency factor ref / (ref + p50) of the Stage 3 median, else the Stage 2 one; so latency
+    scales a proxy between half and all of its reliability. Proxies without samples use
+    factor 0.5, i.e. three quarters of their reliability.
+    Entries are keyed by the dedup key, like the check counts.
+
+    Persistence follows CheckCountStore: scores.json is a compacted snapshot and save()
+    only appends the outcomes observed since to scores.log, one `o <counter> <ts>
+    <key>+|-...` line per batch plus an `l` line per proxy with its samples. Replay
+    skips a batch for every proxy whose stored counter is already at or past its
+    timestamp, so a log that was (partly) folded into the snapshot never counts twice.
+    Proxies are dropped when they have not been checked for SCORE_TTL_DAYS, not when
+    they leave the available list, so recent failures keep weighing on reliability.
+    """
+
+    def __init__(self, path: str = SCORES_FILE, half_life_h: float = SCORE_HALF_LIFE_H,
+                 samples: int = SCORE_LATENCY_SAMPLES, log_path: Optional[str] = None,
+                 ttl_days: float = SCORE_TTL_DAYS, compact_bytes: int = SCORES_COMPACT_KB * 1024) -> None:
+        self.path = path
+        self.log_path = log_path if log_path is not None else (
+            SCORES_LOG_FILE if path == SCORES_FILE else os.path.splitext(path)[0] + '.log')
+        self.half_life_s = max(1.0, float(half_life_h) * 3600.0)
+        self.samples = max(1, int(samples))
+        self.ttl_s = max(1.0, float(ttl_days) * 86400.0)
+        self.compact_bytes = int(compact_bytes)
+        self._entries: Dict[str, Dict] = {}
+        self._pending: List[Tuple[str, int, str, bool, Dict[str, float]]] = []
+        self._lock = threading.Lock()
+        self._hex: Dict[str, str] = {}
+        self.observed = 0
+
+    def _k(self, uri: str) -> str:
+        k = self._hex.get(uri)
+        if k is None:
+            k = self._hex[uri] = _key(uri).hex()
+        return k
+
+    def load(self) -> int:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8', errors='ignore') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self._entries = {str(k): v for k, v in data.items() if isinstance(v, dict)}
+        except Exception as e:
+            log(f"Failed to load proxy scores: {e}")
+            self._entries = {}
+        self._replay()
+        self._expire(time.time())
+        return len(self._entries)
+
+    def _replay(self) -> None:
+        try:
+            with open(self.log_path, 'r', encoding='utf-8', errors='ignore') as f:
+                if f.readline().rstrip('\n') != _LOG_HEADER:
+                    log("Proxy score log has an unknown header; ignoring it")
+                    return
+                applied: set = set()
+                for line in f:
+                    parts = line.split()
+                    try:
+                        if parts[0] == 'o':
+                            counter, ts = parts[1], int(parts[2])
+                            applied = {tok[:-1] for tok in parts[3:] if self._apply(tok[:-1], counter, tok[-1] == '+', ts)}
+                        elif parts[0] == 'l' and parts[3] in applied:
+                            self._apply_samples(parts[3], int(parts[2]),
+                                                {a: float(b) for a, b in (p.split('=', 1) for p in parts[4:])})
+                    except (ValueError, IndexError):
+                        continue
+        except OSError:
+            return
+
+    def _apply(self, k: str, counter: str, ok: bool, ts: int) -> bool:
+        """Fold one outcome at ts into entry k; False when the entry already covers ts."""
+        ent = self._entries.setdefault(k, {})
+        prev = ent.get(counter)
+        if prev and int(prev[2]) >= ts:
+            return False
+        s, n, pts = prev or (0.0, 0.0, ts)
+        f = self._decay(pts, ts)
+        ent[counter] = [round(s * f + (1.0 if ok else 0.0), 4), round(n * f + 1.0, 4), int(ts)]
+        return True
+
+    def _apply_samples(self, k: str, ts: int, values: Mapping[str, float]) -> None:
+        ent = self._entries.setdefault(k, {})
+        detail = {}
+        for name, ms in values.items():
+            if name in _STAGES:
+                window = ent.setdefault(name, [])
+                window.append(round(float(ms), 1))
+                del window[:-self.samples]
+            else:
+                detail[name] = ms
+        if detail:
+            ent['last'] = dict(detail, ts=int(ts))
+
+    def _expire(self, now: float) -> int:
+        """Drop proxies whose newest outcome is older than the TTL."""
+        cutoff = now - self.ttl_s
+        stale = [k for k, e in self._entries.items()
+                 if max((int(e[c][2]) for c in e if isinstance(e.get(c), list) and c not in _STAGES), default=0) < cutoff]
+        for k in stale:
+            del self._entries[k]
+        return len(stale)
+
+    def save(self) -> int:
+        """Append the outcomes observed since the last save to the log (compacting it when large).
+
+        Returns the number of bytes written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            lines: List[str] = []
+            batch: Optional[Tuple[str, int]] = None
+            tokens: List[str] = []
+            samples: List[str] = []
+            for counter, ts, k, ok, values in pending:
+                if batch != (counter, ts):
+                    if tokens:
+                        lines.append(f"o {batch[0]} {batch[1]} " + ' '.join(tokens))
+                        lines.extend(samples)
+                    batch, tokens, samples = (counter, ts), [], []
+                tokens.append(k + ('+' if ok else '-'))
+                if values:
+                    samples.append(f"l {counter} {ts} {k} " + ' '.join(f"{a}={b}" for a, b in values.items()))
+            if tokens:
+                lines.append(f"o {batch[0]} {batch[1]} " + ' '.join(tokens))
+                lines.extend(samples)
+            text = ''.join(ln + '\n' for ln in lines)
+            try:
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                fresh = not os.path.exists(self.log_path)
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write((_LOG_HEADER + '\n' if fresh else '') + text)
+                written = len(text)
+                if os.path.getsize(self.log_path) >= self.compact_bytes:
+                    written += self._compact()
+            except Exception as e:
+                log(f"Failed to save proxy scores: {e}")
+                return 0
+            return written
+
+    def _compact(self) -> int:
+        self._expire(time.time())
+        data = json.dumps(self._entries, separators=(',', ':'))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        tmp = self.log_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(_LOG_HEADER + '\n')
+        os.replace(tmp, self.log_path)
+        return len(data)
+
+    def compact(self) -> None:
+        with self._lock:
+            try:
+                self._compact()
+            except Exception as e:
+                log(f"Failed to save proxy scores: {e}")
+
+    def _decay(self, ts: float, now: float) -> float:
+        return 0.5 ** (max(0.0, now - ts) / self.half_life_s)
+
+    # ---- updates ----
+    def observe(self, uri: str, counter: str, ok: bool, latency_ms: Optional[Mapping[str, float]] = None,
+                now: Optional[float] = None, detail: Optional[Mapping[str, float]] = None) -> None:
+        """Record one check outcome for counter, with the stage latencies it measured (ms).
+
+        detail is the per-step breakdown of a passing check; it replaces the stored one.
+        """
+        ts = int(now if now is not None else time.time())
+        k = self._k(uri)
+        values = {stage: round(float(ms), 1) for stage, ms in (latency_ms or {}).items()
+                  if stage in _STAGES and ms is not None and ms >= 0}
+        if ok and detail:
+            values.update({name: ms for name, ms in detail.items() if name not in _STAGES})
+        with self._lock:
+            if self._apply(k, counter, ok, ts):
+                self._apply_samples(k, ts, values)
+                self._pending.append((counter, ts, k, ok, values))
+            self.observed += 1
+
+    def observe_many(self, outcomes: Iterable[Tuple[str, bool]], counter: str,
+                     latencies: Optional[Mapping[str, Mapping[str, float]]] = None,
+                     details: Optional[Mapping[str, Mapping[str, float]]] = None) -> int:
+        """observe() for (uri, ok) pairs sharing one timestamp; latencies maps uri -> stage -> ms
+        and details uri -> breakdown."""
+        now = time.time()
+        count = 0
+        for uri, ok in outcomes:
+            if uri:
+                self.observe(uri, counter, ok, (latencies or {}).get(uri), now, (details or {}).get(uri))
+                count += 1
+        return count
+
+    # ---- queries ----
+    def reliability(self, uri: str, counter: str, now: Optional[float] = None) -> float:
+        ent = self._entries.get(self._k(uri))
+        rec = ent.get(counter) if ent else None
+        if not rec:
+            return 0.5
+        s, n, ts = rec
+        f = self._decay(ts, float(now if now is not None else time.time()))
+        return (s * f + 1.0) / (n * f + 2.0)
+
+    def latency(self, uri: str, stage: str = 's3', q: float = 50) -> Optional[float]:
+        ent = self._entries.get(self._k(uri))
+        return percentile(ent.get(stage) or [], q) if ent else None
+
+    def last_check(self, uri: str) -> Dict[str, float]:
+        """Latency breakdown (ms) of the proxy's latest passing check; empty when none was measured."""
+        ent = self._entries.get(self._k(uri))
+        return dict(ent.get('last') or {}) if ent else {}
+
+    def score(self, uri: str, counter: str, now: Optional[float] = None) -> float:
+        factor = 0.5
+        for stage in ('s3', 's2'):
+            p50 = self.latency(uri, stage)
+            if p50 is not None:
+                factor = _STAGES[stage] / (_STAGES[stage] + p50)
+                break
+        return self.reliability(uri, counter, now) * (1.0 - _LATENCY_WEIGHT + _LATENCY_WEIGHT * factor)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_store: Optional[ScoreStore] = None
+_store_lock = threading.Lock()
+
+
+def get_scores() -> ScoreStore:
+    """The process-wide score store, loaded on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = ScoreStore()
+                store.load()
+                _store = store
+    return _store
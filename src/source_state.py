@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .constants import SOURCE_STATE_FILE, SOURCE_QUARANTINE_FAILS, SOURCE_BACKOFF_MAX_H, SOURCE_QUARANTINE_RETRY_H
+from .io_ops import tested_store_covers, tested_store_mark
+
+# Smoothing for the per-source latency/yield averages (weight of the newest run)
+_EWMA_ALPHA = 0.3
+# A validated proxy is worth this many merely new ones when ranking sources
+_VALID_WEIGHT = 20.0
+# Runs are hourly; a source due a little after this run starts is fetched now
+_SCHEDULE_SLACK_S = 600
+
+
+class SourceState:
+    """Per-source fetch cache persisted in .state/sources.json.
+
+    For every source the last full fetch stores the HTTP validators (ETag,
+    Last-Modified) and a digest of the body. A source may be skipped (304 or identical
+    body) only while it is reusable: its last pass was complete (nothing held back by
+    NEW_URIS_LIMIT), so every proxy of that body was recorded in the tested store, and
+    the store has not been rewritten since. The latter is checked once per run against
+    the tested_store_mark() saved with the file instead of keeping every proxy hash
+    here; after a cleanup or reset all sources are fetched and parsed in full again.
+
+    It is also the source health registry: fetch latency, failure streak and the yield
+    of new and of validated URIs per source drive schedule(), which starts the most
+    productive sources first, backs off failing ones and quarantines dead ones (retried
+    once every SOURCE_QUARANTINE_RETRY_H hours).
+    """
+
+    def __init__(self, path: str = SOURCE_STATE_FILE) -> None:
+        self.path = path
+        self._entries: Dict[str, Dict] = {}
+        self._mark: Optional[Dict] = None
+        self._intact: Optional[bool] = None
+        self._updated: Set[str] = set()
+        self.not_modified = 0
+        self.unchanged = 0
+        self.deferred = 0
+        self.quarantined = 0
+
+    def load(self) -> int:
+        try:
+            if not os.path.exists(self.path):
+                return 0
+            with open(self.path, 'r', encoding='utf-8', errors='ignore') as f:
+                data = json.load(f)
+            if isinstance(data, dict) and isinstance(data.get('sources'), dict):
+                self._entries = {str(k): v for k, v in data['sources'].items() if isinstance(v, dict)}
+                self._mark = data.get('tested')
+            elif isinstance(data, dict):
+                # Older layout ({url: entry} with per-proxy hashes): keep health, refetch once
+                self._entries = {str(k): v for k, v in data.items() if isinstance(v, dict)}
+                for ent in self._entries.values():
+                    ent.pop('hashes', None)
+                    ent['complete'] = False
+        except Exception:
+            self._entries = {}
+        return len(self._entries)
+
+    def save(self, keep: Optional[Iterable[str]] = None) -> int:
+        """Write atomically; entries for sources not in keep (when given) are dropped.
+
+        Call only after this run's hashes are in the tested store: the file records the
+        store's current mark as the point every complete entry is covered by.
+        """
+        if keep is not None:
+            wanted = set(keep)
+            self._entries = {u: e for u, e in self._entries.items() if u in wanted}
+        if not self._store_intact():
+            # Entries from before a rewrite of the store are not covered by the new mark
+            for url, ent in self._entries.items():
+                if url not in self._updated:
+                    ent['complete'] = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'tested': tested_store_mark(), 'sources': self._entries}, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except Exception:
+            return 0
+        return len(self._entries)
+
+    def _store_intact(self) -> bool:
+        """Whether the tested store still holds everything it held at the last save (checked once)."""
+        if self._intact is None:
+            self._intact = tested_store_covers(self._mark)
+        return self._intact
+
+    def reusable(self, url: str) -> bool:
+        ent = self._entries.get(url)
+        if not ent or not ent.get('complete') or not ent.get('digest'):
+            return False
+        return self._store_intact()
+
+    def validators(self, url: str) -> Dict[str, str]:
+        """Conditional request headers for a reusable source."""
+        ent = self._entries.get(url) or {}
+        headers: Dict[str, str] = {}
+        if ent.get('etag'):
+            headers['If-None-Match'] = str(ent['etag'])
+        if ent.get('last_modified'):
+            headers['If-Modified-Since'] = str(ent['last_modified'])
+        return headers
+
+    def digest(self, url: str) -> Optional[str]:
+        ent = self._entries.get(url)
+        return ent.get('digest') if ent else None
+
+    def touch(self, url: str, meta: Dict) -> None:
+        """Source confirmed unchanged: refresh validators the server may have rotated."""
+        ent = self._entries.get(url)
+        if not ent:
+            return
+        for key in ('etag', 'last_modified'):
+            if meta.get(key):
+                ent[key] = meta[key]
+        ent['checked'] = int(time.time())
+
+    def update(self, url: str, meta: Dict, complete: bool) -> None:
+        """Record a fully processed fetch; complete means every proxy of the body was tested or admitted."""
+        ent = self._entries.setdefault(url, {})
+        self._updated.add(url)
+        ent.update({
+            'etag': meta.get('etag') or '',
+            'last_modified': meta.get('last_modified') or '',
+            'digest': meta.get('digest') or '',
+            'complete': bool(complete),
+            'checked': int(time.time()),
+        })
+
+    # ---- health ----
+    @staticmethod
+    def _ewma(old, new: float) -> float:
+        return float(new) if old is None else (1.0 - _EWMA_ALPHA) * float(old) + _EWMA_ALPHA * float(new)
+
+    def record_fetch(self, url: str, ok: bool, elapsed_ms: int) -> None:
+        """Account one fetch attempt; failures extend the streak and push the next attempt out."""
+        now = int(time.time())
+        ent = self._entries.setdefault(url, {})
+        ent['fetches'] = int(ent.get('fetches', 0)) + 1
+        if ok:
+            ent['fail_streak'] = 0
+            ent['next_attempt'] = 0
+            ent['last_ok'] = now
+            ent['latency_ms'] = round(self._ewma(ent.get('latency_ms'), max(1, int(elapsed_ms))), 1)
+            return
+        streak = int(ent.get('fail_streak', 0)) + 1
+        ent['fail_streak'] = streak
+        ent['failures'] = int(ent.get('failures', 0)) + 1
+        if streak >= int(SOURCE_QUARANTINE_FAILS):
+            delay_h = int(SOURCE_QUARANTINE_RETRY_H)
+        elif streak >= 2:
+            delay_h = min(2 ** (streak - 2), int(SOURCE_BACKOFF_MAX_H))
+        else:
+            delay_h = 0
+        ent['next_attempt'] = now + delay_h * 3600 if delay_h else 0
+
+    def record_yield(self, url: str, new: int, valid: int) -> None:
+        """Fold this run's new and validated URI counts into the source's averages."""
+        ent = self._entries.get(url)
+        if ent is None:
+            return
+        ent['new_yield'] = round(self._ewma(ent.get('new_yield'), new), 2)
+        ent['valid_yield'] = round(self._ewma(ent.get('valid_yield'), valid), 2)
+
+    def is_quarantined(self, url: str) -> bool:
+        ent = self._entries.get(url) or {}
+        return int(ent.get('fail_streak', 0)) >= int(SOURCE_QUARANTINE_FAILS)
+
+    def score(self, url: str) -> float:
+        """Expected useful URIs per second of fetching; unknown sources rank first."""
+        ent = self._entries.get(url)
+        if not ent or ent.get('latency_ms') is None:
+            return float('inf')
+        value = 1.0 + float(ent.get('new_yield') or 0.0) + _VALID_WEIGHT * float(ent.get('valid_yield') or 0.0)
+        return value / max(0.05, float(ent['latency_ms']) / 1000.0)
+
+    def schedule(self, urls: List[str]) -> Tuple[List[str], Dict[str, int]]:
+        """Order urls by expected value and drop those backing off or quarantined.
+
+        Returns (urls to fetch now, per-url retry overrides). Sources with a failure
+        streak get no retries: one attempt per run is enough to notice a recovery.
+        """
+        now = time.time()
+        due: List[str] = []
+        retries: Dict[str, int] = {}
+        for u in urls:
+            ent = self._entries.get(u) or {}
+            if float(ent.get('next_attempt') or 0) > now + _SCHEDULE_SLACK_S:
+                self.deferred += 1
+                if self.is_quarantined(u):
+                    self.quarantined += 1
+                continue
+            if int(ent.get('fail_streak', 0)) > 0:
+                retries[u] = 0
+            due.append(u)
+        due.sort(key=self.score, reverse=True)
+        return due, retries
+
+    def quarantined_sources(self) -> List[str]:
+        return sorted(u for u in self._entries if self.is_quarantined(u))
+
+    def stats(self) -> Dict[str, int]:
+        return {'sources': len(self._entries), 'not_modified': self.not_modified, 'unchanged': self.unchanged,
+                'deferred': self.deferred, 'quarantined': self.quarantined}
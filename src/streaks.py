@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import sys
+import time
+from array import array
+from typing import Dict, Iterator, Mapping, Optional, Tuple
+
+from .io_ops import get_streaks_file
+
+# streaks.bin: header, n+1 host offsets, sorted UTF-8 host blob, then the streak,
+# last_test and last_success columns (n uint32 each, little-endian)
+_MAGIC = b'ORSTRK1\x00'
+_HEADER = struct.Struct('<8sII')
+# streaks.bin.log: one record per updated host, absolute values (replaying twice is harmless)
+_LOG_RECORD = struct.Struct('<III')
+# The log is folded into the base once it is this large, or as large as the base itself
+_COMPACT_MIN_BYTES = 256 * 1024
+
+Streak = Tuple[int, int, int]  # (streak, last_test, last_success)
+
+
+def _le(col: array) -> array:
+    if sys.byteorder != 'little':
+        col = array(col.typecode, col)
+        col.byteswap()
+    return col
+
+
+class StreakStore:
+    """Per-host success streaks in a packed, sorted binary base plus an update log.
+
+    The base (streaks.bin) is a sorted host blob with an offset column and three uint32
+    columns; get() binary-searches it in place, so a run only decodes the hosts it
+    actually tests instead of parsing an entry for every host ever seen. A run's
+    updates are appended to streaks.bin.log as (host, streak, last_test, last_success)
+    records; once the log outgrows the base it is merged back, and hosts not tested
+    within ttl_days are dropped at that point. A legacy streaks.json next to the base
+    is imported on the first save and removed.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl_days: Optional[int] = None) -> None:
+        if ttl_days is None:
+            from .constants import STREAKS_TTL_DAYS
+            ttl_days = STREAKS_TTL_DAYS
+        self.path = path or get_streaks_file()
+        self.log_path = self.path + '.log'
+        self.legacy_path = os.path.splitext(self.path)[0] + '.json'
+        self.ttl_days = max(1, int(ttl_days))
+        self._n = 0
+        self._offsets = array('I')
+        self._blob = b''
+        self._cols = (array('I'), array('I'), array('I'))
+        self._log: Dict[str, Streak] = {}
+        self._pending: Dict[str, Streak] = {}
+        self._legacy = False
+        self._log_bytes = 0
+        self.evicted = 0
+        self.written = 0
+
+    # ---- loading ----
+    def load(self) -> int:
+        """Map the base and read the update log; returns the number of base hosts."""
+        self._load_base()
+        self._load_log()
+        if not self._n and not self._log and os.path.exists(self.legacy_path):
+            self._load_legacy()
+        return self._n
+
+    def _load_base(self) -> None:
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            magic, n, blob_len = _HEADER.unpack_from(data, 0)
+            if magic != _MAGIC:
+                return
+            pos = _HEADER.size
+            offsets = array('I')
+            offsets.frombytes(data[pos:pos + 4 * (n + 1)])
+            pos += 4 * (n + 1)
+            blob = data[pos:pos + blob_len]
+            pos += blob_len
+            cols = []
+            for _ in range(3):
+                col = array('I')
+                col.frombytes(data[pos:pos + 4 * n])
+                pos += 4 * n
+                cols.append(col)
+            if sys.byteorder != 'little':
+                for col in (offsets, *cols):
+                    col.byteswap()
+            if len(offsets) != n + 1 or len(blob) != blob_len or any(len(c) != n for c in cols):
+                return
+            self._n, self._offsets, self._blob, self._cols = n, offsets, blob, tuple(cols)
+        except (OSError, struct.error, ValueError):
+            pass
+
+    def _load_log(self) -> None:
+        try:
+            with open(self.log_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+        self._log_bytes = len(data)
+        pos, end = 0, len(data)
+        while pos < end:
+            size = data[pos]
+            rec_end = pos + 1 + size + _LOG_RECORD.size
+            if rec_end > end:
+                break  # torn tail of an interrupted append
+            host = data[pos + 1:pos + 1 + size].decode('utf-8', errors='ignore')
+            self._log[host] = _LOG_RECORD.unpack_from(data, pos + 1 + size)
+            pos = rec_end
+
+    def _load_legacy(self) -> None:
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8', errors='ignore') as f:
+                data = json.load(f)
+        except Exception:
+            return
+        if not isinstance(data, dict):
+            return
+        for host, obj in data.items():
+            if not isinstance(obj, dict):
+                continue
+            try:
+                self._log[str(host)] = (int(obj.get('streak', 0)), int(obj.get('last_test', 0)),
+                                        int(obj.get('last_success', 0)))
+            except (TypeError, ValueError):
+                continue
+        self._legacy = True
+
+    # ---- lookups ----
+    def _base_index(self, key: bytes) -> int:
+        lo, hi = 0, self._n
+        blob, offsets = self._blob, self._offsets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and blob[offsets[lo]:offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def get(self, host: str) -> Optional[Streak]:
+        rec = self._pending.get(host) or self._log.get(host)
+        if rec is not None:
+            return rec
+        i = self._base_index(host.encode('utf-8', errors='ignore'))
+        if i < 0:
+            return None
+        return self._cols[0][i], self._cols[1][i], self._cols[2][i]
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.items())
+
+    def items(self) -> Iterator[Tuple[str, Streak]]:
+        """Every known host with its current record (base, log and pending updates merged)."""
+        overlay = dict(self._log)
+        overlay.update(self._pending)
+        blob, offsets = self._blob, self._offsets
+        for i in range(self._n):
+            host = blob[offsets[i]:offsets[i + 1]].decode('utf-8', errors='ignore')
+            rec = overlay.pop(host, None)
+            yield host, (rec if rec is not None else (self._cols[0][i], self._cols[1][i], self._cols[2][i]))
+        yield from overlay.items()
+
+    # ---- updates ----
+    def record(self, results: Mapping[str, bool], now: Optional[int] = None) -> int:
+        """Apply one run's per-host outcomes: a success extends the streak, a failure resets it."""
+        now = int(now if now is not None else time.time())
+        for host, success in results.items():
+            if not host:
+                continue
+            streak, _, last_success = self.get(host) or (0, 0, 0)
+            if success:
+                self._pending[host] = (streak + 1, now, now)
+            else:
+                self._pending[host] = (0, now, last_success)
+        return len(results)
+
+    def set(self, host: str, streak: int, last_test: int, last_success: int) -> None:
+        self._pending[host] = (int(streak), int(last_test), int(last_success))
+
+    # ---- persistence ----
+    def save(self) -> int:
+        """Persist pending updates (append, or compact when the log has grown); returns bytes written."""
+        if not self._pending and not self._legacy:
+            return 0
+        records = []
+        for host, rec in self._pending.items():
+            hb = host.encode('utf-8', errors='ignore')
+            if len(hb) > 255:
+                continue
+            records.append(bytes((len(hb),)) + hb + _LOG_RECORD.pack(*(min(max(int(v), 0), 0xFFFFFFFF) for v in rec)))
+        data = b''.join(records)
+        base_size = _HEADER.size + len(self._blob) + 16 * self._n
+        if self._legacy or self._log_bytes + len(data) >= max(_COMPACT_MIN_BYTES, base_size):
+            return self.compact()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.log_path, 'ab') as f:
+                f.write(data)
+        except OSError:
+            return 0
+        self._log.update(self._pending)
+        self._pending = {}
+        self._log_bytes += len(data)
+        self.written += len(data)
+        return len(data)
+
+    def compact(self, now: Optional[int] = None) -> int:
+        """Rewrite the base with every update merged in, evicting hosts untested for ttl_days."""
+        cutoff = int(now if now is not None else time.time()) - self.ttl_days * 86400
+        merged = []
+        evicted = 0
+        for host, rec in self.items():
+            hb = host.encode('utf-8', errors='ignore')
+            if rec[1] < cutoff or len(hb) > 255:
+                evicted += 1
+                continue
+            merged.append((hb, rec))
+        merged.sort(key=lambda t: t[0])
+        offsets = array('I', [0])
+        cols = (array('I'), array('I'), array('I'))
+        for hb, rec in merged:
+            offsets.append(offsets[-1] + len(hb))
+            for col, v in zip(cols, rec):
+                col.append(min(max(int(v), 0), 0xFFFFFFFF))
+        blob = b''.join(hb for hb, _ in merged)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, len(merged), len(blob)))
+                f.write(_le(offsets).tobytes())
+                f.write(blob)
+                for col in cols:
+                    f.write(_le(col).tobytes())
+                size = f.tell()
+            os.replace(tmp, self.path)
+            # The log's records are all in the new base now
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+            if self._legacy and os.path.exists(self.legacy_path):
+                os.remove(self.legacy_path)
+        except OSError:
+            return 0
+        self._n, self._offsets, self._blob, self._cols = len(merged), offsets, blob, cols
+        self._log, self._pending = {}, {}
+        self._log_bytes = 0
+        self._legacy = False
+        self.evicted += evicted
+        self.written += size
+        return size
+
+
+def streaks_to_dict(store: StreakStore) -> Dict[str, Dict[str, int]]:
+    return {host: {'streak': s, 'last_test': lt, 'last_success': ls} for host, (s, lt, ls) in store.items()}
+
+
+def update_from_dict(store: StreakStore, streaks: Mapping[str, Mapping[str, int]]) -> None:
+    for host, obj in streaks.items():
+        if not isinstance(obj, Mapping):
+            continue
+        try:
+            rec = (int(obj.get('streak', obj.get('consecutive', 0)) or 0), int(obj.get('last_test', 0) or 0),
+                   int(obj.get('last_success', 0) or 0))
+        except (TypeError, ValueError):
+            continue
+        if store.get(host) != rec:
+            store.set(host, *rec)
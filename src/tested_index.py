@@ -0,0 +1,498 @@
+from __future__ import annotations
+
+import json
+import math
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import numpy as _np  # optional: vectorized index/filter builds
+except Exception:
+    _np = None
+
+# Index layout: header, 256-entry cumulative fanout on the first digest byte, then the
+# sorted 20-byte digests back to back. The .bin tested files stay the source of truth;
+# the index only covers the prefix of each file recorded in the sidecar JSON.
+_MAGIC = b'ORTI'
+_VERSION = 1
+_HEADER = struct.Struct('>4sIQ')
+_FANOUT = struct.Struct('>256I')
+_DATA_OFF = _HEADER.size + _FANOUT.size
+DIGEST_SIZE = 20
+RECORD_SIZE = 28  # '>Q20s' records of the .bin files
+
+_BLOOM_MAGIC = b'ORTB'
+_BLOOM_VERSION = 2
+_BLOOM_HEADER = struct.Struct('>4sIQQIQ')  # magic, version, bits, capacity, hashes, covered index count
+_BLOOM_MIN_CAPACITY = 1 << 20
+_MASK64 = (1 << 64) - 1
+_BULK_CHUNK = 1 << 20
+
+
+def _read_bin_digests(path: str, start: int, end: int) -> List[bytes]:
+    """Digests of the whole 28-byte records in path[start:end]."""
+    n = (end - start) // RECORD_SIZE
+    if n <= 0:
+        return []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(n * RECORD_SIZE)
+    return [data[i + 8:i + RECORD_SIZE] for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE)]
+
+
+class BloomFilter:
+    """Bloom filter over SHA1 digests.
+
+    The digests are already uniform, so bit positions come from double hashing two
+    64-bit words of the digest itself instead of rehashing. Arithmetic wraps at 64 bits
+    so the numpy bulk path sets exactly the same bits as add().
+    """
+
+    __slots__ = ('m', 'k', 'capacity', 'bits')
+
+    def __init__(self, capacity: int, bits_per_entry: int = 10) -> None:
+        self.capacity = max(1, int(capacity))
+        m = max(8 * 1024, self.capacity * max(1, int(bits_per_entry)))
+        self.m = (m + 7) // 8 * 8
+        self.k = max(1, int(round(self.m / self.capacity * math.log(2))))
+        self.bits = bytearray(self.m // 8)
+
+    def _positions(self, d: bytes):
+        h1 = int.from_bytes(d[0:8], 'big')
+        h2 = int.from_bytes(d[8:16], 'big') | 1
+        m = self.m
+        return (((h1 + i * h2) & _MASK64) % m for i in range(self.k))
+
+    def add(self, d: bytes) -> None:
+        bits = self.bits
+        for pos in self._positions(d):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def add_many(self, digests) -> None:
+        """Vectorized add of an (n, 20) uint8 numpy array of digests."""
+        if len(digests) == 0:
+            return
+        h1 = _np.ascontiguousarray(digests[:, 0:8]).view('>u8').ravel().astype(_np.uint64)
+        h2 = _np.ascontiguousarray(digests[:, 8:16]).view('>u8').ravel().astype(_np.uint64) | _np.uint64(1)
+        bits = _np.frombuffer(self.bits, dtype=_np.uint8)
+        m = _np.uint64(self.m)
+        with _np.errstate(over='ignore'):
+            for i in range(self.k):
+                pos = (h1 + _np.uint64(i) * h2) % m
+                _np.bitwise_or.at(bits, (pos >> _np.uint64(3)).astype(_np.intp),
+                                  _np.left_shift(_np.uint8(1), (pos & _np.uint64(7)).astype(_np.uint8)))
+
+    def __contains__(self, d: bytes) -> bool:
+        bits = self.bits
+        for pos in self._positions(d):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, path: str, covered: int) -> None:
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, _BLOOM_VERSION, self.m, self.capacity, self.k, int(covered)))
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional[Tuple['BloomFilter', int]]:
+        """Return (filter, covered index count) or None when missing/corrupt."""
+        try:
+            with open(path, 'rb') as f:
+                magic, version, m, capacity, k, covered = _BLOOM_HEADER.unpack(f.read(_BLOOM_HEADER.size))
+                if magic != _BLOOM_MAGIC or version != _BLOOM_VERSION or m % 8:
+                    return None
+                bits = bytearray(f.read())
+            if len(bits) != m // 8:
+                return None
+            bf = cls.__new__(cls)
+            bf.m, bf.k, bf.capacity, bf.bits = int(m), int(k), int(capacity), bits
+            return bf, int(covered)
+        except Exception:
+            return None
+
+
+class TestedIndex:
+    """Membership over all tested hashes without building a Python set of the history.
+
+    Merged digests live in a sorted, memory-mapped file and are found by binary search
+    inside their fanout bucket. Records appended to the .bin files since the last merge
+    (the tails) plus legacy text-only files are held in a small in-memory set until
+    merge() folds them into the index.
+
+    A persisted Bloom filter (tested.bloom) fronts both: most lookups are for URIs never
+    tested before and are answered from the filter without touching the index pages.
+    A missing or stale filter is rebuilt from the index with numpy; without numpy the
+    index is queried directly rather than re-adding the history digest by digest.
+    """
+
+    def __init__(self, index_path: str, tested_files: List[str], bloom_bits_per_entry: int = 10) -> None:
+        self.path = index_path
+        self.meta_path = index_path + '.json'
+        self.bloom_path = os.path.splitext(index_path)[0] + '.bloom'
+        self._bloom_bits = max(1, int(bloom_bits_per_entry))
+        self._bloom: Optional[BloomFilter] = None
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self._base = os.path.dirname(index_path)
+        self._tested_files = list(tested_files)
+        self._fh = None
+        self._mm: Optional[mmap.mmap] = None
+        self._count = 0
+        self._fanout = (0,) * 256
+        self._delta: Set[bytes] = set()
+        self.rebuilt = False
+        self._open()
+
+    # ---- loading ----
+    def _rel(self, path: str) -> str:
+        try:
+            return os.path.relpath(path, self._base)
+        except ValueError:
+            return path
+
+    def _load_meta(self) -> Dict[str, int]:
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if int(data.get('count', -1)) != self._count:
+                return {}
+            return {str(k): int(v) for k, v in (data.get('files') or {}).items()}
+        except Exception:
+            return {}
+
+    def _map(self) -> None:
+        self._close_map()
+        self._count = 0
+        self._fanout = (0,) * 256
+        if not os.path.exists(self.path):
+            return
+        try:
+            fh = open(self.path, 'rb')
+            size = os.fstat(fh.fileno()).st_size
+            if size < _DATA_OFF:
+                fh.close()
+                return
+            magic, version, count = _HEADER.unpack(fh.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION or size < _DATA_OFF + count * DIGEST_SIZE:
+                fh.close()
+                return
+            self._fanout = _FANOUT.unpack(fh.read(_FANOUT.size))
+            self._count = int(count)
+            if self._count:
+                self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._fh = fh
+        except Exception:
+            self._close_map()
+            self._count = 0
+            self._fanout = (0,) * 256
+
+    def _open(self) -> None:
+        self._map()
+        merged = self._load_meta() if self._count else {}
+        bins = [(p + '.bin') for p in self._tested_files if os.path.exists(p + '.bin')]
+        sizes = {self._rel(b): os.path.getsize(b) for b in bins}
+        # A tracked log that shrank or vanished was rewritten (cleanup/reset): start over
+        stale = any(sizes.get(rel, -1) < off for rel, off in merged.items())
+        if stale or (self._count and not merged):
+            self._close_map()
+            self._count = 0
+            self._fanout = (0,) * 256
+            merged = {}
+            self.rebuilt = True
+        if not self._count and bins:
+            # No usable index: sort and dedup every log in one pass (vectorized when numpy
+            # is installed) instead of collecting the whole history in the delta set
+            try:
+                merged = self._bulk_build(bins, sizes) if _np is not None else self._sorted_build(bins, sizes)
+                self.rebuilt = False
+            except Exception:
+                merged = {}
+        self._open_bloom(sum(sizes.values()) // RECORD_SIZE)
+        for b in bins:
+            rel = self._rel(b)
+            start = merged.get(rel, 0)
+            try:
+                self._delta.update(_read_bin_digests(b, start, sizes[rel]))
+            except Exception:
+                continue
+        # Text-only (pre-binary) tested files are never merged; keep them in the delta
+        for p in self._tested_files:
+            if os.path.exists(p + '.bin') or not os.path.exists(p):
+                continue
+            try:
+                with open(p, 'r', encoding='utf-8', errors='ignore') as f:
+                    for line in f:
+                        h = line.strip()
+                        if h:
+                            try:
+                                self._delta.add(bytes.fromhex(h))
+                            except ValueError:
+                                continue
+            except Exception:
+                continue
+        if self._bloom is not None:
+            for d in self._delta:
+                self._bloom.add(d)
+        if self.rebuilt:
+            self.merge()
+
+    def _open_bloom(self, expected: int) -> None:
+        """Load the filter if it covers exactly the current index, otherwise rebuild it from the index."""
+        loaded = None if self.rebuilt else BloomFilter.load(self.bloom_path)
+        if loaded is not None:
+            bloom, covered = loaded
+            if covered == self._count and bloom.capacity >= self._count:
+                self._bloom = bloom
+                return
+        if _np is None and self._count:
+            # Per-digest Python adds would make startup O(history) again; lookups
+            # fall through to the index until numpy can rebuild the filter
+            self._bloom = None
+            return
+        self._rebuild_bloom(max(expected, self._count))
+        if self._count:
+            try:
+                self._bloom.save(self.bloom_path, self._count)
+            except Exception:
+                pass
+
+    def _rebuild_bloom(self, expected: int) -> None:
+        bloom = BloomFilter(max(_BLOOM_MIN_CAPACITY, 2 * int(expected)), self._bloom_bits)
+        if _np is not None and self._count:
+            for start in range(0, self._count, _BULK_CHUNK):
+                n = min(_BULK_CHUNK, self._count - start)
+                chunk = _np.frombuffer(self._mm, dtype=_np.uint8, count=n * DIGEST_SIZE,
+                                       offset=_DATA_OFF + start * DIGEST_SIZE).reshape(-1, DIGEST_SIZE)
+                bloom.add_many(chunk)
+                del chunk  # release the mmap export before the map can be closed
+        else:
+            for i in range(self._count):
+                bloom.add(self._digest_at(i))
+        self._bloom = bloom
+
+    def _bulk_build(self, bins: List[str], sizes: Dict[str, int]) -> Dict[str, int]:
+        """Write the index straight from the .bin logs with numpy (sort + unique + fanout)."""
+        dtype = _np.dtype([('ts', '>u8'), ('h', 'V20')])
+        cols = [_np.fromfile(b, dtype=dtype, count=sizes[self._rel(b)] // RECORD_SIZE)['h'] for b in bins]
+        uniq = _np.unique(_np.concatenate(cols)) if cols else _np.empty(0, dtype='V20')
+        del cols
+        raw = uniq.tobytes()
+        first = _np.frombuffer(raw, dtype=_np.uint8)[::DIGEST_SIZE]
+        fanout = _np.cumsum(_np.bincount(first, minlength=256)).astype('>u4')
+        total = len(uniq)
+        tmp = self.path + '.tmp'
+        os.makedirs(self._base or '.', exist_ok=True)
+        with open(tmp, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, _VERSION, total))
+            out.write(fanout.tobytes())
+            out.write(raw)
+        del raw, first, uniq
+        return self._install(tmp, total, bins, sizes)
+
+    def _sorted_build(self, bins: List[str], sizes: Dict[str, int]) -> Dict[str, int]:
+        """Pure-Python _bulk_build: one list sort of the logged digests, written in a single pass."""
+        digests: List[bytes] = []
+        for b in bins:
+            digests.extend(_read_bin_digests(b, 0, sizes[self._rel(b)]))
+        digests.sort()
+        uniq = [d for i, d in enumerate(digests) if not i or d != digests[i - 1]]
+        del digests
+        counts = [0] * 256
+        for d in uniq:
+            counts[d[0]] += 1
+        fanout = []
+        running = 0
+        for n in counts:
+            running += n
+            fanout.append(running)
+        tmp = self.path + '.tmp'
+        os.makedirs(self._base or '.', exist_ok=True)
+        with open(tmp, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, _VERSION, len(uniq)))
+            out.write(_FANOUT.pack(*fanout))
+            out.write(b''.join(uniq))
+        return self._install(tmp, len(uniq), bins, sizes)
+
+    def _install(self, tmp: str, total: int, bins: List[str], sizes: Dict[str, int]) -> Dict[str, int]:
+        """Move a freshly built index into place, record the covered log prefixes and map it."""
+        self._close_map()
+        os.replace(tmp, self.path)
+        try:
+            # A filter left from an earlier index could claim the same entry count
+            os.remove(self.bloom_path)
+        except OSError:
+            pass
+        files = {self._rel(b): sizes[self._rel(b)] - sizes[self._rel(b)] % RECORD_SIZE for b in bins}
+        self._save_meta(total, files)
+        self._map()
+        return files
+
+    def _save_meta(self, count: int, files: Dict[str, int]) -> None:
+        try:
+            with open(self.meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'count': count, 'files': files}, f)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
+        except Exception:
+            pass
+
+    # ---- lookups ----
+    def _digest_at(self, i: int) -> bytes:
+        off = _DATA_OFF + i * DIGEST_SIZE
+        return self._mm[off:off + DIGEST_SIZE]
+
+    def _bisect(self, d: bytes) -> int:
+        """Leftmost position of d among the merged digests."""
+        if not self._count:
+            return 0
+        b = d[0]
+        lo = self._fanout[b - 1] if b else 0
+        hi = self._fanout[b]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest_at(mid) < d:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def contains_digest(self, d: bytes) -> bool:
+        self.lookups += 1
+        if self._bloom is not None and len(d) == DIGEST_SIZE and d not in self._bloom:
+            self.bloom_negatives += 1
+            return False
+        if d in self._delta:
+            return True
+        if not self._count or len(d) != DIGEST_SIZE:
+            return False
+        i = self._bisect(d)
+        return i < self._count and self._digest_at(i) == d
+
+    def __contains__(self, h: object) -> bool:
+        if isinstance(h, bytes):
+            return self.contains_digest(h)
+        try:
+            return self.contains_digest(bytes.fromhex(str(h)))
+        except ValueError:
+            return False
+
+    def __len__(self) -> int:
+        # Delta entries may repeat merged ones only for text-only legacy files; close enough for stats
+        return self._count + len(self._delta)
+
+    @property
+    def tested_files(self) -> List[str]:
+        return list(self._tested_files)
+
+    @property
+    def pending(self) -> int:
+        return len(self._delta)
+
+    # ---- updates ----
+    def add_digests(self, digests: Iterable[bytes]) -> None:
+        """Record digests that were just appended to a .bin log."""
+        for d in digests:
+            if len(d) != DIGEST_SIZE:
+                continue
+            self._delta.add(d)
+            if self._bloom is not None:
+                self._bloom.add(d)
+
+    def merge(self) -> int:
+        """Fold the in-memory tail into the sorted file. Returns the merged entry count."""
+        new = sorted(d for d in self._delta if not (self._count and self._contains_merged(d)))
+        tmp = self.path + '.tmp'
+        os.makedirs(self._base or '.', exist_ok=True)
+        total = self._count + len(new)
+        counts = [0] * 256
+        with open(tmp, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, _VERSION, total))
+            out.write(b'\x00' * _FANOUT.size)
+            prev = 0
+            for d in new:
+                pos = self._bisect(d)
+                if pos > prev:
+                    out.write(self._mm[_DATA_OFF + prev * DIGEST_SIZE:_DATA_OFF + pos * DIGEST_SIZE])
+                    prev = pos
+                out.write(d)
+                counts[d[0]] += 1
+            if self._count > prev:
+                out.write(self._mm[_DATA_OFF + prev * DIGEST_SIZE:_DATA_OFF + self._count * DIGEST_SIZE])
+            # Cumulative fanout: old buckets plus the new digests per first byte
+            fanout = []
+            running = 0
+            for b in range(256):
+                old_n = self._fanout[b] - (self._fanout[b - 1] if b else 0)
+                running += old_n + counts[b]
+                fanout.append(running)
+            out.seek(_HEADER.size)
+            out.write(_FANOUT.pack(*fanout))
+        self._close_map()
+        os.replace(tmp, self.path)
+
+        files = {}
+        for p in self._tested_files:
+            b = p + '.bin'
+            if os.path.exists(b):
+                size = os.path.getsize(b)
+                files[self._rel(b)] = size - size % RECORD_SIZE
+        self._save_meta(total, files)
+        # Legacy text-only entries are re-read on every open, so they stay out of the tracked offsets
+        self._delta = set()
+        self._map()
+        # The filter already holds every merged digest; only resize when it filled up
+        if self._bloom is None or self._bloom.capacity < total:
+            if _np is not None:
+                self._rebuild_bloom(total)
+            else:
+                self._bloom = None
+        if self._bloom is not None:
+            try:
+                self._bloom.save(self.bloom_path, total)
+            except Exception:
+                pass
+        return total
+
+    def _contains_merged(self, d: bytes) -> bool:
+        i = self._bisect(d)
+        return i < self._count and self._digest_at(i) == d
+
+    def maybe_merge(self, min_pending: int) -> bool:
+        """Merge once the unmerged tail reaches min_pending entries (always when no index exists yet)."""
+        if not self._delta:
+            return False
+        if self._count and len(self._delta) < int(min_pending):
+            return False
+        self.merge()
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self),
+            'pending': len(self._delta),
+            'lookups': self.lookups,
+            'bloom_negatives': self.bloom_negatives,
+            'bloom_bytes': len(self._bloom.bits) if self._bloom is not None else 0,
+        }
+
+    # ---- teardown ----
+    def _close_map(self) -> None:
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except Exception:
+                pass
+            self._mm = None
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+    def close(self) -> None:
+        self._close_map()
@@ -6,7 +6,7 @@ import re
 from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlsplit, parse_qs, unquote
 
-from .common import safe_b64decode_to_bytes, sha1_hex
+from .common import decode_vmess_payload, sha1_hex
 from .constants import OUTPUT_DIR
 
 
@@ -29,14 +29,7 @@ def _sanitize_filename(name: str) -> str:
 def _parse_vmess(uri: str) -> Optional[Dict]:
     # vmess://<base64-json>
     try:
-        b64 = uri.split('://', 1)[1]
-        raw = safe_b64decode_to_bytes(b64)
-        if not raw:
-            return None
-        obj = json.loads(raw.decode('utf-8', errors='ignore') or '{}')
-        if not isinstance(obj, dict):
-            return None
-        return obj
+        return decode_vmess_payload(uri.split('://', 1)[1])
     except Exception:
         return None
 
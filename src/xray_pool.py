@@ -0,0 +1,402 @@
+from __future__ import annotations
+
+import concurrent.futures
+import errno
+import json
+import os
+import selectors
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.request import Request, build_opener, ProxyHandler
+
+from .common import log, progress
+from .constants import USER_AGENT, V2RAY_CORE_PATH, STAGE3_WORKERS, XRAY_BATCH_SIZE, XRAY_INSTANCES, XRAY_START_TIMEOUT_MS
+
+
+_TEST_URLS = (
+    'https://www.google.com/generate_204',
+    'https://cp.cloudflare.com/generate_204',
+)
+
+
+class XrayStartError(Exception):
+    """The core exited before serving the batch (bad config, port clash, crash)."""
+
+
+class StartupHistogram:
+    """Start-to-ready latencies of core processes, bucketed for tuning Stage 3 concurrency."""
+
+    BOUNDS_MS = (50, 100, 250, 500, 1000, 2000, 5000)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self._samples: List[float] = []
+        self.failures = 0
+
+    def record(self, seconds: float) -> None:
+        ms = seconds * 1000.0
+        idx = len(self.BOUNDS_MS)
+        for i, bound in enumerate(self.BOUNDS_MS):
+            if ms <= bound:
+                idx = i
+                break
+        with self._lock:
+            self._buckets[idx] += 1
+            self._samples.append(ms)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            samples = sorted(self._samples)
+            buckets = list(self._buckets)
+            failures = self.failures
+
+        def _pct(q: float) -> float:
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(q * (len(samples) - 1) + 0.5))]
+
+        labels = [f'<={b}ms' for b in self.BOUNDS_MS] + [f'>{self.BOUNDS_MS[-1]}ms']
+        return {
+            'count': len(samples),
+            'failures': failures,
+            'p50_ms': _pct(0.50),
+            'p95_ms': _pct(0.95),
+            'max_ms': samples[-1] if samples else 0.0,
+            'buckets': dict(zip(labels, buckets)),
+        }
+
+    def summary(self) -> str:
+        st = self.snapshot()
+        hist = ', '.join(f'{k}: {v}' for k, v in st['buckets'].items() if v)
+        return (f"{st['count']} ready, {st['failures']} not ready; p50={st['p50_ms']:.0f}ms "
+                f"p95={st['p95_ms']:.0f}ms max={st['max_ms']:.0f}ms [{hist}]")
+
+
+# Process-wide startup latencies of every core started for Stage 3
+STARTUP_STATS = StartupHistogram()
+
+
+def wait_until_ready(proc: Optional[subprocess.Popen], ports: List[int], timeout_s: float) -> float:
+    """Block until every local port accepts a TCP connection; return seconds waited.
+
+    Ports are probed with non-blocking connects multiplexed on one selector, so a batch
+    of inbounds costs a few syscalls per round instead of a guessed sleep. Raises
+    XrayStartError when the process exits or the deadline passes first.
+    """
+    t0 = time.perf_counter()
+    deadline = t0 + max(0.05, float(timeout_s))
+    remaining = set(int(p) for p in ports)
+    delay = 0.005
+    with selectors.DefaultSelector() as sel:
+        while remaining:
+            if proc is not None and proc.poll() is not None:
+                raise XrayStartError(f"core exited with code {proc.returncode}")
+            socks: List[socket.socket] = []
+            try:
+                pending = False
+                for port in list(remaining):
+                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    s.setblocking(False)
+                    socks.append(s)
+                    rc = s.connect_ex(('127.0.0.1', port))
+                    if rc == 0:
+                        remaining.discard(port)
+                    elif rc in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        sel.register(s, selectors.EVENT_WRITE, port)
+                        pending = True
+                if pending:
+                    for key, _ev in sel.select(timeout=min(0.05, max(0.0, deadline - time.perf_counter()))):
+                        if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                            remaining.discard(key.data)
+            finally:
+                for s in socks:
+                    try:
+                        sel.unregister(s)
+                    except Exception:
+                        pass
+                    s.close()
+            if not remaining:
+                break
+            if time.perf_counter() >= deadline:
+                raise XrayStartError(f"{len(remaining)} inbounds not ready after {timeout_s:.1f}s")
+            time.sleep(delay)
+            delay = min(0.05, delay * 2)
+    return time.perf_counter() - t0
+
+
+# Held from port allocation until the core listens on those ports: _free_ports releases the
+# ports before Xray binds them, and a concurrent batch must not be handed the same ones
+_start_lock = threading.Lock()
+
+
+def _free_ports(n: int) -> List[int]:
+    """Reserve n distinct local ports by binding them all at once, then release them.
+
+    Callers hold _start_lock until the ports are bound again by the core.
+    """
+    socks: List[socket.socket] = []
+    ports: List[int] = []
+    try:
+        for _ in range(n):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(('127.0.0.1', 0))
+            socks.append(s)
+            ports.append(s.getsockname()[1])
+    finally:
+        for s in socks:
+            try:
+                s.close()
+            except Exception:
+                pass
+    return ports
+
+
+def build_batch_config(uris: List[str]) -> Tuple[Dict, List[Optional[int]]]:
+    """One Xray config carrying an outbound per URI.
+
+    Every supported URI gets its own HTTP inbound on a local port, routed to its outbound
+    by inbound tag. Returns (config, ports) where ports[i] is None for unsupported URIs.
+    """
+    from .v2ray import build_config_for_uri  # local import: only needed when Stage 3 runs
+
+    outbounds: List[Dict] = []
+    slots: List[Optional[int]] = []
+    for i, u in enumerate(uris):
+        built = None
+        try:
+            built = build_config_for_uri(u)
+        except Exception:
+            built = None
+        if not built:
+            slots.append(None)
+            continue
+        _tag, cfg = built
+        try:
+            ob = dict(cfg['outbounds'][0])
+        except Exception:
+            slots.append(None)
+            continue
+        ob['tag'] = f'out-{i}'
+        outbounds.append(ob)
+        slots.append(i)
+
+    ports_iter = iter(_free_ports(len(outbounds)))
+    ports: List[Optional[int]] = []
+    inbounds: List[Dict] = []
+    rules: List[Dict] = []
+    for slot in slots:
+        if slot is None:
+            ports.append(None)
+            continue
+        port = next(ports_iter)
+        ports.append(port)
+        inbounds.append({
+            'tag': f'in-{slot}',
+            'listen': '127.0.0.1',
+            'port': int(port),
+            'protocol': 'http',
+            'settings': {}
+        })
+        rules.append({'type': 'field', 'inboundTag': [f'in-{slot}'], 'outboundTag': f'out-{slot}'})
+
+    cfg = {
+        'log': {'loglevel': 'warning'},
+        'inbounds': inbounds,
+        'outbounds': outbounds,
+        'routing': {'domainStrategy': 'AsIs', 'rules': rules},
+    }
+    return cfg, ports
+
+
+def _check_via_http_proxy(port: int, timeout_s: float) -> Optional[float]:
+    """Fetch a 204 endpoint through the local HTTP inbound.
+
+    Returns the duration of the successful (200/204) request in ms, None when every test
+    URL failed.
+    """
+    opener = build_opener(ProxyHandler({
+        'http': f'http://127.0.0.1:{port}',
+        'https': f'http://127.0.0.1:{port}',
+    }))
+    deadline = time.time() + max(2.0, float(timeout_s))
+    for url in _TEST_URLS:
+        if time.time() >= deadline:
+            break
+        try:
+            req = Request(url, headers={'User-Agent': USER_AGENT, 'Accept': '*/*'})
+            rem = max(0.5, deadline - time.time())
+            t0 = time.perf_counter()
+            with opener.open(req, timeout=rem) as resp:
+                code = getattr(resp, 'status', None) or getattr(resp, 'code', None)
+                if isinstance(code, int) and code in (200, 204):
+                    return (time.perf_counter() - t0) * 1000.0
+        except Exception:
+            continue
+    return None
+
+
+def _stop_process(proc: subprocess.Popen) -> None:
+    try:
+        proc.terminate()
+    except Exception:
+        pass
+    try:
+        proc.wait(timeout=0.5)
+    except Exception:
+        try:
+            proc.kill()
+            proc.wait(timeout=0.5)
+        except Exception:
+            pass
+
+
+def run_xray_batch(core_path: str, uris: List[str], timeout_s: float = 12,
+                   check_workers: Optional[int] = None,
+                   http_ms: Optional[Dict[str, float]] = None) -> List[Optional[bool]]:
+    """Start one core for a batch of URIs and check each outbound through its own inbound.
+
+    Returns per-URI True/False, or None for URIs the config builder does not support.
+    When http_ms is given, the request time (ms) of every passing URI is stored in it.
+    Raises XrayStartError when the core exits before the checks start.
+    """
+    results: List[Optional[bool]] = [None] * len(uris)
+    proc = None
+    tmp_path = None
+    # Serialized: between _free_ports and the core binding them, another batch could be
+    # given the same ports and wait_until_ready would see the other core's inbounds
+    _start_lock.acquire()
+    starting = True
+    try:
+        cfg, ports = build_batch_config(uris)
+        active = [(i, p) for i, p in enumerate(ports) if p is not None]
+        if not active:
+            return results
+
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
+        tmp_path = tmp.name
+        try:
+            tmp.write(json.dumps(cfg).encode('utf-8'))
+            tmp.flush()
+        finally:
+            tmp.close()
+
+        creation = (subprocess.CREATE_NO_WINDOW if os.name == 'nt' and hasattr(subprocess, 'CREATE_NO_WINDOW') else 0)
+        proc = subprocess.Popen([core_path, '-config', tmp_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=creation)
+        try:
+            STARTUP_STATS.record(wait_until_ready(proc, [p for _i, p in active], XRAY_START_TIMEOUT_MS / 1000.0))
+        except XrayStartError:
+            STARTUP_STATS.record_failure()
+            raise
+        finally:
+            starting = False
+            _start_lock.release()
+
+        workers = max(1, min(len(active), int(check_workers or STAGE3_WORKERS)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            timings = list(pool.map(lambda ip: _check_via_http_proxy(ip[1], timeout_s), active))
+        for (i, _p), ms in zip(active, timings):
+            results[i] = ms is not None
+            if ms is not None and http_ms is not None:
+                http_ms[uris[i]] = round(ms, 1)
+        return results
+    finally:
+        if starting:
+            _start_lock.release()
+        if proc is not None:
+            _stop_process(proc)
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except Exception:
+                pass
+
+
+class XrayPool:
+    """Stage 3 over a fixed number of Xray instance slots, each loaded with a batch of outbounds.
+
+    An instance serves one batch and is restarted with the next one, so process startup is
+    paid once per batch instead of once per proxy. A batch whose core refuses to start
+    (one malformed outbound is enough) is split in halves and retried, down to single
+    URIs, so one bad proxy cannot fail its neighbours.
+    """
+
+    def __init__(self, core_path: Optional[str] = None, instances: Optional[int] = None,
+                 batch_size: Optional[int] = None, timeout_s: float = 12) -> None:
+        self.core_path = (core_path if core_path is not None else (V2RAY_CORE_PATH or '')).strip()
+        self.instances = max(1, int(instances or XRAY_INSTANCES))
+        self.batch_size = max(1, int(batch_size or XRAY_BATCH_SIZE))
+        self.timeout_s = timeout_s
+        self._lock = threading.Lock()
+        # URI -> ms of the request that validated it, for every proxy that passed
+        self.http_ms: Dict[str, float] = {}
+        self.batches = 0
+        self.starts = 0
+        self.start_failures = 0
+
+    def available(self) -> bool:
+        return bool(self.core_path) and os.path.exists(self.core_path)
+
+    def run_batch(self, uris: List[str]) -> List[Optional[bool]]:
+        """Validate up to batch_size URIs on one instance (splitting on start failures)."""
+        if not uris:
+            return []
+        if not self.available():
+            return [None] * len(uris)
+        with self._lock:
+            self.batches += 1
+        return self._run(list(uris))
+
+    def _run(self, uris: List[str]) -> List[Optional[bool]]:
+        with self._lock:
+            self.starts += 1
+        try:
+            return run_xray_batch(self.core_path, uris, self.timeout_s, http_ms=self.http_ms)
+        except XrayStartError:
+            with self._lock:
+                self.start_failures += 1
+            if len(uris) == 1:
+                # Core ran but could not carry this proxy: same verdict as a failed fetch
+                return [False]
+            mid = len(uris) // 2
+            return self._run(uris[:mid]) + self._run(uris[mid:])
+        except Exception:
+            return [None] * len(uris)
+
+    def validate_many(self, uris: List[str], show_progress: bool = True) -> List[Optional[bool]]:
+        """Validate many URIs, running up to `instances` batches at once. Results keep input order."""
+        results: List[Optional[bool]] = [None] * len(uris)
+        if not uris or not self.available():
+            return results
+        chunks = [(off, uris[off:off + self.batch_size]) for off in range(0, len(uris), self.batch_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.instances, len(chunks))) as pool:
+            futs = {pool.submit(self.run_batch, chunk): (off, len(chunk)) for off, chunk in chunks}
+            done_iter = concurrent.futures.as_completed(futs)
+            if show_progress:
+                done_iter = progress(done_iter, total=len(futs))
+            for fut in done_iter:
+                off, n = futs[fut]
+                try:
+                    res = fut.result()
+                except Exception:
+                    res = [None] * n
+                results[off:off + n] = res
+        return results
+
+    def stats(self) -> Dict[str, object]:
+        return {'batches': self.batches, 'starts': self.starts, 'start_failures': self.start_failures,
+                'startup': STARTUP_STATS.snapshot()}
+
+    def log_stats(self, label: str = 'Stage 3') -> None:
+        st = self.stats()
+        if st['batches']:
+            log(f"{label}: {st['batches']} Xray batches, {st['starts']} core starts ({st['start_failures']} failed to start)")
+            log(f"{label}: Xray startup {STARTUP_STATS.summary()}")